@@ -1,8 +1,8 @@
 from .core.chat_dataset import *
-from .core.evaluate_chat_response import evaluate_chat_response
+from .core.evaluate_chat_response import aevaluate_chat_response, evaluate_chat_response
 from .core.evaluate_from_file import evaluate_from_file
-from .core.evaluate_generation import evaluate_generation
-from .core.evaluate_multiple_choice import evaluate_multiple_choice
+from .core.evaluate_generation import aevaluate_generation, evaluate_generation
+from .core.evaluate_multiple_choice import aevaluate_multiple_choice, evaluate_multiple_choice
 from .core.evaluate_pairwise import evaluate_pairwise
 from .core.evaluate_perplexity import evaluate_perplexity
 from .core.few_shot_generator import *
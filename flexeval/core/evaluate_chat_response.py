@@ -1,87 +1,161 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from typing import Any
+from typing import Any, Iterator
 
 from tqdm import tqdm
 
 from .chat_dataset import ChatDataset, ChatInstance
 from .language_model import LanguageModel
-from .metric import Metric
-from .utils.data_util import batch_iter
+from .metric import Metric, MetricResult
+from .utils.data_util import batch_iter, token_budget_batch_indices
 
 logger = logging.getLogger(__name__)
 
 
-def evaluate_chat_response(
+def _generate_incremental_responses(
     language_model: LanguageModel,
+    input_messages_list: list[list[dict[str, str]]],
     gen_kwargs: dict[str, Any],
-    eval_dataset: ChatDataset,
-    metrics: list[Metric],
+) -> list[list[dict[str, str]]]:
+    """Generate a response for each turn, feeding the model's previous responses as the chat history."""
+    max_num_turns = max(len(messages) for messages in input_messages_list)
+    current_chat_history: list[list[dict[str, str]]] = [[] for _ in input_messages_list]
+    # perform generation for each turn
+    for turn in range(max_num_turns):
+        batch_ids_fed_to_model = [b_id for b_id, messages in enumerate(input_messages_list) if turn < len(messages)]
+        current_model_inputs = [
+            current_chat_history[b_id] + [input_messages_list[b_id][turn]] for b_id in batch_ids_fed_to_model
+        ]
+        lm_outputs = language_model.batch_generate_chat_response(
+            current_model_inputs,
+            **gen_kwargs,
+        )
+        for o_id, b_id in enumerate(batch_ids_fed_to_model):
+            current_chat_history[b_id].append(input_messages_list[b_id][turn])
+            current_chat_history[b_id].append(
+                {"role": "assistant", "content": lm_outputs[o_id]},
+            )
+    return current_chat_history
+
+
+async def _agenerate_incremental_responses(
+    language_model: LanguageModel,
+    input_messages_list: list[list[dict[str, str]]],
+    gen_kwargs: dict[str, Any],
+) -> list[list[dict[str, str]]]:
+    """Asynchronous version of `_generate_incremental_responses`."""
+    max_num_turns = max(len(messages) for messages in input_messages_list)
+    current_chat_history: list[list[dict[str, str]]] = [[] for _ in input_messages_list]
+    for turn in range(max_num_turns):
+        batch_ids_fed_to_model = [b_id for b_id, messages in enumerate(input_messages_list) if turn < len(messages)]
+        current_model_inputs = [
+            current_chat_history[b_id] + [input_messages_list[b_id][turn]] for b_id in batch_ids_fed_to_model
+        ]
+        lm_outputs = await language_model.abatch_generate_chat_response(current_model_inputs, **gen_kwargs)
+        for o_id, b_id in enumerate(batch_ids_fed_to_model):
+            current_chat_history[b_id].append(input_messages_list[b_id][turn])
+            current_chat_history[b_id].append({"role": "assistant", "content": lm_outputs[o_id]})
+    return current_chat_history
+
+
+def _iter_conversations(
+    language_model: LanguageModel,
+    chat_instance_list: list[ChatInstance],
+    gen_kwargs: dict[str, Any],
+    batch_indices_list: list[list[int]],
+    require_incremental_response: bool,
+) -> Iterator[tuple[int, list[dict[str, str]], dict[str, Any]]]:
+    """Yield the index of each chat instance, the conversation including the model's responses,
+    and the statistics of the model for the last response, e.g., the latency of the request.
+    """
+    # Models that schedule the inputs by themselves receive the whole dataset and stream the responses back.
+    if language_model.prefers_whole_dataset() and not require_incremental_response:
+        all_messages_list = [chat_instance.messages for chat_instance in chat_instance_list]
+        instance_stats = {}
+        for idx, lm_output in language_model.iter_generate_chat_response(all_messages_list, **gen_kwargs):
+            # the stats of the other inputs may be collected before their responses are yielded
+            instance_stats.update(language_model.pop_instance_stats())
+            lm_stats = instance_stats.pop(idx, {})
+            yield idx, [*all_messages_list[idx], {"role": "assistant", "content": lm_output}], lm_stats
+        return
+
+    for batch_indices in batch_indices_list:
+        input_messages_list = [chat_instance_list[idx].messages for idx in batch_indices]
+        if not require_incremental_response:
+            lm_outputs = language_model.batch_generate_chat_response(
+                input_messages_list,
+                **gen_kwargs,
+            )
+            instance_stats = language_model.pop_instance_stats()
+            for i, (idx, input_messages, lm_output) in enumerate(zip(batch_indices, input_messages_list, lm_outputs)):
+                lm_stats = instance_stats.get(i, {})
+                yield idx, [*input_messages, {"role": "assistant", "content": lm_output}], lm_stats
+        else:
+            # the stats are not collected for the conversations with multiple responses
+            chat_history_list = _generate_incremental_responses(language_model, input_messages_list, gen_kwargs)
+            language_model.pop_instance_stats()
+            for idx, chat_history in zip(batch_indices, chat_history_list):
+                yield idx, chat_history, {}
+
+
+def _build_batch_indices_list(
+    language_model: LanguageModel,
+    chat_instance_list: list[ChatInstance],
     batch_size: int,
-) -> tuple[dict[str, float], list[dict[str, Any]]]:
-    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
+    max_tokens_per_batch: int | None = None,
+) -> list[list[int]]:
+    """Split the indices of the chat instances into batches."""
+    # Models that schedule the inputs by themselves (e.g., with continuous batching) receive the whole dataset.
+    if language_model.prefers_whole_dataset():
+        if max_tokens_per_batch is not None:
+            logger.warning(
+                "`max_tokens_per_batch` is ignored because the model receives the whole dataset "
+                "and schedules the inputs by itself.",
+            )
+        return list(batch_iter(range(len(chat_instance_list)), max(len(chat_instance_list), 1)))
+    if max_tokens_per_batch is None:
+        return list(batch_iter(range(len(chat_instance_list)), batch_size))
 
-    all_messages_list: list[list[dict[str, str]]] = []
-    references_list: list[list[str]] = []
-    extra_info_list: list[dict[str, Any]] = []
-    with tqdm(total=len(eval_dataset)) as pbar:
-        for i, batch in enumerate(batch_iter(eval_dataset, batch_size)):
-            batch: list[ChatInstance]
+    # When `max_tokens_per_batch` is specified, conversations of similar length are grouped together
+    # to reduce the padding. The outputs are restored to the original order afterwards.
+    chat_text_list = [
+        "".join(message.get("content", "") for message in chat_instance.messages)
+        for chat_instance in chat_instance_list
+    ]
+    return token_budget_batch_indices(
+        language_model.count_tokens(chat_text_list),
+        max_tokens=max_tokens_per_batch,
+        max_batch_size=batch_size,
+    )
 
-            input_messages_list = [chat_instance.messages for chat_instance in batch]
-            if not eval_dataset.require_incremental_response():
-                lm_outputs = language_model.batch_generate_chat_response(
-                    input_messages_list,
-                    **gen_kwargs,
-                )
-                for input_messages, lm_output in zip(input_messages_list, lm_outputs):
-                    all_messages_list.append(
-                        [*input_messages, {"role": "assistant", "content": lm_output}],
-                    )
-            else:
-                max_num_turns = max(len(messages) for messages in input_messages_list)
-                current_chat_history: list[list[dict[str, str]]] = [[] for _ in input_messages_list]
-                # perform generation for each turn
-                for turn in range(max_num_turns):
-                    batch_ids_fed_to_model = [
-                        b_id for b_id, messages in enumerate(input_messages_list) if turn < len(messages)
-                    ]
-                    current_model_inputs = [
-                        current_chat_history[b_id] + [input_messages_list[b_id][turn]]
-                        for b_id in batch_ids_fed_to_model
-                    ]
-                    lm_outputs = language_model.batch_generate_chat_response(
-                        current_model_inputs,
-                        **gen_kwargs,
-                    )
-                    for o_id, b_id in enumerate(batch_ids_fed_to_model):
-                        current_chat_history[b_id].append(input_messages_list[b_id][turn])
-                        current_chat_history[b_id].append(
-                            {"role": "assistant", "content": lm_outputs[o_id]},
-                        )
-                all_messages_list += current_chat_history
-
-            references_list += [chat_instance.references for chat_instance in batch]
-            extra_info_list += [chat_instance.extra_info for chat_instance in batch]
 
-            if i == 0:
-                logger.info("Example of the conversation")
-                logger.info(f"{all_messages_list[0]}")
+def _evaluate_metric(
+    metric: Metric,
+    all_messages_list: list[list[dict[str, str]]],
+    chat_instance_list: list[ChatInstance],
+) -> MetricResult:
+    return metric.evaluate(
+        lm_outputs=[messages[-1]["content"] for messages in all_messages_list],
+        references_list=[chat_instance.references for chat_instance in chat_instance_list],
+        task_inputs_list=[
+            {"messages": messages[:-1], **chat_instance.extra_info}
+            for messages, chat_instance in zip(all_messages_list, chat_instance_list)
+        ],
+    )
 
-            pbar.update(len(batch))
+
+def _build_results(
+    metric_results: list[MetricResult],
+    all_messages_list: list[list[dict[str, str]]],
+    lm_stats_list: list[dict[str, Any]],
+    chat_instance_list: list[ChatInstance],
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    """Merge the results of the metrics into the summary and the outputs of each instance."""
     metrics_summary_dict: dict[str, float] = {}
     instance_metrics_list: list[dict[str, Any]] = [{} for _ in range(len(all_messages_list))]
-    for metric in metrics:
-        metric_result = metric.evaluate(
-            lm_outputs=[messages[-1]["content"] for messages in all_messages_list],
-            references_list=references_list,
-            task_inputs_list=[
-                {"messages": messages[:-1], **extra_info}
-                for messages, extra_info in zip(all_messages_list, extra_info_list)
-            ],
-        )
-
+    for metric_result in metric_results:
         metrics_summary_dict.update(metric_result.summary)
 
         if metric_result.instance_details:
@@ -95,15 +169,132 @@ def evaluate_chat_response(
     outputs = [
         {
             "lm_output": messages[-1]["content"],
-            "task_inputs": {"messages": messages[:-1], **extra_info},
-            "references": references,
+            "task_inputs": {"messages": messages[:-1], **chat_instance.extra_info},
+            "references": chat_instance.references,
+            **lm_stats,
             **instance_metrics,
         }
-        for messages, references, extra_info, instance_metrics in zip(
+        for messages, chat_instance, lm_stats, instance_metrics in zip(
             all_messages_list,
-            references_list,
-            extra_info_list,
+            chat_instance_list,
+            lm_stats_list,
             instance_metrics_list,
         )
     ]
     return metrics_summary_dict, outputs
+
+
+def evaluate_chat_response(
+    language_model: LanguageModel,
+    gen_kwargs: dict[str, Any],
+    eval_dataset: ChatDataset,
+    metrics: list[Metric],
+    batch_size: int,
+    max_tokens_per_batch: int | None = None,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
+
+    chat_instance_list: list[ChatInstance] = list(eval_dataset)
+
+    batch_indices_list = _build_batch_indices_list(
+        language_model,
+        chat_instance_list,
+        batch_size=batch_size,
+        max_tokens_per_batch=max_tokens_per_batch,
+    )
+
+    all_messages_list: list[list[dict[str, str]]] = [[] for _ in chat_instance_list]
+    lm_stats_list: list[dict[str, Any]] = [{} for _ in chat_instance_list]
+    with tqdm(total=len(chat_instance_list)) as pbar:
+        for i, (idx, messages, lm_stats) in enumerate(
+            _iter_conversations(
+                language_model,
+                chat_instance_list,
+                gen_kwargs,
+                batch_indices_list,
+                require_incremental_response=eval_dataset.require_incremental_response(),
+            ),
+        ):
+            if i == 0:
+                logger.info("Example of the conversation")
+                logger.info(f"{messages}")
+
+            all_messages_list[idx] = messages
+            lm_stats_list[idx] = lm_stats
+            pbar.update(1)
+
+    metric_results = [_evaluate_metric(metric, all_messages_list, chat_instance_list) for metric in metrics]
+    return _build_results(metric_results, all_messages_list, lm_stats_list, chat_instance_list)
+
+
+async def aevaluate_chat_response(
+    language_model: LanguageModel,
+    gen_kwargs: dict[str, Any],
+    eval_dataset: ChatDataset,
+    metrics: list[Metric],
+    batch_size: int,
+    max_tokens_per_batch: int | None = None,
+    max_batches_in_flight: int = 2,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    """
+    Asynchronous version of `evaluate_chat_response`.
+
+    Up to `max_batches_in_flight` batches are passed to the asynchronous methods of the model at the same time.
+    Only the generation is pipelined: the metrics take all the outputs at once,
+    so they are computed after all the outputs are generated, in a thread not to block the event loop,
+    and the latency of LLM judges does not overlap with the generation.
+    The statistics of each instance reported by the model are not collected.
+    """
+    if max_batches_in_flight < 1:
+        msg = f"max_batches_in_flight must be a positive integer, but got {max_batches_in_flight}."
+        raise ValueError(msg)
+    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
+    loop = asyncio.get_running_loop()
+
+    chat_instance_list: list[ChatInstance] = list(eval_dataset)
+    batch_indices_list = _build_batch_indices_list(
+        language_model,
+        chat_instance_list,
+        batch_size=batch_size,
+        max_tokens_per_batch=max_tokens_per_batch,
+    )
+    require_incremental_response = eval_dataset.require_incremental_response()
+    all_messages_list: list[list[dict[str, str]]] = [[] for _ in chat_instance_list]
+    semaphore = asyncio.Semaphore(max_batches_in_flight)
+
+    async def _generate(batch_indices: list[int], pbar: tqdm) -> None:
+        async with semaphore:
+            input_messages_list = [chat_instance_list[idx].messages for idx in batch_indices]
+            if require_incremental_response:
+                chat_history_list = await _agenerate_incremental_responses(
+                    language_model,
+                    input_messages_list,
+                    gen_kwargs,
+                )
+            else:
+                lm_outputs = await language_model.abatch_generate_chat_response(input_messages_list, **gen_kwargs)
+                chat_history_list = [
+                    [*input_messages, {"role": "assistant", "content": lm_output}]
+                    for input_messages, lm_output in zip(input_messages_list, lm_outputs)
+                ]
+            for idx, chat_history in zip(batch_indices, chat_history_list):
+                all_messages_list[idx] = chat_history
+            pbar.update(len(batch_indices))
+
+    with tqdm(total=len(chat_instance_list)) as pbar:
+        await asyncio.gather(*[_generate(batch_indices, pbar) for batch_indices in batch_indices_list])
+    if all_messages_list:
+        logger.info("Example of the conversation")
+        logger.info(f"{all_messages_list[0]}")
+
+    # The metrics are computed one by one, because LLM judges may share a model that is not thread-safe.
+    metric_results = [
+        await loop.run_in_executor(None, _evaluate_metric, metric, all_messages_list, chat_instance_list)
+        for metric in metrics
+    ]
+    return _build_results(
+        metric_results,
+        all_messages_list,
+        [{} for _ in chat_instance_list],
+        chat_instance_list,
+    )
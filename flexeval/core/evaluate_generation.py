@@ -1,77 +1,140 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from typing import Any
+from typing import Any, Iterator
 
 from tqdm import tqdm
 
 from .few_shot_generator import FewShotGenerator
 from .generation_dataset import GenerationDataset, GenerationInstance
 from .language_model import LanguageModel
-from .metric import Metric
+from .metric import Metric, MetricResult
 from .prompt_template import PromptTemplate
-from .utils.data_util import batch_iter
+from .utils.data_util import batch_iter, token_budget_batch_indices
 
 logger = logging.getLogger(__name__)
 
 
-def evaluate_generation(
-    language_model: LanguageModel,
-    gen_kwargs: dict[str, Any],
-    eval_dataset: GenerationDataset,
+def _build_lm_prompt(
+    eval_instance: GenerationInstance,
     prompt_template: PromptTemplate,
-    metrics: list[Metric],
-    batch_size: int,
     few_shot_generator: FewShotGenerator | None = None,
-) -> tuple[dict[str, float], list[dict[str, Any]]]:
-    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
-    logger.info(f"Prompt template: {prompt_template}")
-    eval_instance_list: list[GenerationInstance] = []
-    lm_prompt_list: list[str] = []
-    lm_output_list: list[str] = []
-    with tqdm(total=len(eval_dataset)) as pbar:
-        for i, batch in enumerate(batch_iter(eval_dataset, batch_size)):
-            lm_prompts: list[str] = []
-            for eval_instance in batch:
-                template_inputs = eval_instance.inputs
-                if few_shot_generator is not None:
-                    few_shot_instances = few_shot_generator(template_inputs)
-                    few_shot_item_list: list[dict[str, Any]] = []
-                    for few_shot_instance in few_shot_instances:
-                        if isinstance(few_shot_instance, GenerationInstance):
-                            few_shot_item = {**few_shot_instance.inputs, "references": few_shot_instance.references}
-                            few_shot_item_list.append(few_shot_item)
-                        else:
-                            msg = f"Invalid instance type: {type(few_shot_instance)}"
-                            raise TypeError(msg)
-                    template_inputs = {**template_inputs, "few_shot_data": few_shot_item_list}
-                prompt = prompt_template.embed_input(template_inputs)
-                lm_prompts.append(prompt)
-
-            lm_outputs = language_model.batch_complete_text(
-                lm_prompts,
+) -> str:
+    template_inputs = eval_instance.inputs
+    if few_shot_generator is not None:
+        few_shot_instances = few_shot_generator(template_inputs)
+        few_shot_item_list: list[dict[str, Any]] = []
+        for few_shot_instance in few_shot_instances:
+            if isinstance(few_shot_instance, GenerationInstance):
+                few_shot_item = {**few_shot_instance.inputs, "references": few_shot_instance.references}
+                few_shot_item_list.append(few_shot_item)
+            else:
+                msg = f"Invalid instance type: {type(few_shot_instance)}"
+                raise TypeError(msg)
+        template_inputs = {**template_inputs, "few_shot_data": few_shot_item_list}
+    return prompt_template.embed_input(template_inputs)
+
+
+def _iter_lm_outputs(
+    language_model: LanguageModel,
+    lm_prompt_list: list[str],
+    gen_kwargs: dict[str, Any],
+    batch_indices_list: list[list[int]],
+    num_samples: int = 1,
+) -> Iterator[tuple[int, list[str], dict[str, Any]]]:
+    """Yield the index of each prompt, the output samples of the model as they are generated,
+    and the statistics of the model for the prompt, e.g., the latency of the request.
+    """
+    if num_samples > 1:
+        if language_model.prefers_whole_dataset():
+            batch_indices_list = [list(range(len(lm_prompt_list)))]
+        for batch_indices in batch_indices_list:
+            lm_output_samples = language_model.batch_complete_text_samples(
+                [lm_prompt_list[idx] for idx in batch_indices],
+                num_samples=num_samples,
                 **gen_kwargs,
             )
+            instance_stats = language_model.pop_instance_stats()
+            for i, (idx, samples) in enumerate(zip(batch_indices, lm_output_samples)):
+                yield idx, samples, instance_stats.get(i, {})
+        return
 
-            if i == 0:
-                logger.info("Example of the model inputs and outputs:")
-                logger.info(f"lm_prompts: {lm_prompts[0]}")
-                logger.info(f"lm_outputs: {lm_outputs[0]}")
+    # Models that schedule the inputs by themselves (e.g., with continuous batching) receive the whole dataset
+    # and stream the outputs back.
+    if language_model.prefers_whole_dataset():
+        instance_stats = {}
+        for idx, lm_output in language_model.iter_complete_text(lm_prompt_list, **gen_kwargs):
+            # the stats of the other inputs may be collected before their outputs are yielded
+            instance_stats.update(language_model.pop_instance_stats())
+            yield idx, [lm_output], instance_stats.pop(idx, {})
+        return
+
+    for batch_indices in batch_indices_list:
+        lm_outputs = language_model.batch_complete_text(
+            [lm_prompt_list[idx] for idx in batch_indices],
+            **gen_kwargs,
+        )
+        instance_stats = language_model.pop_instance_stats()
+        for i, (idx, lm_output) in enumerate(zip(batch_indices, lm_outputs)):
+            yield idx, [lm_output], instance_stats.get(i, {})
 
-            lm_prompt_list += lm_prompts
-            eval_instance_list += batch
-            lm_output_list += lm_outputs
 
-            pbar.update(len(batch))
-    metrics_summary_dict: dict[str, float] = {}
-    instance_metrics_list: list[dict[str, Any]] = [{} for _ in range(len(eval_instance_list))]
-    for metric in metrics:
-        metric_result = metric.evaluate(
-            lm_outputs=lm_output_list,
+def _build_batch_indices_list(
+    language_model: LanguageModel,
+    lm_prompt_list: list[str],
+    batch_size: int,
+    max_tokens_per_batch: int | None = None,
+) -> list[list[int]]:
+    if max_tokens_per_batch is not None and language_model.prefers_whole_dataset():
+        logger.warning(
+            "`max_tokens_per_batch` is ignored because the model receives the whole dataset "
+            "and schedules the inputs by itself.",
+        )
+        max_tokens_per_batch = None
+    # When `max_tokens_per_batch` is specified, prompts of similar length are grouped together
+    # to reduce the padding. The outputs are restored to the original order afterwards.
+    if max_tokens_per_batch is None:
+        return list(batch_iter(range(len(lm_prompt_list)), batch_size))
+    return token_budget_batch_indices(
+        language_model.count_tokens(lm_prompt_list),
+        max_tokens=max_tokens_per_batch,
+        max_batch_size=batch_size,
+    )
+
+
+def _evaluate_metric(
+    metric: Metric,
+    lm_output_samples_list: list[list[str]],
+    eval_instance_list: list[GenerationInstance],
+    num_samples: int,
+) -> MetricResult:
+    # With multiple samples per prompt, the metrics consume all the samples, e.g., for pass@k or majority voting.
+    if num_samples > 1:
+        return metric.evaluate_samples(
+            lm_output_samples=lm_output_samples_list,
             references_list=[i.references for i in eval_instance_list],
             task_inputs_list=[i.inputs for i in eval_instance_list],
         )
+    return metric.evaluate(
+        lm_outputs=[lm_output_samples[0] for lm_output_samples in lm_output_samples_list],
+        references_list=[i.references for i in eval_instance_list],
+        task_inputs_list=[i.inputs for i in eval_instance_list],
+    )
+
 
+def _build_results(
+    metric_results: list[MetricResult],
+    lm_prompt_list: list[str],
+    lm_output_samples_list: list[list[str]],
+    lm_stats_list: list[dict[str, Any]],
+    eval_instance_list: list[GenerationInstance],
+    num_samples: int,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    """Merge the results of the metrics into the summary and the outputs of each instance."""
+    metrics_summary_dict: dict[str, float] = {}
+    instance_metrics_list: list[dict[str, Any]] = [{} for _ in range(len(eval_instance_list))]
+    for metric_result in metric_results:
         metrics_summary_dict.update(metric_result.summary)
 
         if metric_result.instance_details:
@@ -85,16 +148,156 @@ def evaluate_generation(
     outputs = [
         {
             "lm_prompt": lm_prompt,
-            "lm_output": lm_output,
+            "lm_output": lm_output_samples[0],
+            **({"lm_output_samples": lm_output_samples} if num_samples > 1 else {}),
             "task_inputs": eval_instance.inputs,
             "references": eval_instance.references,
+            **lm_stats,
             **instance_metrics,
         }
-        for lm_prompt, lm_output, eval_instance, instance_metrics in zip(
+        for lm_prompt, lm_output_samples, lm_stats, eval_instance, instance_metrics in zip(
             lm_prompt_list,
-            lm_output_list,
+            lm_output_samples_list,
+            lm_stats_list,
             eval_instance_list,
             instance_metrics_list,
         )
     ]
     return metrics_summary_dict, outputs
+
+
+def evaluate_generation(
+    language_model: LanguageModel,
+    gen_kwargs: dict[str, Any],
+    eval_dataset: GenerationDataset,
+    prompt_template: PromptTemplate,
+    metrics: list[Metric],
+    batch_size: int,
+    few_shot_generator: FewShotGenerator | None = None,
+    max_tokens_per_batch: int | None = None,
+    num_samples: int = 1,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
+    logger.info(f"Prompt template: {prompt_template}")
+    eval_instance_list: list[GenerationInstance] = []
+    lm_prompt_list: list[str] = []
+    for eval_instance in eval_dataset:
+        lm_prompt_list.append(_build_lm_prompt(eval_instance, prompt_template, few_shot_generator))
+        eval_instance_list.append(eval_instance)
+
+    batch_indices_list = _build_batch_indices_list(language_model, lm_prompt_list, batch_size, max_tokens_per_batch)
+
+    lm_output_samples_list: list[list[str]] = [[] for _ in lm_prompt_list]
+    lm_stats_list: list[dict[str, Any]] = [{} for _ in lm_prompt_list]
+    with tqdm(total=len(lm_prompt_list)) as pbar:
+        for i, (idx, lm_output_samples, lm_stats) in enumerate(
+            _iter_lm_outputs(language_model, lm_prompt_list, gen_kwargs, batch_indices_list, num_samples),
+        ):
+            if i == 0:
+                logger.info("Example of the model inputs and outputs:")
+                logger.info(f"lm_prompts: {lm_prompt_list[idx]}")
+                logger.info(f"lm_outputs: {lm_output_samples[0]}")
+
+            lm_output_samples_list[idx] = lm_output_samples
+            lm_stats_list[idx] = lm_stats
+            pbar.update(1)
+
+    metric_results = [
+        _evaluate_metric(metric, lm_output_samples_list, eval_instance_list, num_samples) for metric in metrics
+    ]
+    return _build_results(
+        metric_results,
+        lm_prompt_list,
+        lm_output_samples_list,
+        lm_stats_list,
+        eval_instance_list,
+        num_samples,
+    )
+
+
+async def aevaluate_generation(
+    language_model: LanguageModel,
+    gen_kwargs: dict[str, Any],
+    eval_dataset: GenerationDataset,
+    prompt_template: PromptTemplate,
+    metrics: list[Metric],
+    batch_size: int,
+    few_shot_generator: FewShotGenerator | None = None,
+    max_tokens_per_batch: int | None = None,
+    num_samples: int = 1,
+    max_batches_in_flight: int = 2,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    """
+    Asynchronous version of `evaluate_generation`.
+
+    Up to `max_batches_in_flight` batches are passed to the asynchronous methods of the model at the same time,
+    and the prompts of the next batches are built while the model processes the previous ones.
+    Only the generation is pipelined: the metrics take all the outputs at once,
+    so they are computed after all the outputs are generated, in a thread not to block the event loop,
+    and the latency of LLM judges does not overlap with the generation.
+    The statistics of each instance reported by the model are not collected.
+    """
+    if max_batches_in_flight < 1:
+        msg = f"max_batches_in_flight must be a positive integer, but got {max_batches_in_flight}."
+        raise ValueError(msg)
+    logger.info(f"Evaluate the model with gen_kwargs: {gen_kwargs}")
+    logger.info(f"Prompt template: {prompt_template}")
+    loop = asyncio.get_running_loop()
+
+    eval_instance_list: list[GenerationInstance] = list(eval_dataset)
+    lm_output_samples_list: list[list[str]] = [[] for _ in eval_instance_list]
+    # The prompts are built for each batch while the previous batches are processed,
+    # unless they are needed beforehand to count the tokens.
+    lm_prompt_list: list[str | None] = [None] * len(eval_instance_list)
+    if max_tokens_per_batch is not None and not language_model.prefers_whole_dataset():
+        lm_prompt_list = [_build_lm_prompt(i, prompt_template, few_shot_generator) for i in eval_instance_list]
+    batch_indices_list = _build_batch_indices_list(language_model, lm_prompt_list, batch_size, max_tokens_per_batch)
+    semaphore = asyncio.Semaphore(max_batches_in_flight)
+
+    async def _generate(batch_indices: list[int], pbar: tqdm) -> None:
+        async with semaphore:
+            for idx in batch_indices:
+                if lm_prompt_list[idx] is None:
+                    lm_prompt_list[idx] = _build_lm_prompt(eval_instance_list[idx], prompt_template, few_shot_generator)
+            batch_prompts = [lm_prompt_list[idx] for idx in batch_indices]
+            if num_samples > 1:
+                batch_output_samples = await language_model.abatch_complete_text_samples(
+                    batch_prompts,
+                    num_samples=num_samples,
+                    **gen_kwargs,
+                )
+            else:
+                batch_output_samples = [
+                    [lm_output] for lm_output in await language_model.abatch_complete_text(batch_prompts, **gen_kwargs)
+                ]
+            for idx, lm_output_samples in zip(batch_indices, batch_output_samples):
+                lm_output_samples_list[idx] = lm_output_samples
+            pbar.update(len(batch_indices))
+
+    with tqdm(total=len(eval_instance_list)) as pbar:
+        await asyncio.gather(*[_generate(batch_indices, pbar) for batch_indices in batch_indices_list])
+    if lm_prompt_list:
+        logger.info("Example of the model inputs and outputs:")
+        logger.info(f"lm_prompts: {lm_prompt_list[0]}")
+        logger.info(f"lm_outputs: {lm_output_samples_list[0][0]}")
+
+    # The metrics are computed one by one, because LLM judges may share a model that is not thread-safe.
+    metric_results = [
+        await loop.run_in_executor(
+            None,
+            _evaluate_metric,
+            metric,
+            lm_output_samples_list,
+            eval_instance_list,
+            num_samples,
+        )
+        for metric in metrics
+    ]
+    return _build_results(
+        metric_results,
+        lm_prompt_list,
+        lm_output_samples_list,
+        [{} for _ in eval_instance_list],
+        eval_instance_list,
+        num_samples,
+    )
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from typing import Any
 
@@ -9,98 +10,231 @@ from .few_shot_generator import FewShotGenerator
 from .language_model import LanguageModel
 from .multiple_choice_dataset import MultipleChoiceDataset, MultipleChoiceInstance
 from .prompt_template import PromptTemplate
-from .utils.data_util import batch_iter
+from .utils.data_util import batch_iter, token_budget_batch_indices
 
 logger = logging.getLogger(__name__)
 
 
+def _build_prefix(
+    eval_instance: MultipleChoiceInstance,
+    prompt_template: PromptTemplate,
+    few_shot_generator: FewShotGenerator | None = None,
+) -> str:
+    template_inputs = {**eval_instance.inputs, "choices": eval_instance.choices}
+
+    if few_shot_generator is not None:
+        few_shot_instances = few_shot_generator(template_inputs)
+        few_shot_item_list: list[dict[str, Any]] = []
+        for few_shot_instance in few_shot_instances:
+            if isinstance(few_shot_instance, MultipleChoiceInstance):
+                few_shot_item = {
+                    **few_shot_instance.inputs,
+                    "choices": few_shot_instance.choices,
+                    "answer_index": few_shot_instance.answer_index,
+                }
+                few_shot_item_list.append(few_shot_item)
+            else:
+                msg = f"Invalid instance type: {type(few_shot_instance)}"
+                raise TypeError(msg)
+        template_inputs = {**template_inputs, "few_shot_data": few_shot_item_list}
+
+    return prompt_template.embed_input(template_inputs)
+
+
+def _count_max_input_tokens(
+    language_model: LanguageModel,
+    eval_instance_list: list[MultipleChoiceInstance],
+    prefix_list: list[str],
+) -> list[int]:
+    """Count the number of tokens of the longest `prefix + choice` for each instance."""
+    prefix_lengths = language_model.count_tokens(prefix_list)
+    all_choice_lengths = language_model.count_tokens(
+        [choice for eval_instance in eval_instance_list for choice in eval_instance.choices],
+    )
+    max_lengths: list[int] = []
+    offset = 0
+    for eval_instance, prefix_length in zip(eval_instance_list, prefix_lengths):
+        choice_lengths = all_choice_lengths[offset : offset + len(eval_instance.choices)]
+        max_lengths.append(prefix_length + max(choice_lengths, default=0))
+        offset += len(eval_instance.choices)
+    return max_lengths
+
+
+def _build_batch_indices_list(
+    language_model: LanguageModel,
+    eval_instance_list: list[MultipleChoiceInstance],
+    prefix_list: list[str],
+    batch_size: int,
+    max_tokens_per_batch: int | None = None,
+) -> list[list[int]]:
+    if language_model.prefers_whole_dataset():
+        if max_tokens_per_batch is not None:
+            logger.warning(
+                "`max_tokens_per_batch` is ignored because the model receives the whole dataset "
+                "and schedules the inputs by itself.",
+            )
+        return [list(range(len(eval_instance_list)))] if eval_instance_list else []
+    # When `max_tokens_per_batch` is specified, instances of similar length are grouped together
+    # to reduce the padding. Note that each instance occupies as many rows as the number of choices.
+    # The results are restored to the original order afterwards.
+    if max_tokens_per_batch is None:
+        return list(batch_iter(range(len(eval_instance_list)), batch_size))
+    return token_budget_batch_indices(
+        _count_max_input_tokens(language_model, eval_instance_list, prefix_list),
+        max_tokens=max_tokens_per_batch,
+        max_batch_size=batch_size,
+        num_rows=[len(eval_instance.choices) for eval_instance in eval_instance_list],
+    )
+
+
+def _build_batch_inputs(
+    batch_indices: list[int],
+    eval_instance_list: list[MultipleChoiceInstance],
+    prefix_list: list[str],
+) -> tuple[list[str], list[str]]:
+    """Flatten the choices of the instances in the batch into the prefixes and the texts to compute log probs."""
+    batch_prefixes: list[str] = []
+    batch_choices: list[str] = []
+    for idx in batch_indices:
+        eval_instance = eval_instance_list[idx]
+        batch_prefixes += [prefix_list[idx]] * len(eval_instance.choices)
+        batch_choices += eval_instance.choices
+    return batch_prefixes, batch_choices
+
+
+def _score_batch(
+    batch_indices: list[int],
+    batch_log_probs: list[float],
+    eval_instance_list: list[MultipleChoiceInstance],
+    prefix_list: list[str],
+    results: list[dict[str, Any]],
+) -> None:
+    """Select the choice with the highest log probability for each instance in the batch and fill `results`."""
+    i = 0
+    for idx in batch_indices:
+        eval_instance = eval_instance_list[idx]
+        log_probs_for_choices = batch_log_probs[i : i + len(eval_instance.choices)]
+        # select the choice with the highest log probability as model output
+        max_log_prob = max(log_probs_for_choices)
+        max_log_prob_index = log_probs_for_choices.index(max_log_prob)
+
+        # we also calculate accuracy using byte-normalized log probabilities
+        # for the discussion on normalization methods, see
+        # https://github.com/EleutherAI/lm-evaluation-harness/issues/1396
+        # https://blog.eleuther.ai/multiple-choice-normalization/
+        norm_log_probs = [
+            log_p / len(choice.encode("utf-8")) for log_p, choice in zip(log_probs_for_choices, eval_instance.choices)
+        ]
+        max_norm_log_p = max(norm_log_probs)
+        max_norm_log_p_index = norm_log_probs.index(max_norm_log_p)
+
+        results[idx] = {
+            "prefix": prefix_list[idx],
+            "choices": eval_instance.choices,
+            "answer_index": eval_instance.answer_index,
+            "log_probs": log_probs_for_choices,
+            "prediction": max_log_prob_index,
+            "byte_norm_log_probs": norm_log_probs,
+            "byte_norm_prediction": max_norm_log_p_index,
+        }
+        i += len(eval_instance.choices)
+
+
+def _compute_accuracy(results: list[dict[str, Any]]) -> dict[str, float]:
+    accuracy = sum(res["prediction"] == res["answer_index"] for res in results) / len(results)
+    byte_norm_accuracy = sum(res["byte_norm_prediction"] == res["answer_index"] for res in results) / len(results)
+
+    metrics_dict: dict[str, float] = {
+        "accuracy": accuracy,
+        "byte_norm_accuracy": byte_norm_accuracy,
+    }
+    logger.info(metrics_dict)
+    return metrics_dict
+
+
 def evaluate_multiple_choice(
     language_model: LanguageModel,
     eval_dataset: MultipleChoiceDataset,
     prompt_template: PromptTemplate,
     batch_size: int,
     few_shot_generator: FewShotGenerator | None = None,
+    max_tokens_per_batch: int | None = None,
 ) -> tuple[dict[str, float], list[dict[str, Any]]]:
-    results: list[dict[str, Any]] = []
-    with tqdm(total=len(eval_dataset)) as pbar:
-        for batch_id, batch in enumerate(batch_iter(eval_dataset, batch_size)):
-            batch: list[MultipleChoiceInstance]
-
-            batch_prefixes: list[str] = []
-            batch_choices: list[str] = []
-            for eval_instance in batch:
-                template_inputs = {**eval_instance.inputs, "choices": eval_instance.choices}
-
-                if few_shot_generator is not None:
-                    few_shot_instances = few_shot_generator(template_inputs)
-                    few_shot_item_list: list[dict[str, Any]] = []
-                    for few_shot_instance in few_shot_instances:
-                        if isinstance(few_shot_instance, MultipleChoiceInstance):
-                            few_shot_item = {
-                                **few_shot_instance.inputs,
-                                "choices": few_shot_instance.choices,
-                                "answer_index": few_shot_instance.answer_index,
-                            }
-                            few_shot_item_list.append(few_shot_item)
-                        else:
-                            msg = f"Invalid instance type: {type(few_shot_instance)}"
-                            raise TypeError(msg)
-                    template_inputs = {**template_inputs, "few_shot_data": few_shot_item_list}
-
-                prefix = prompt_template.embed_input(template_inputs)
-                batch_prefixes += [prefix] * len(eval_instance.choices)
-                batch_choices += eval_instance.choices
+    eval_instance_list: list[MultipleChoiceInstance] = []
+    prefix_list: list[str] = []
+    for eval_instance in eval_dataset:
+        prefix_list.append(_build_prefix(eval_instance, prompt_template, few_shot_generator))
+        eval_instance_list.append(eval_instance)
+
+    batch_indices_list = _build_batch_indices_list(
+        language_model,
+        eval_instance_list,
+        prefix_list,
+        batch_size,
+        max_tokens_per_batch,
+    )
+
+    results: list[dict[str, Any]] = [{} for _ in eval_instance_list]
+    with tqdm(total=len(eval_instance_list)) as pbar:
+        for batch_id, batch_indices in enumerate(batch_indices_list):
+            batch_prefixes, batch_choices = _build_batch_inputs(batch_indices, eval_instance_list, prefix_list)
 
             if batch_id == 0:
                 logger.info("Example of the model inputs and outputs:")
                 logger.info(f"prefix: {batch_prefixes[0]}")
-                logger.info(f"choices: {batch_choices[:len(eval_instance.choices)]}")
+                logger.info(f"choices: {batch_choices[:len(eval_instance_list[batch_indices[0]].choices)]}")
 
             batch_log_probs = language_model.batch_compute_log_probs(
                 text_list=batch_choices,
                 prefix_list=batch_prefixes,
             )
+            _score_batch(batch_indices, batch_log_probs, eval_instance_list, prefix_list, results)
 
-            # calculate accuracy
-            i = 0
-            for eval_instance in batch:
-                log_probs_for_choices = batch_log_probs[i : i + len(eval_instance.choices)]
-                # select the choice with the highest log probability as model output
-                max_log_prob = max(log_probs_for_choices)
-                max_log_prob_index = log_probs_for_choices.index(max_log_prob)
-
-                # we also calculate accuracy using byte-normalized log probabilities
-                # for the discussion on normalization methods, see
-                # https://github.com/EleutherAI/lm-evaluation-harness/issues/1396
-                # https://blog.eleuther.ai/multiple-choice-normalization/
-                norm_log_probs = [
-                    log_p / len(choice.encode("utf-8"))
-                    for log_p, choice in zip(log_probs_for_choices, eval_instance.choices)
-                ]
-                max_norm_log_p = max(norm_log_probs)
-                max_norm_log_p_index = norm_log_probs.index(max_norm_log_p)
-
-                results.append(
-                    {
-                        "prefix": batch_prefixes[i],
-                        "choices": eval_instance.choices,
-                        "answer_index": eval_instance.answer_index,
-                        "log_probs": log_probs_for_choices,
-                        "prediction": max_log_prob_index,
-                        "byte_norm_log_probs": norm_log_probs,
-                        "byte_norm_prediction": max_norm_log_p_index,
-                    },
-                )
-                i += len(eval_instance.choices)
-
-            pbar.update(len(batch))
+            pbar.update(len(batch_indices))
 
-    accuracy = sum(res["prediction"] == res["answer_index"] for res in results) / len(results)
-    byte_norm_accuracy = sum(res["byte_norm_prediction"] == res["answer_index"] for res in results) / len(results)
+    return _compute_accuracy(results), results
 
-    metrics_dict: dict[str, float] = {
-        "accuracy": accuracy,
-        "byte_norm_accuracy": byte_norm_accuracy,
-    }
-    logger.info(metrics_dict)
-    return metrics_dict, results
+
+async def aevaluate_multiple_choice(
+    language_model: LanguageModel,
+    eval_dataset: MultipleChoiceDataset,
+    prompt_template: PromptTemplate,
+    batch_size: int,
+    few_shot_generator: FewShotGenerator | None = None,
+    max_tokens_per_batch: int | None = None,
+    max_batches_in_flight: int = 2,
+) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    """
+    Asynchronous version of `evaluate_multiple_choice`.
+
+    Up to `max_batches_in_flight` batches are passed to `abatch_compute_log_probs` of the model at the same time.
+    """
+    if max_batches_in_flight < 1:
+        msg = f"max_batches_in_flight must be a positive integer, but got {max_batches_in_flight}."
+        raise ValueError(msg)
+    eval_instance_list: list[MultipleChoiceInstance] = list(eval_dataset)
+    prefix_list = [_build_prefix(i, prompt_template, few_shot_generator) for i in eval_instance_list]
+    batch_indices_list = _build_batch_indices_list(
+        language_model,
+        eval_instance_list,
+        prefix_list,
+        batch_size,
+        max_tokens_per_batch,
+    )
+    semaphore = asyncio.Semaphore(max_batches_in_flight)
+    results: list[dict[str, Any]] = [{} for _ in eval_instance_list]
+
+    async def _score(batch_indices: list[int], pbar: tqdm) -> None:
+        async with semaphore:
+            batch_prefixes, batch_choices = _build_batch_inputs(batch_indices, eval_instance_list, prefix_list)
+            batch_log_probs = await language_model.abatch_compute_log_probs(
+                text_list=batch_choices,
+                prefix_list=batch_prefixes,
+            )
+            _score_batch(batch_indices, batch_log_probs, eval_instance_list, prefix_list, results)
+            pbar.update(len(batch_indices))
+
+    with tqdm(total=len(eval_instance_list)) as pbar:
+        await asyncio.gather(*[_score(batch_indices, pbar) for batch_indices in batch_indices_list])
+
+    return _compute_accuracy(results), results
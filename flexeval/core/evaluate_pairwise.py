@@ -46,6 +46,9 @@ def evaluate_pairwise(
             unjudged_matches.append((index, match))
     cache_count: int = len(judged_matches)
 
+    # Judges that schedule the requests by themselves (e.g., with the Batch API) receive all the matches at once.
+    if judge.prefers_whole_dataset():
+        batch_size = max(len(unjudged_matches), 1)
     newly_judged_results: list[tuple[Winner, str]] = []
     for batch_matches in batch_iter(unjudged_matches, batch_size):
         batch_inputs = [(match.model1_item, match.model2_item) for (_, match) in batch_matches]
@@ -3,13 +3,14 @@ from __future__ import annotations
 import logging
 import math
 from collections import defaultdict
+from typing import Iterable
 
 from tqdm import tqdm
 
 from .language_model import LanguageModel
 from .metric.tokenizer import Tokenizer
 from .text_dataset import TextDataset
-from .utils.data_util import batch_iter
+from .utils.data_util import batch_iter, token_budget_batch_indices
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +20,36 @@ def evaluate_perplexity(
     eval_dataset: TextDataset,
     batch_size: int,
     tokenizer: Tokenizer | None = None,
+    max_tokens_per_batch: int | None = None,
 ) -> dict[str, float]:
     total_log_prob = 0.0
 
+    if language_model.prefers_whole_dataset():
+        if max_tokens_per_batch is not None:
+            logger.warning(
+                "`max_tokens_per_batch` is ignored because the model receives the whole dataset "
+                "and schedules the inputs by itself.",
+            )
+        text_list = list(eval_dataset)
+        batches: Iterable[list[str]] = [text_list] if text_list else []
+    # When `max_tokens_per_batch` is specified, texts of similar length are grouped together
+    # to reduce the padding. The order does not matter because the log probabilities are summed up.
+    elif max_tokens_per_batch is None:
+        batches = batch_iter(eval_dataset, batch_size)
+    else:
+        text_list = list(eval_dataset)
+        batches = [
+            [text_list[idx] for idx in batch_indices]
+            for batch_indices in token_budget_batch_indices(
+                language_model.count_tokens(text_list),
+                max_tokens=max_tokens_per_batch,
+                max_batch_size=batch_size,
+            )
+        ]
+
     token_counts: dict[str, int] = defaultdict(int)
     with tqdm() as pbar:
-        for batch in batch_iter(eval_dataset, batch_size):
+        for batch in batches:
             log_probs = language_model.batch_compute_log_probs(batch)
             total_log_prob += sum(log_probs)
 
@@ -1,4 +1,9 @@
 from .base import LanguageModel
+from .cached_lm import CachedLanguageModel
+from .coalescing_lm import CoalescingLanguageModel
+from .data_parallel_lm import DataParallelLM
 from .hf_lm import HuggingFaceLM
+from .llama_cpp_lm import LlamaCppLM
 from .openai_chatgpt import OpenAIChatGPT
+from .openai_completion_lm import OpenAICompletionLM
 from .vllm_model import VllmModel
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Coroutine, Iterator, TypeVar
+
+from openai import AsyncOpenAI
+
+T = TypeVar("T")
+
+
+class AsyncOpenAIRunner:
+    """
+    Runs the requests of an `AsyncOpenAI` client in an event loop running in a background thread,
+    so that the connection pool of the client is reused throughout the lifetime of the language model.
+
+    The requests can be sent from synchronous methods, and from the event loop of the caller in async methods.
+
+    Args:
+        api_headers: The keyword arguments of `AsyncOpenAI`, e.g., `base_url` and `api_key`.
+        max_concurrency: The maximum number of requests sent at the same time.
+            The requests have to be sent within `async with runner.semaphore`.
+    """
+
+    def __init__(self, api_headers: dict[str, Any] | None = None, max_concurrency: int = 16) -> None:
+        if max_concurrency < 1:
+            msg = f"max_concurrency must be a positive integer, but got {max_concurrency}."
+            raise ValueError(msg)
+        self._max_concurrency = max_concurrency
+        # the semaphore is created in the event loop because it is bound to the loop in Python < 3.10
+        self._semaphore: asyncio.Semaphore | None = None
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        # the errors are retried in `_retry_on_error` instead of the client
+        self.client = AsyncOpenAI(**{"max_retries": 0, **(api_headers or {})})
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """The semaphore bounding the concurrent requests. This must be accessed in the background event loop."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        """Run the coroutine in the background event loop and wait for the result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def arun(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        """Run the coroutine in the background event loop and wait for the result in the caller's event loop."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self._loop))
+
+    def iter_as_completed(self, coroutines: list[Coroutine[Any, Any, T]]) -> Iterator[tuple[int, T]]:
+        """Run the coroutines concurrently and yield `(index, result)` as each coroutine finishes."""
+        futures = [asyncio.run_coroutine_threadsafe(coroutine, self._loop) for coroutine in coroutines]
+        future_to_index = {future: index for index, future in enumerate(futures)}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future_to_index[future], future.result()
+        finally:
+            # cancel the remaining requests when the caller stops consuming the results
+            for future in futures:
+                future.cancel()
+
+    def run_all(self, coroutines: list[Coroutine[Any, Any, T]]) -> list[T]:
+        """Run the coroutines concurrently and return the results in the order of the coroutines."""
+        results: list[T | None] = [None] * len(coroutines)
+        for index, result in self.iter_as_completed(coroutines):
+            results[index] = result
+        return results
+
+    def close(self) -> None:
+        """Close the client and stop the background event loop."""
+        if not self._loop.is_running():
+            return
+        self.run(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+
+    def __del__(self) -> None:
+        # the loop thread is daemonic, so it is terminated at exit even if this is not called
+        if getattr(self, "_loop", None) is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
@@ -1,5 +1,11 @@
 from __future__ import annotations
 
+import asyncio
+import threading
+from typing import Any, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
 
 class LanguageModel:
     """LanguageModel is what you want to evaluate with this library.
@@ -25,6 +31,35 @@ class LanguageModel:
         msg = f"{self.__class__.__name__} cannot generate text."
         raise NotImplementedError(msg)
 
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        """
+        Generate `num_samples` continuations for each input text.
+        Used for metrics that consume multiple samples, such as pass@k or majority voting.
+
+        The default implementation calls `batch_complete_text()` `num_samples` times.
+        Subclasses should override this to process the prompt only once for all the samples.
+        Note that the samples are identical unless sampling is enabled in `kwargs`.
+
+        Args:
+            text_list: A list of input texts.
+            num_samples: The number of continuations to generate for each text.
+            stop_sequences: A string or a list of strings that will stop the generation when they are generated.
+            max_new_tokens: The maximum number of tokens to generate for each text.
+        """
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        outputs_per_sample = [self.batch_complete_text(text_list, **kwargs) for _ in range(num_samples)]
+        return [list(samples) for samples in zip(*outputs_per_sample)]
+
     def batch_generate_chat_response(
         self,
         chat_messages_list: list[list[dict[str, str]]],
@@ -56,3 +91,168 @@ class LanguageModel:
         """
         msg = f"{self.__class__.__name__} cannot compute perplexity."
         raise NotImplementedError(msg)
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Generate text based on the input text list, yielding `(index, text)` as each generation finishes.
+        The results may be yielded in any order.
+
+        Models that prefer the whole dataset (see `prefers_whole_dataset()`) can override this
+        so that the evaluation reports the progress while the model processes all the inputs.
+        The default implementation calls `batch_complete_text()` and yields the results in order.
+
+        Args:
+            text_list: A list of input texts.
+            stop_sequences: A string or a list of strings that will stop the generation when they are generated.
+            max_new_tokens: The maximum number of tokens to generate for each text.
+        """
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        yield from enumerate(self.batch_complete_text(text_list, **kwargs))
+
+    def iter_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Generate chat responses, yielding `(index, response)` as each generation finishes.
+        The results may be yielded in any order.
+
+        The default implementation calls `batch_generate_chat_response()` and yields the results in order.
+
+        Args:
+            chat_messages_list: A list of chat messages.
+        """
+        yield from enumerate(self.batch_generate_chat_response(chat_messages_list, **kwargs))
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        """
+        Count the number of tokens in each text.
+        Used to estimate the cost of a batch when grouping inputs by length.
+
+        The default implementation approximates the number of tokens by the number of characters.
+        Subclasses with access to the tokenizer should override this method.
+
+        Args:
+            text_list: A list of texts to count tokens.
+        """
+        return [len(text) for text in text_list]
+
+    def prefers_whole_dataset(self) -> bool:
+        """
+        Whether the model schedules the inputs by itself and should be given the whole dataset at once.
+
+        Evaluation functions pass all the inputs in a single call instead of splitting them into batches
+        when this returns True, e.g., for models with continuous batching.
+        The generation results are then collected with `iter_complete_text()` or `iter_generate_chat_response()`,
+        so the model can stream the results back as they finish.
+        """
+        return False
+
+    def get_stats(self) -> dict[str, Any]:
+        """
+        Return the statistics collected since the last call of `reset_stats()`, such as timing information.
+        The statistics are saved together with the evaluation metrics.
+        """
+        return {}
+
+    def reset_stats(self) -> None:
+        """Reset the statistics returned by `get_stats()`."""
+
+    def pop_instance_stats(self) -> dict[int, dict[str, Any]]:
+        """
+        Return the statistics of each input collected so far in the current call, and clear them.
+        The keys are the indices of the inputs in the call, and the statistics are saved with the outputs,
+        e.g., the latency of each request.
+        Inputs without statistics are omitted.
+        """
+        return {}
+
+    async def _run_in_thread(self, method: Callable[..., T], *args: Any, **kwargs: Any) -> T:  # noqa: ANN401
+        """Run a synchronous method in a thread of the default executor, one call at a time,
+        so that the model does not have to be thread-safe.
+        """
+        # the lock is created lazily because subclasses do not call `__init__` of this class
+        lock = self.__dict__.setdefault("_sync_call_lock", threading.Lock())
+
+        def _locked_call() -> T:
+            with lock:
+                return method(*args, **kwargs)
+
+        # `asyncio.to_thread` is not available in Python 3.8
+        return await asyncio.get_running_loop().run_in_executor(None, _locked_call)
+
+    async def abatch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        """
+        Asynchronous version of `batch_complete_text()`.
+
+        The default implementation runs `batch_complete_text()` in a thread,
+        so the event loop can prepare the next inputs in the meantime.
+        Models backed by asynchronous clients can override this to process multiple calls concurrently.
+        """
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return await self._run_in_thread(self.batch_complete_text, text_list, **kwargs)
+
+    async def abatch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        """
+        Asynchronous version of `batch_complete_text_samples()`.
+        The default implementation runs `batch_complete_text_samples()` in a thread.
+        """
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return await self._run_in_thread(self.batch_complete_text_samples, text_list, num_samples, **kwargs)
+
+    async def abatch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        """
+        Asynchronous version of `batch_generate_chat_response()`.
+        The default implementation runs `batch_generate_chat_response()` in a thread.
+        """
+        return await self._run_in_thread(self.batch_generate_chat_response, chat_messages_list, **kwargs)
+
+    async def abatch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        """
+        Asynchronous version of `batch_compute_log_probs()`.
+        The default implementation runs `batch_compute_log_probs()` in a thread.
+        """
+        return await self._run_in_thread(
+            self.batch_compute_log_probs,
+            text_list,
+            prefix_list=prefix_list,
+            stride=stride,
+        )
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from .base import LanguageModel
+
+logger = logging.getLogger(__name__)
+
+
+class _ResponseStore:
+    """A key-value store of the responses in SQLite, which evicts the least recently used entries
+    when the total size exceeds `max_size_bytes`.
+    """
+
+    def __init__(self, path: str | os.PathLike[str], max_size_bytes: int | None = None) -> None:
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)",
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._max_size_bytes = max_size_bytes
+
+    def get_many(self, keys: list[str]) -> dict[str, Any]:
+        values: dict[str, Any] = {}
+        unique_keys = list(set(keys))
+        # SQLite limits the number of parameters in a query
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._connection.execute(
+                f"SELECT key, value FROM responses WHERE key IN ({placeholders})",  # noqa: S608
+                chunk,
+            ).fetchall()
+            values.update({key: json.loads(value) for key, value in rows})
+            self._connection.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(time.time(), key) for key, _ in rows],
+            )
+        self._connection.commit()
+        return values
+
+    def put(self, key: str, value: Any) -> None:  # noqa: ANN401
+        serialized_value = json.dumps(value, ensure_ascii=False)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, serialized_value, len(key) + len(serialized_value.encode("utf-8")), time.time()),
+        )
+
+    def commit(self) -> None:
+        """Commit the new entries and evict the least recently used ones if the store is too large."""
+        if self._max_size_bytes is not None:
+            (total_size,) = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if total_size > self._max_size_bytes:
+                rows = self._connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+                evicted_keys: list[str] = []
+                for key, size in rows:
+                    if total_size <= self._max_size_bytes:
+                        break
+                    evicted_keys.append(key)
+                    total_size -= size
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in evicted_keys])
+                logger.info(f"Evicted {len(evicted_keys)} entries from the response cache.")
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class CachedLanguageModel(LanguageModel):
+    """
+    A wrapper that caches the outputs of a language model in a local SQLite database.
+
+    Each input is keyed by `model_id`, the method, the input itself, and the generation arguments,
+    so re-running an evaluation after changing only the metrics or other settings does not regenerate the outputs.
+    Only the inputs missing in the cache are sent to the wrapped model, in a single call for each call of this model.
+    Note that the outputs of sampling are cached as well; change `model_id` or delete the cache to sample again.
+
+    Args:
+        language_model: The language model to wrap.
+        model_id: The identifier of the wrapped model in the cache keys, e.g., the name and revision of the model.
+            Use a different id whenever the model or its settings that affect the outputs change.
+        cache_path: The path to the SQLite database file.
+        max_size_mb: The maximum size of the cached outputs in megabytes.
+            The least recently used entries are evicted when the size exceeds this. No limit if None.
+
+    Examples:
+        >>> flexeval_lm \\
+        ...   --language_model CachedLanguageModel \\
+        ...   --language_model.language_model HuggingFaceLM \\
+        ...   --language_model.language_model.model_name "sbintuitions/tiny-lm" \\
+        ...   --language_model.model_id "sbintuitions/tiny-lm" \\
+        ...   --language_model.max_size_mb 1024 \\
+        ...   --eval_setup "aio" \\
+        ...   --save_dir "results/aio"
+    """
+
+    def __init__(
+        self,
+        language_model: LanguageModel,
+        model_id: str,
+        cache_path: str = "~/.cache/flexeval/responses.sqlite",
+        max_size_mb: float | None = None,
+    ) -> None:
+        self._language_model = language_model
+        self._model_id = model_id
+        self._store = _ResponseStore(
+            cache_path,
+            max_size_bytes=int(max_size_mb * 1024 * 1024) if max_size_mb is not None else None,
+        )
+        # the indices of the inputs sent to the wrapped model in the current call
+        self._miss_indices: list[int] = []
+        self._instance_stats: dict[int, dict[str, Any]] = {}
+        self.reset_stats()
+
+    def _make_key(self, method_name: str, model_input: Any, kwargs: dict[str, Any]) -> str:  # noqa: ANN401
+        key_source = json.dumps(
+            {"model_id": self._model_id, "method": method_name, "input": model_input, "kwargs": kwargs},
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def _iter_cached(
+        self,
+        method_name: str,
+        model_inputs: list[Any],
+        kwargs: dict[str, Any],
+        iter_misses: Callable[[list[int]], Iterator[tuple[int, Any]]],
+    ) -> Iterator[tuple[int, Any]]:
+        """Yield `(index, output)` of the cached inputs first, and then of the inputs computed by `iter_misses`.
+
+        `iter_misses` receives the indices of the missing inputs and yields the outputs with the positions
+        in the indices.
+        """
+        keys = [self._make_key(method_name, model_input, kwargs) for model_input in model_inputs]
+        cached_outputs = self._store.get_many(keys)
+        self._miss_indices = [i for i, key in enumerate(keys) if key not in cached_outputs]
+        self._instance_stats.clear()
+        self._num_hits += len(keys) - len(self._miss_indices)
+        self._num_misses += len(self._miss_indices)
+
+        for i, key in enumerate(keys):
+            if key in cached_outputs:
+                yield i, cached_outputs[key]
+        if not self._miss_indices:
+            return
+        try:
+            for position, output in iter_misses(self._miss_indices):
+                index = self._miss_indices[position]
+                self._store.put(keys[index], output)
+                yield index, output
+        finally:
+            # the outputs computed so far are kept even if the evaluation is interrupted
+            self._store.commit()
+
+    def _run_cached(
+        self,
+        method_name: str,
+        model_inputs: list[Any],
+        kwargs: dict[str, Any],
+        run_misses: Callable[[list[int]], list[Any]],
+    ) -> list[Any]:
+        outputs: list[Any] = [None] * len(model_inputs)
+        for index, output in self._iter_cached(
+            method_name,
+            model_inputs,
+            kwargs,
+            lambda miss_indices: enumerate(run_misses(miss_indices)),
+        ):
+            outputs[index] = output
+        return outputs
+
+    def batch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._run_cached(
+            "complete_text",
+            text_list,
+            kwargs,
+            lambda miss_indices: self._language_model.batch_complete_text(
+                [text_list[i] for i in miss_indices],
+                **kwargs,
+            ),
+        )
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        yield from self._iter_cached(
+            "complete_text",
+            text_list,
+            kwargs,
+            lambda miss_indices: self._language_model.iter_complete_text(
+                [text_list[i] for i in miss_indices],
+                **kwargs,
+            ),
+        )
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._run_cached(
+            "complete_text_samples",
+            text_list,
+            {"num_samples": num_samples, **kwargs},
+            lambda miss_indices: self._language_model.batch_complete_text_samples(
+                [text_list[i] for i in miss_indices],
+                num_samples=num_samples,
+                **kwargs,
+            ),
+        )
+
+    def batch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        return self._run_cached(
+            "generate_chat_response",
+            chat_messages_list,
+            kwargs,
+            lambda miss_indices: self._language_model.batch_generate_chat_response(
+                [chat_messages_list[i] for i in miss_indices],
+                **kwargs,
+            ),
+        )
+
+    def iter_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        yield from self._iter_cached(
+            "generate_chat_response",
+            chat_messages_list,
+            kwargs,
+            lambda miss_indices: self._language_model.iter_generate_chat_response(
+                [chat_messages_list[i] for i in miss_indices],
+                **kwargs,
+            ),
+        )
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        return self._run_cached(
+            "compute_log_probs",
+            list(zip(prefix_list or [None] * len(text_list), text_list)),
+            {"stride": stride},
+            lambda miss_indices: self._language_model.batch_compute_log_probs(
+                [text_list[i] for i in miss_indices],
+                prefix_list=[prefix_list[i] for i in miss_indices] if prefix_list is not None else None,
+                stride=stride,
+            ),
+        )
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        return self._language_model.count_tokens(text_list)
+
+    def prefers_whole_dataset(self) -> bool:
+        return self._language_model.prefers_whole_dataset()
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            **self._language_model.get_stats(),
+            "cache_num_hits": self._num_hits,
+            "cache_num_misses": self._num_misses,
+        }
+
+    def reset_stats(self) -> None:
+        self._language_model.reset_stats()
+        self._num_hits = 0
+        self._num_misses = 0
+
+    def pop_instance_stats(self) -> dict[int, dict[str, Any]]:
+        # the wrapped model reports the stats with the positions in the inputs sent to it
+        for position, stats in self._language_model.pop_instance_stats().items():
+            self._instance_stats[self._miss_indices[position]] = stats
+        instance_stats = self._instance_stats
+        self._instance_stats = {}
+        return instance_stats
+
+    def close(self) -> None:
+        """Close the cache database."""
+        self._store.close()
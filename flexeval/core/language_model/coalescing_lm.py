@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import json
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from .base import LanguageModel
+
+
+@dataclass(eq=False)
+class _Request:
+    method_name: str
+    inputs: list[Any]
+    kwargs: dict[str, Any]
+    group_key: str
+    deadline: float
+    future: concurrent.futures.Future
+
+
+class CoalescingLanguageModel(LanguageModel):
+    """
+    A wrapper that coalesces the calls from multiple threads or coroutines into larger batches.
+
+    When a language model is shared among several callers, e.g., the evaluation loop and LLM-as-a-judge metrics
+    such as `LLMScore` or `ChatLLMPairwiseJudge`, each caller sends its own small batches.
+    This wrapper puts the calls into a queue, and a worker thread merges the calls of the same method
+    with the same generation arguments into a single call of the wrapped model.
+    A batch is sent when it has `max_batch_size` inputs,
+    or when the oldest call in the queue has waited for `max_wait_time` seconds.
+    A call is never split, so a batch may exceed `max_batch_size` when a single call is larger than the rest.
+
+    The wrapped model is called from the worker thread one batch at a time,
+    so it does not have to be thread-safe.
+    Note that the statistics of each instance (see `pop_instance_stats()`) are not collected through this wrapper
+    because a batch mixes the inputs of different callers.
+
+    Args:
+        language_model: The language model to wrap.
+        max_batch_size: The number of inputs that triggers sending a batch.
+        max_wait_time: The maximum time in seconds that a call waits for other calls to join its batch.
+
+    Examples:
+        >>> from flexeval import ChatLLMScore, CoalescingLanguageModel, HuggingFaceLM
+        >>> language_model = CoalescingLanguageModel(
+        ...     HuggingFaceLM(model_name="sbintuitions/tiny-lm-chat"),
+        ...     max_batch_size=32,
+        ... )
+        >>> # the same instance serves the evaluation and the judge metric
+        >>> judge = ChatLLMScore(language_model, prompt_template=...)
+    """
+
+    def __init__(
+        self,
+        language_model: LanguageModel,
+        max_batch_size: int = 32,
+        max_wait_time: float = 0.05,
+    ) -> None:
+        if max_batch_size < 1:
+            msg = f"max_batch_size must be a positive integer, but got {max_batch_size}."
+            raise ValueError(msg)
+        if max_wait_time < 0:
+            msg = f"max_wait_time must be non-negative, but got {max_wait_time}."
+            raise ValueError(msg)
+        self._language_model = language_model
+        self._max_batch_size = max_batch_size
+        self._max_wait_time = max_wait_time
+        self.reset_stats()
+
+        # `None` in the queue is the signal to stop the worker
+        self._queue: queue.Queue[_Request | None] = queue.Queue()
+        self._worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self._worker.start()
+
+    def _submit(self, method_name: str, inputs: list[Any], kwargs: dict[str, Any]) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if not inputs:
+            future.set_result([])
+            return future
+        group_key = json.dumps({"method": method_name, "kwargs": kwargs}, sort_keys=True, default=str)
+        self._queue.put(
+            _Request(
+                method_name=method_name,
+                inputs=inputs,
+                kwargs=kwargs,
+                group_key=group_key,
+                deadline=time.monotonic() + self._max_wait_time,
+                future=future,
+            ),
+        )
+        return future
+
+    def _worker_loop(self) -> None:
+        pending: list[_Request] = []
+        stopping = False
+        while pending or not stopping:
+            group_key = self._find_ready_group(pending, flush_all=stopping)
+            if group_key is not None:
+                batch = self._pop_batch(pending, group_key)
+                self._run_batch(batch)
+                continue
+            # wait for more calls until the oldest call reaches its deadline
+            timeout = max(pending[0].deadline - time.monotonic(), 0.0) if pending else None
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if request is None:
+                stopping = True
+            else:
+                pending.append(request)
+
+    def _find_ready_group(self, pending: list[_Request], flush_all: bool) -> str | None:
+        """Return the key of a group that should be sent now, preferring full groups to the expired one."""
+        num_inputs_per_group: dict[str, int] = {}
+        for request in pending:
+            num_inputs = num_inputs_per_group.get(request.group_key, 0) + len(request.inputs)
+            num_inputs_per_group[request.group_key] = num_inputs
+            if num_inputs >= self._max_batch_size:
+                return request.group_key
+        if pending and (flush_all or pending[0].deadline <= time.monotonic()):
+            return pending[0].group_key
+        return None
+
+    def _pop_batch(self, pending: list[_Request], group_key: str) -> list[_Request]:
+        batch: list[_Request] = []
+        num_inputs = 0
+        for request in pending:
+            if request.group_key != group_key or num_inputs >= self._max_batch_size:
+                continue
+            batch.append(request)
+            num_inputs += len(request.inputs)
+        pending[:] = [request for request in pending if request not in batch]
+        return batch
+
+    def _run_batch(self, batch: list[_Request]) -> None:
+        inputs = [model_input for request in batch for model_input in request.inputs]
+        try:
+            outputs = self._call_language_model(batch[0].method_name, inputs, batch[0].kwargs)
+        except Exception as e:  # noqa: BLE001
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        self._num_batches += 1
+        self._num_requests += len(batch)
+        self._num_inputs += len(inputs)
+
+        start = 0
+        for request in batch:
+            request.future.set_result(outputs[start : start + len(request.inputs)])
+            start += len(request.inputs)
+
+    def _call_language_model(self, method_name: str, inputs: list[Any], kwargs: dict[str, Any]) -> list[Any]:
+        if method_name == "batch_compute_log_probs":
+            text_list = [text for text, _ in inputs]
+            # the calls with and without prefixes are in different groups
+            prefix_list = [prefix for _, prefix in inputs] if kwargs["has_prefix"] else None
+            return self._language_model.batch_compute_log_probs(
+                text_list,
+                prefix_list=prefix_list,
+                stride=kwargs["stride"],
+            )
+        return getattr(self._language_model, method_name)(inputs, **kwargs)
+
+    def _submit_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None,
+        stride: int | None,
+    ) -> concurrent.futures.Future:
+        return self._submit(
+            "batch_compute_log_probs",
+            list(zip(text_list, prefix_list or [None] * len(text_list))),
+            {"stride": stride, "has_prefix": prefix_list is not None},
+        )
+
+    def batch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._submit("batch_complete_text", text_list, kwargs).result()
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._submit("batch_complete_text_samples", text_list, {"num_samples": num_samples, **kwargs}).result()
+
+    def batch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        return self._submit("batch_generate_chat_response", chat_messages_list, kwargs).result()
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        return self._submit_log_probs(text_list, prefix_list, stride).result()
+
+    async def abatch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return await asyncio.wrap_future(self._submit("batch_complete_text", text_list, kwargs))
+
+    async def abatch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return await asyncio.wrap_future(
+            self._submit("batch_complete_text_samples", text_list, {"num_samples": num_samples, **kwargs}),
+        )
+
+    async def abatch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        return await asyncio.wrap_future(self._submit("batch_generate_chat_response", chat_messages_list, kwargs))
+
+    async def abatch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        return await asyncio.wrap_future(self._submit_log_probs(text_list, prefix_list, stride))
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        return self._language_model.count_tokens(text_list)
+
+    def prefers_whole_dataset(self) -> bool:
+        return self._language_model.prefers_whole_dataset()
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            **self._language_model.get_stats(),
+            "coalescing_num_batches": self._num_batches,
+            "coalescing_num_requests": self._num_requests,
+            "coalescing_mean_batch_size": self._num_inputs / self._num_batches if self._num_batches else None,
+        }
+
+    def reset_stats(self) -> None:
+        self._language_model.reset_stats()
+        self._num_batches = 0
+        self._num_requests = 0
+        self._num_inputs = 0
+
+    def close(self) -> None:
+        """Send the remaining calls and stop the worker thread."""
+        if self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
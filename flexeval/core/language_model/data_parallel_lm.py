@@ -0,0 +1,409 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import time
+import traceback
+from multiprocessing.reduction import ForkingPickler
+from typing import Any, Iterator, Literal
+
+import torch
+
+from .base import LanguageModel
+
+logger = logging.getLogger(__name__)
+
+
+def split_cpu_ids(cpu_ids: list[int], num_workers: int) -> list[list[int]]:
+    """Split the CPU ids into `num_workers` contiguous slices.
+
+    If there are fewer CPUs than workers, the CPUs are shared among the workers in a round-robin manner.
+    """
+    cpu_ids = sorted(cpu_ids)
+    if len(cpu_ids) < num_workers:
+        return [[cpu_ids[i % len(cpu_ids)]] for i in range(num_workers)]
+    return [
+        cpu_ids[i * len(cpu_ids) // num_workers : (i + 1) * len(cpu_ids) // num_workers] for i in range(num_workers)
+    ]
+
+
+def split_into_batches(group_sizes: list[int], batch_size: int) -> list[tuple[int, int]]:
+    """Split consecutive groups of inputs into batches of about `batch_size` inputs,
+    and return the `(start, end)` indices of each batch.
+
+    A group is never split across batches, so a batch may exceed `batch_size` if a group is larger than it.
+    """
+    batches: list[tuple[int, int]] = []
+    batch_start = batch_end = 0
+    for group_size in group_sizes:
+        if batch_end > batch_start and batch_end + group_size - batch_start > batch_size:
+            batches.append((batch_start, batch_end))
+            batch_start = batch_end
+        batch_end += group_size
+    if batch_end > batch_start:
+        batches.append((batch_start, batch_end))
+    return batches
+
+
+def count_native_threads() -> int | None:
+    """Return the number of threads of the current process including the native ones, or None if unknown."""
+    try:
+        return len(os.listdir("/proc/self/task"))
+    except OSError:
+        return None
+
+
+def _worker_loop(
+    worker_id: int,
+    language_model: LanguageModel,
+    task_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+    stats_epoch: multiprocessing.Value,
+    cpu_ids: list[int] | None,
+    num_threads: int | None,
+) -> None:
+    if cpu_ids is not None:
+        os.sched_setaffinity(0, cpu_ids)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    current_stats_epoch = stats_epoch.value
+    while True:
+        task = task_queue.get()
+        # `None` is the signal to stop the worker
+        if task is None:
+            break
+        # the statistics are reset lazily when the parent has called `reset_stats()` since the last task
+        if current_stats_epoch != stats_epoch.value:
+            current_stats_epoch = stats_epoch.value
+            language_model.reset_stats()
+        # the tasks are pickled by the parent so that unpicklable inputs are reported to the caller
+        task_id, method_name, args, kwargs = pickle.loads(task)  # noqa: S301
+        try:
+            result = getattr(language_model, method_name)(*args, **kwargs)
+        except Exception:  # noqa: BLE001
+            # exceptions are sent as strings because they are not always picklable
+            result, error = None, traceback.format_exc()
+        else:
+            error = None
+        stats = (worker_id, current_stats_epoch, language_model.get_stats())
+        result_queue.put((task_id, result, error, stats))
+
+
+class DataParallelLM(LanguageModel):
+    """
+    A wrapper that runs a language model in multiple forked worker processes.
+
+    This is useful to use all the cores of a CPU-only machine,
+    where a single process does not scale well with the number of threads.
+    The workers are forked after the wrapped model is loaded,
+    so the model weights are shared among the workers copy-on-write instead of being loaded in each process.
+    Each worker is pinned to its own slice of the available CPU cores and sets its own number of threads.
+
+    The evaluation passes the whole dataset to this model,
+    which splits the inputs into batches of `batch_size` and puts them into a shared queue.
+    The workers take the batches from the queue, and the results are streamed back to the evaluation
+    as each batch finishes.
+    In `batch_compute_log_probs`, the consecutive texts with the same prefix (e.g., the choices of a
+    multiple-choice question) are kept in the same batch, so that the wrapped model can share the prefix among them.
+
+    The statistics of each worker are reported with the prefix `worker{i}_`.
+
+    Note that the forked workers keep the random state of the parent process at the time of forking.
+    Forking a process in which native threads are running (e.g., the OpenMP threads of PyTorch after a forward pass)
+    may deadlock the workers.
+    In that case, use `start_method="spawn"`, which loads a pickled copy of the model in each worker instead,
+    or set `timeout` to fail instead of waiting forever.
+
+    Args:
+        language_model: The language model to run in the workers.
+        num_workers: The number of worker processes.
+        batch_size: The number of inputs in each batch sent to the workers.
+        num_threads_per_worker: The number of torch threads in each worker.
+            Defaults to the number of CPU cores assigned to the worker.
+        pin_cpu_cores: Whether to pin each worker to its own slice of the available CPU cores.
+            This is only supported on Linux.
+        start_method: The start method of the worker processes.
+            `fork` shares the weights of the loaded model copy-on-write,
+            while `spawn` and `forkserver` send a pickled copy of the model to each worker.
+        timeout: The maximum time in seconds to wait for the next batch to finish. No limit if None.
+
+    Examples:
+        >>> flexeval_lm \\
+        ...   --language_model DataParallelLM \\
+        ...   --language_model.language_model HuggingFaceLM \\
+        ...   --language_model.language_model.model_name "sbintuitions/tiny-lm" \\
+        ...   --language_model.num_workers 4 \\
+        ...   --eval_setup "aio" \\
+        ...   --save_dir "results/aio"
+    """
+
+    def __init__(
+        self,
+        language_model: LanguageModel,
+        num_workers: int,
+        batch_size: int = 1,
+        num_threads_per_worker: int | None = None,
+        pin_cpu_cores: bool = True,
+        start_method: Literal["fork", "spawn", "forkserver"] = "fork",
+        timeout: float | None = None,
+    ) -> None:
+        if num_workers < 1:
+            msg = f"num_workers must be a positive integer, but got {num_workers}."
+            raise ValueError(msg)
+        if batch_size < 1:
+            msg = f"batch_size must be a positive integer, but got {batch_size}."
+            raise ValueError(msg)
+
+        self._language_model = language_model
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._call_counter = itertools.count()
+
+        cpu_ids_list: list[list[int] | None] = [None] * num_workers
+        if pin_cpu_cores and hasattr(os, "sched_getaffinity"):
+            cpu_ids_list = split_cpu_ids(list(os.sched_getaffinity(0)), num_workers)
+        elif pin_cpu_cores:
+            logger.warning("Pinning CPU cores is not supported on this platform.")
+
+        num_threads_in_parent = count_native_threads()
+        if start_method == "fork" and num_threads_in_parent is not None and num_threads_in_parent > 1:
+            logger.warning(
+                f"Forking the workers from a process with {num_threads_in_parent} threads. "
+                "If the workers hang, use `start_method='spawn'`.",
+            )
+
+        context = multiprocessing.get_context(start_method)
+        self._task_queue = context.Queue()
+        self._result_queue = context.Queue()
+        # incremented by `reset_stats()` to let the workers reset their statistics
+        self._stats_epoch = context.Value("i", 0)
+        self._worker_stats: dict[int, dict[str, Any]] = {}
+        self._workers: list[multiprocessing.Process] = []
+        for worker_id, cpu_ids in enumerate(cpu_ids_list):
+            num_threads = num_threads_per_worker
+            if num_threads is None and cpu_ids is not None:
+                num_threads = len(cpu_ids)
+            worker = context.Process(
+                target=_worker_loop,
+                args=(
+                    worker_id,
+                    language_model,
+                    self._task_queue,
+                    self._result_queue,
+                    self._stats_epoch,
+                    cpu_ids,
+                    num_threads,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+            logger.info(f"Started worker {worker.pid} with CPU cores {cpu_ids} and {num_threads} threads.")
+
+    def _send_tasks(
+        self,
+        call_id: int,
+        method_name: str,
+        batches: list[tuple[int, list[Any]]],
+        kwargs: dict[str, Any],
+    ) -> None:
+        """Put a task for each `(start, inputs)` batch into the task queue."""
+        # The tasks are pickled here, because the queue pickles them in a background thread
+        # and the workers would wait forever for the tasks that failed to be sent.
+        tasks: list[bytes] = []
+        for batch_start, batch in batches:
+            args = [list(arg_list) for arg_list in zip(*batch)]
+            try:
+                tasks.append(bytes(ForkingPickler.dumps(((call_id, batch_start), method_name, args, kwargs))))
+            except Exception as e:
+                msg = f"The arguments of {method_name} cannot be sent to the workers of DataParallelLM: {e}"
+                raise ValueError(msg) from e
+        for task in tasks:
+            self._task_queue.put(task)
+
+    def _receive_result(self) -> tuple[tuple[int, int], Any, str | None]:
+        """Wait for the next result from the workers while checking that they are alive."""
+        start_time = time.monotonic()
+        while True:
+            try:
+                task_id, result, error, (worker_id, stats_epoch, worker_stats) = self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    msg = "A worker process of DataParallelLM died unexpectedly."
+                    raise RuntimeError(msg) from None
+                if self._timeout is not None and time.monotonic() - start_time > self._timeout:
+                    msg = f"No batch finished in the workers of DataParallelLM within {self._timeout} seconds."
+                    raise RuntimeError(msg) from None
+                continue
+            # the stats collected before the last `reset_stats()` are ignored
+            if stats_epoch == self._stats_epoch.value:
+                self._worker_stats[worker_id] = worker_stats
+            return task_id, result, error
+
+    def _iter_in_workers(
+        self,
+        method_name: str,
+        inputs: list[Any],
+        kwargs: dict[str, Any],
+        group_sizes: list[int] | None = None,
+    ) -> Iterator[tuple[int, Any]]:
+        """Split the inputs into batches, run the method in the workers,
+        and yield `(index, output)` as each batch finishes.
+
+        Each item of `inputs` is a tuple of the positional arguments for an input.
+        The consecutive inputs in each group of `group_sizes` are sent to the same worker.
+        """
+        # The results of a previous call that was not consumed to the end are identified by the call id and ignored.
+        call_id = next(self._call_counter)
+        batches = split_into_batches(group_sizes or [1] * len(inputs), self._batch_size)
+        self._send_tasks(call_id, method_name, [(start, inputs[start:end]) for start, end in batches], kwargs)
+
+        error: str | None = None
+        num_received = 0
+        while num_received < len(batches):
+            (result_call_id, batch_start), result, task_error = self._receive_result()
+            if result_call_id != call_id:
+                continue
+            num_received += 1
+            error = error or task_error
+            if error is None:
+                yield from enumerate(result, start=batch_start)
+        # raise the error after receiving all the results so that they do not mix with the next call
+        if error is not None:
+            msg = f"An error occurred in a worker process of DataParallelLM:\n{error}"
+            raise RuntimeError(msg)
+
+    def _run_in_workers(
+        self,
+        method_name: str,
+        inputs: list[Any],
+        kwargs: dict[str, Any],
+        group_sizes: list[int] | None = None,
+    ) -> list[Any]:
+        """Run the method in the workers and merge the results in the original order."""
+        outputs: list[Any] = [None] * len(inputs)
+        for index, output in self._iter_in_workers(method_name, inputs, kwargs, group_sizes):
+            outputs[index] = output
+        return outputs
+
+    def batch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._run_in_workers("batch_complete_text", [(text,) for text in text_list], kwargs)
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        yield from self._iter_in_workers("batch_complete_text", [(text,) for text in text_list], kwargs)
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        kwargs["num_samples"] = num_samples
+        if stop_sequences is not None:
+            kwargs["stop_sequences"] = stop_sequences
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        return self._run_in_workers("batch_complete_text_samples", [(text,) for text in text_list], kwargs)
+
+    def batch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        return self._run_in_workers(
+            "batch_generate_chat_response",
+            [(chat_messages,) for chat_messages in chat_messages_list],
+            kwargs,
+        )
+
+    def iter_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        yield from self._iter_in_workers(
+            "batch_generate_chat_response",
+            [(chat_messages,) for chat_messages in chat_messages_list],
+            kwargs,
+        )
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        if prefix_list is None:
+            return self._run_in_workers(
+                "batch_compute_log_probs",
+                [(text,) for text in text_list],
+                {"stride": stride},
+            )
+        # the texts with the same prefix are kept together so that the wrapped model can share the prefix
+        group_sizes = [len(list(group)) for _, group in itertools.groupby(prefix_list)]
+        return self._run_in_workers(
+            "batch_compute_log_probs",
+            list(zip(text_list, prefix_list)),
+            {"stride": stride},
+            group_sizes,
+        )
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        return self._language_model.count_tokens(text_list)
+
+    def prefers_whole_dataset(self) -> bool:
+        return True
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            f"worker{worker_id}_{key}": value
+            for worker_id, worker_stats in sorted(self._worker_stats.items())
+            for key, value in worker_stats.items()
+        }
+
+    def reset_stats(self) -> None:
+        with self._stats_epoch.get_lock():
+            self._stats_epoch.value += 1
+        self._worker_stats = {}
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10.0)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __del__(self) -> None:
+        # the workers are daemonic, so they are terminated at exit even if this is not called
+        if getattr(self, "_workers", None):
+            self.close()
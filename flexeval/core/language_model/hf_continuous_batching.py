@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import collections
+from dataclasses import dataclass
+from typing import Iterator
+
+import torch
+import torch.nn.functional as F  # noqa: N812
+from transformers import (
+    LogitsProcessorList,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .hf_lm import (
+    StopSequenceCriteria,
+    get_position_ids,
+    keep_last_logits,
+    select_past_key_values,
+    to_model_cache_format,
+    trim_past_key_values,
+)
+
+
+def left_pad_past_key_values(past_key_values: tuple, length: int) -> tuple:
+    """Pad the legacy-format `past_key_values` on the left with zeros so that the sequence length becomes `length`."""
+    return tuple(
+        tuple(F.pad(tensor, (0, 0, length - tensor.size(-2), 0)) for tensor in layer) for layer in past_key_values
+    )
+
+
+def concat_past_key_values(past_key_values_list: list[tuple]) -> tuple:
+    """Concatenate the legacy-format `past_key_values` with the same sequence length along the batch dimension."""
+    return tuple(tuple(torch.cat(tensors, dim=0) for tensors in zip(*layers)) for layers in zip(*past_key_values_list))
+
+
+@dataclass
+class _RunningBatch:
+    """The states of the sequences being decoded.
+
+    `next_token_ids` are the tokens selected for each sequence in the last step, which are not fed to the model yet.
+    `attention_mask` and `past_key_values` cover the tokens fed so far, left-padded to the same length.
+    """
+
+    indices: list[int]
+    next_token_ids: torch.Tensor
+    attention_mask: torch.Tensor
+    past_key_values: tuple
+
+    def concat(self, other: _RunningBatch) -> _RunningBatch:
+        sequence_length = max(self.attention_mask.size(1), other.attention_mask.size(1))
+        return _RunningBatch(
+            indices=self.indices + other.indices,
+            next_token_ids=torch.cat([self.next_token_ids, other.next_token_ids]),
+            attention_mask=torch.cat(
+                [
+                    F.pad(self.attention_mask, (sequence_length - self.attention_mask.size(1), 0)),
+                    F.pad(other.attention_mask, (sequence_length - other.attention_mask.size(1), 0)),
+                ],
+            ),
+            past_key_values=concat_past_key_values(
+                [
+                    left_pad_past_key_values(self.past_key_values, sequence_length),
+                    left_pad_past_key_values(other.past_key_values, sequence_length),
+                ],
+            ),
+        )
+
+    def select(self, rows: list[int]) -> _RunningBatch | None:
+        """Keep only the given rows, or return None if no rows are left."""
+        if not rows:
+            return None
+        rows_tensor = torch.tensor(rows, dtype=torch.long, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, rows_tensor)
+        past_key_values = select_past_key_values(self.past_key_values, rows_tensor)
+        # drop the columns that are padding for all the remaining sequences
+        num_padding_columns = int(attention_mask.any(dim=0).long().argmax())
+        if num_padding_columns > 0:
+            attention_mask = attention_mask[:, num_padding_columns:]
+            past_key_values = trim_past_key_values(past_key_values, attention_mask.size(1))
+        return _RunningBatch(
+            indices=[self.indices[row] for row in rows],
+            next_token_ids=self.next_token_ids.index_select(0, rows_tensor),
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+        )
+
+
+class ContinuousBatchingGenerator:
+    """
+    Generate texts with continuous batching.
+
+    `model.generate` keeps every sequence in the batch until the longest one finishes,
+    and the next batch cannot start until then.
+    This generator instead runs its own decoding loop over a running batch of at most `max_batch_size` sequences.
+    Finished sequences are evicted from the running batch after each step,
+    and the waiting prompts are prefilled and merged into the batch to take the freed slots.
+
+    The running batch is left-padded and the key-value cache is kept in the legacy
+    `(batch, heads, seq, dim)` layout, so that rows can be selected, padded, and concatenated.
+
+    Args:
+        model: The causal language model.
+        tokenizer: The tokenizer used to decode the generated tokens for the stop sequences.
+        max_batch_size: The maximum number of sequences decoded at the same time.
+    """
+
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, max_batch_size: int) -> None:
+        if max_batch_size < 1:
+            msg = f"max_batch_size must be a positive integer, but got {max_batch_size}."
+            raise ValueError(msg)
+        self._model = model
+        self._tokenizer = tokenizer
+        self._max_batch_size = max_batch_size
+        self._pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    def _build_logits_warper(
+        self,
+        do_sample: bool | None,
+        temperature: float | None,
+        top_k: int | None,
+        top_p: float | None,
+    ) -> LogitsProcessorList | None:
+        """Build the logits warpers for sampling, or return None for greedy decoding.
+
+        The unspecified parameters are taken from the generation config of the model as in `model.generate`.
+        """
+        generation_config = self._model.generation_config
+        if not (do_sample if do_sample is not None else generation_config.do_sample):
+            return None
+        temperature = temperature if temperature is not None else generation_config.temperature
+        top_k = top_k if top_k is not None else generation_config.top_k
+        top_p = top_p if top_p is not None else generation_config.top_p
+
+        logits_warper = LogitsProcessorList()
+        if temperature is not None and temperature != 1.0:
+            logits_warper.append(TemperatureLogitsWarper(temperature))
+        if top_k is not None and top_k != 0:
+            logits_warper.append(TopKLogitsWarper(top_k=top_k))
+        if top_p is not None and top_p < 1.0:
+            logits_warper.append(TopPLogitsWarper(top_p=top_p))
+        return logits_warper
+
+    def _get_max_new_tokens(self, prompt_length: int, max_new_tokens: int | None, max_length: int | None) -> int:
+        if max_new_tokens is not None:
+            return max_new_tokens
+        if max_length is None:
+            if self._model.generation_config.max_new_tokens is not None:
+                return self._model.generation_config.max_new_tokens
+            max_length = self._model.generation_config.max_length
+        # as in `model.generate`, `max_length` includes the prompt
+        return max(max_length - prompt_length, 1)
+
+    def _forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        past_key_values: tuple | None,
+    ) -> tuple[torch.Tensor, tuple]:
+        """Run the model and return the logits of the last position and the cache in the legacy format."""
+        with keep_last_logits(self._model, 1):
+            lm_outputs = self._model.forward(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=to_model_cache_format(self._model, past_key_values),
+                use_cache=True,
+            )
+        past_key_values = lm_outputs.past_key_values
+        if not isinstance(past_key_values, tuple):
+            past_key_values = past_key_values.to_legacy_cache()
+        return lm_outputs.logits[:, -1].float(), past_key_values
+
+    def _prefill(
+        self,
+        indices: list[int],
+        input_ids_list: list[list[int]],
+        logits_warper: LogitsProcessorList | None,
+    ) -> _RunningBatch:
+        """Encode the prompts and select their first tokens."""
+        max_length = max(len(input_ids) for input_ids in input_ids_list)
+        input_ids = torch.tensor(
+            [[self._pad_token_id] * (max_length - len(ids)) + ids for ids in input_ids_list],
+            dtype=torch.long,
+            device=self._model.device,
+        )
+        attention_mask = torch.tensor(
+            [[0] * (max_length - len(ids)) + [1] * len(ids) for ids in input_ids_list],
+            dtype=torch.long,
+            device=self._model.device,
+        )
+        next_token_logits, past_key_values = self._forward(
+            input_ids,
+            attention_mask,
+            get_position_ids(attention_mask),
+            past_key_values=None,
+        )
+        return _RunningBatch(
+            indices=indices,
+            next_token_ids=self._select_next_tokens(next_token_logits, logits_warper),
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+        )
+
+    def _decode(self, running_batch: _RunningBatch, logits_warper: LogitsProcessorList | None) -> _RunningBatch:
+        """Feed the last selected tokens of the running sequences and select their next tokens."""
+        position_ids = running_batch.attention_mask.sum(dim=1, keepdim=True)
+        attention_mask = F.pad(running_batch.attention_mask, (0, 1), value=1)
+        next_token_logits, past_key_values = self._forward(
+            running_batch.next_token_ids.unsqueeze(1),
+            attention_mask,
+            position_ids,
+            running_batch.past_key_values,
+        )
+        return _RunningBatch(
+            indices=running_batch.indices,
+            next_token_ids=self._select_next_tokens(next_token_logits, logits_warper),
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+        )
+
+    @staticmethod
+    def _select_next_tokens(next_token_logits: torch.Tensor, logits_warper: LogitsProcessorList | None) -> torch.Tensor:
+        if logits_warper is None:
+            return next_token_logits.argmax(dim=-1)
+        # the warpers used here do not look at the input ids
+        next_token_scores = logits_warper(None, next_token_logits)
+        return torch.multinomial(F.softmax(next_token_scores, dim=-1), num_samples=1).squeeze(1)
+
+    def generate(self, input_ids_list: list[list[int]], stop_token_ids: list[int], **kwargs) -> list[list[int]]:
+        """Generate the continuation of each prompt and return the generated token ids.
+
+        See `iter_generate` for the arguments.
+        """
+        output_token_ids_list: list[list[int]] = [[] for _ in input_ids_list]
+        for index, output_token_ids in self.iter_generate(input_ids_list, stop_token_ids, **kwargs):
+            output_token_ids_list[index] = output_token_ids
+        return output_token_ids_list
+
+    @torch.inference_mode()
+    def iter_generate(
+        self,
+        input_ids_list: list[list[int]],
+        stop_token_ids: list[int],
+        stop_sequences: list[str] | None = None,
+        max_new_tokens: int | None = None,
+        max_length: int | None = None,
+        do_sample: bool | None = None,
+        temperature: float | None = None,
+        top_k: int | None = None,
+        top_p: float | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, list[int]]]:
+        """
+        Generate the continuation of each prompt,
+        yielding `(index, generated_token_ids)` as each sequence finishes and is evicted from the running batch.
+
+        Args:
+            input_ids_list: The token ids of the prompts.
+            stop_token_ids: The token ids that end the generation. The stop token is included in the output.
+            stop_sequences: The stop sequences detected from the decoded text.
+            max_new_tokens: The maximum number of tokens to generate for each prompt.
+            max_length: The maximum length of each prompt and its generated tokens,
+                used only when `max_new_tokens` is not specified.
+            do_sample: Whether to sample the next tokens instead of greedy decoding.
+            temperature: The temperature for sampling.
+            top_k: The number of the highest probability tokens to keep for sampling.
+            top_p: The cumulative probability of the tokens to keep for sampling.
+        """
+        if kwargs:
+            msg = f"Continuous batching does not support the generation kwargs: {sorted(kwargs)}"
+            raise ValueError(msg)
+
+        logits_warper = self._build_logits_warper(do_sample, temperature, top_k, top_p)
+        stop_token_id_set = set(stop_token_ids)
+        stop_criteria = (
+            StopSequenceCriteria(self._tokenizer, stop_sequences, prompt_length=0) if stop_sequences else None
+        )
+        max_new_tokens_list = [
+            self._get_max_new_tokens(len(input_ids), max_new_tokens, max_length) for input_ids in input_ids_list
+        ]
+
+        output_token_ids_list: list[list[int]] = [[] for _ in input_ids_list]
+        waiting_indices = collections.deque(range(len(input_ids_list)))
+        running_batch: _RunningBatch | None = None
+        while waiting_indices or running_batch is not None:
+            num_free_slots = self._max_batch_size - (len(running_batch.indices) if running_batch else 0)
+            if waiting_indices and num_free_slots > 0:
+                # prefill the waiting prompts and merge them into the running batch
+                # the running sequences do not advance in this step
+                new_indices = [waiting_indices.popleft() for _ in range(min(num_free_slots, len(waiting_indices)))]
+                new_batch = self._prefill(new_indices, [input_ids_list[i] for i in new_indices], logits_warper)
+                running_batch = new_batch if running_batch is None else running_batch.concat(new_batch)
+                updated_batch = new_batch
+            else:
+                running_batch = self._decode(running_batch, logits_warper)
+                updated_batch = running_batch
+
+            # record the new tokens and evict the finished sequences from the running batch
+            finished_indices: set[int] = set()
+            for index, token_id in zip(updated_batch.indices, updated_batch.next_token_ids.tolist()):
+                output_token_ids_list[index].append(token_id)
+                if token_id in stop_token_id_set or len(output_token_ids_list[index]) >= max_new_tokens_list[index]:
+                    finished_indices.add(index)
+            if stop_criteria is not None:
+                contains_stop_sequence = stop_criteria.contains_stop_sequence(
+                    [output_token_ids_list[index] for index in updated_batch.indices],
+                )
+                finished_indices.update(
+                    index for index, contains in zip(updated_batch.indices, contains_stop_sequence) if contains
+                )
+            if finished_indices:
+                running_batch = running_batch.select(
+                    [row for row, index in enumerate(running_batch.indices) if index not in finished_indices],
+                )
+                for index in updated_batch.indices:
+                    if index in finished_indices:
+                        yield index, output_token_ids_list[index]
@@ -2,12 +2,22 @@ from __future__ import annotations
 
 import contextlib
 import logging
-from typing import Any, Literal, TypeVar
+import time
+import weakref
+from typing import Any, Iterator, Literal, TypeVar
 
 import torch
 import torch.nn.functional as F  # noqa: N812
 import transformers
-from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, PreTrainedModel, PreTrainedTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BatchEncoding,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
 
 from .base import LanguageModel
 
@@ -53,6 +63,30 @@ def tokenize_text_for_lm_prefix(
     return model_inputs
 
 
+def get_bucketed_length(length: int, min_length: int = 16) -> int:
+    """Round up the length to a power of two (at least `min_length`) to limit the number of distinct shapes."""
+    return max(min_length, 1 << (length - 1).bit_length())
+
+
+def pad_batch_encoding(
+    batch_encoding: BatchEncoding,
+    length: int,
+    pad_token_id: int,
+    padding_side: Literal["left", "right"],
+) -> BatchEncoding:
+    """Pad `input_ids` and `attention_mask` of the batch encoding to `length`."""
+    num_pads = length - batch_encoding.input_ids.size(1)
+    if num_pads <= 0:
+        return batch_encoding
+    pad = (num_pads, 0) if padding_side == "left" else (0, num_pads)
+    return BatchEncoding(
+        {
+            "input_ids": F.pad(batch_encoding.input_ids, pad, value=pad_token_id),
+            "attention_mask": F.pad(batch_encoding.attention_mask, pad, value=0),
+        },
+    )
+
+
 def tokenize_text_for_lm_continuation(
     text_list: list[str],
     tokenizer: PreTrainedTokenizer,
@@ -75,6 +109,40 @@ def tokenize_text_for_lm_continuation(
     If `as_continuation` is a boolean, it determines whether all texts should be treated as continuations.
     If `as_continuation` is a list of booleans, it specifies whether each text should be treated as a continuation.
     """
+    input_ids_list = tokenize_text_for_lm_continuation_ids(
+        text_list,
+        tokenizer,
+        oov_character=oov_character,
+        as_continuation=as_continuation,
+    )
+
+    # pad to the right with a single tensor construction, which is much faster than `tokenizer.pad`
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        msg = "The tokenizer does not have a padding token."
+        raise ValueError(msg)
+    max_length = max((len(ids) for ids in input_ids_list), default=0)
+    return BatchEncoding(
+        {
+            "input_ids": torch.tensor(
+                [ids + [pad_token_id] * (max_length - len(ids)) for ids in input_ids_list],
+                dtype=torch.long,
+            ),
+            "attention_mask": torch.tensor(
+                [[1] * len(ids) + [0] * (max_length - len(ids)) for ids in input_ids_list],
+                dtype=torch.long,
+            ),
+        },
+    )
+
+
+def tokenize_text_for_lm_continuation_ids(
+    text_list: list[str],
+    tokenizer: PreTrainedTokenizer,
+    oov_character: str = "彁",
+    as_continuation: bool | list[bool] = True,
+) -> list[list[int]]:
+    """The same as `tokenize_text_for_lm_continuation`, but returns the token ids of each text without padding."""
     if isinstance(as_continuation, bool):
         as_continuation = [as_continuation] * len(text_list)
 
@@ -82,30 +150,67 @@ def tokenize_text_for_lm_continuation(
         msg = "The length of as_continuation must be the same as the length of text_list."
         raise ValueError(msg)
 
-    if oov_character in tokenizer.get_vocab():
-        msg = f"oov_character '{oov_character}' is already in the tokenizer's vocab."
-        raise ValueError(msg)
-    oov_char_len = len(tokenizer.tokenize(oov_character))
-
-    encoding_list: list[BatchEncoding] = []
-    for text, as_cont in zip(text_list, as_continuation):
-        input_text = text
-        # tokenize with OOV character
-        if as_cont:
-            input_text = oov_character + text
-        encoding = tokenizer(
-            input_text,
-            add_special_tokens=False,
-            return_token_type_ids=False,
-        )
-        # remove OOV character
-        if as_cont:
-            for k in encoding:
-                encoding[k] = encoding[k][oov_char_len:]
-        encoding_list.append(encoding)
+    oov_char_len = get_oov_character_length(tokenizer, oov_character)
 
-    with set_temporal_padding_side(tokenizer, "right"):
-        return tokenizer.pad(encoding_list, return_tensors="pt")
+    # tokenize all the texts with a single call, which runs in batch for fast tokenizers
+    input_text_list = [oov_character + text if as_cont else text for text, as_cont in zip(text_list, as_continuation)]
+    encoding = tokenizer(
+        input_text_list,
+        add_special_tokens=False,
+        return_token_type_ids=False,
+        return_attention_mask=False,
+    )
+    # remove OOV character
+    return [ids[oov_char_len:] if as_cont else ids for ids, as_cont in zip(encoding.input_ids, as_continuation)]
+
+
+def tokenize_prefix_and_continuation_ids(
+    text_list: list[str],
+    prefix_list: list[str] | None,
+    tokenizer: PreTrainedTokenizer,
+    add_special_tokens: bool = False,
+) -> tuple[list[list[int]], list[list[int]]]:
+    """
+    Tokenize the prefixes and the texts to compute log probabilities in the same way as `HuggingFaceLM`.
+
+    Returns the token ids of the prefixes and those of the texts as continuations of the prefixes.
+    """
+    # If the prefix is an empty string, replace it with the bos token regardless of the model being trained with it.
+    prefix_list = [prefix or tokenizer.bos_token for prefix in (prefix_list or [""] * len(text_list))]
+    prefix_ids_list = tokenizer(
+        prefix_list,
+        add_special_tokens=add_special_tokens,
+        return_token_type_ids=False,
+        return_attention_mask=False,
+    ).input_ids
+    # If the last token is a special token, it is treated as a beginning of a new sentence.
+    continuation_ids_list = tokenize_text_for_lm_continuation_ids(
+        text_list,
+        tokenizer,
+        as_continuation=[prefix_ids[-1] not in tokenizer.all_special_ids for prefix_ids in prefix_ids_list],
+    )
+    return prefix_ids_list, continuation_ids_list
+
+
+_OOV_CHARACTER_LENGTH_CACHE: weakref.WeakKeyDictionary[PreTrainedTokenizer, dict[tuple[int, str], int]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_oov_character_length(tokenizer: PreTrainedTokenizer, oov_character: str) -> int:
+    """Return the number of tokens of `oov_character` after checking that it is not in the vocab.
+
+    The result is cached per tokenizer, as `tokenizer.get_vocab()` builds a new dict on every call.
+    The size of the vocab is part of the key, so that the result is recomputed after tokens are added.
+    """
+    oov_char_len_dict = _OOV_CHARACTER_LENGTH_CACHE.setdefault(tokenizer, {})
+    key = (len(tokenizer), oov_character)
+    if key not in oov_char_len_dict:
+        if oov_character in tokenizer.get_vocab():
+            msg = f"oov_character '{oov_character}' is already in the tokenizer's vocab."
+            raise ValueError(msg)
+        oov_char_len_dict[key] = len(tokenizer.tokenize(oov_character))
+    return oov_char_len_dict[key]
 
 
 def normalize_stop_sequences(
@@ -137,6 +242,193 @@ def normalize_stop_sequences(
     return stop_sequences
 
 
+class StopSequenceCriteria(StoppingCriteria):
+    """Stop the generation of each sequence once its generated text contains one of the stop sequences.
+
+    This handles stop sequences that do not correspond to a single token (e.g., `"\\n\\n"`),
+    which cannot be passed to `generate` as `eos_token_id`.
+    Only the last tokens that can form the longest stop sequence are decoded at each step.
+
+    Args:
+        tokenizer: The tokenizer to decode the generated tokens.
+        stop_sequences: The stop sequences.
+        prompt_length: The length of the input tokens, which are excluded from the search.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, stop_sequences: list[str], prompt_length: int) -> None:
+        self._tokenizer = tokenizer
+        self._stop_sequences = stop_sequences
+        self._prompt_length = prompt_length
+        # a character consists of at most 4 bytes and a token has at least one byte in byte-level tokenizers,
+        # and one more token is needed in case the first token is only partially included in the tail
+        self._num_tail_tokens = 4 * max(len(stop_seq) for stop_seq in stop_sequences) + 1
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated_tail = input_ids[:, self._prompt_length :][:, -self._num_tail_tokens :]
+        is_done = self.contains_stop_sequence(generated_tail.tolist())
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+    def contains_stop_sequence(self, generated_token_ids_list: list[list[int]]) -> list[bool]:
+        """Check if the decoded tail of each list of generated token ids contains one of the stop sequences."""
+        decoded_tails = self._tokenizer.batch_decode(
+            [token_ids[-self._num_tail_tokens :] for token_ids in generated_token_ids_list],
+            skip_special_tokens=False,
+        )
+        return [any(stop_seq in text for stop_seq in self._stop_sequences) for text in decoded_tails]
+
+
+def get_position_ids(attention_mask: torch.Tensor) -> torch.Tensor:
+    """Compute position ids from the attention mask in the same way as `prepare_inputs_for_generation`."""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids
+
+
+def has_absolute_position_embeddings(model: PreTrainedModel) -> bool:
+    """Return whether the model learns an embedding for each absolute position (e.g., GPT-2 and OPT).
+
+    Such models cannot take position ids beyond `max_position_embeddings`.
+    The embeddings are detected as embedding layers other than the input embeddings
+    that have at least `max_position_embeddings` entries.
+    """
+    max_length = model.config.max_position_embeddings
+    input_embeddings = model.get_input_embeddings()
+    return any(
+        isinstance(module, torch.nn.Embedding)
+        and module is not input_embeddings
+        and module.num_embeddings >= max_length
+        for module in model.modules()
+    )
+
+
+def select_past_key_values(past_key_values: Any, indices: torch.Tensor) -> Any:  # noqa: ANN401
+    """Select the batch entries of `past_key_values` by `indices`.
+
+    Both the legacy format (tuple of key/value tensors of shape `(batch, heads, seq, dim)`)
+    and the `DynamicCache` class are supported.
+    """
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(tensor.index_select(0, indices) for tensor in layer) for layer in past_key_values)
+    legacy_cache = select_past_key_values(past_key_values.to_legacy_cache(), indices)
+    return type(past_key_values).from_legacy_cache(legacy_cache)
+
+
+def trim_past_key_values(past_key_values: Any, num_tokens_to_keep: int) -> Any:  # noqa: ANN401
+    """Keep only the last `num_tokens_to_keep` tokens of `past_key_values`.
+
+    Both the legacy format (tuple of key/value tensors of shape `(batch, heads, seq, dim)`)
+    and the `DynamicCache` class are supported.
+    """
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(tensor[..., -num_tokens_to_keep:, :] for tensor in layer) for layer in past_key_values)
+    legacy_cache = trim_past_key_values(past_key_values.to_legacy_cache(), num_tokens_to_keep)
+    return type(past_key_values).from_legacy_cache(legacy_cache)
+
+
+def to_model_cache_format(model: PreTrainedModel, past_key_values: Any) -> Any:  # noqa: ANN401
+    """Convert the legacy cache format into `DynamicCache` if the model supports cache classes."""
+    if isinstance(past_key_values, tuple) and getattr(model, "_supports_cache_class", False):
+        from transformers import DynamicCache
+
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return past_key_values
+
+
+@contextlib.contextmanager
+def keep_last_logits(model: PreTrainedModel, num_logits_to_keep: int) -> Iterator[None]:
+    """Temporarily let the LM head compute logits only for the last `num_logits_to_keep` positions.
+
+    This avoids materializing a `(batch_size, sequence_length, vocab_size)` tensor when only the logits
+    at the end of the sequence are needed.
+    Note that the logits may still cover all positions if the model does not expose its LM head,
+    so the caller should slice the last positions of the output.
+    """
+    output_embeddings = model.get_output_embeddings()
+    if output_embeddings is None:
+        yield
+        return
+
+    def _slice_hidden_states(_module: torch.nn.Module, args: tuple[torch.Tensor, ...]) -> tuple[torch.Tensor, ...]:
+        return (args[0][:, -num_logits_to_keep:], *args[1:])
+
+    handle = output_embeddings.register_forward_pre_hook(_slice_hidden_states)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
+def gather_log_probs(
+    logits: torch.Tensor,
+    target_ids: torch.Tensor,
+    max_num_elements: int = 2**24,
+) -> torch.Tensor:
+    """Compute `log_softmax(logits).gather(target_ids)` without materializing the log-softmax of all positions.
+
+    The positions are processed in chunks so that each chunk has at most `max_num_elements` elements.
+
+    Args:
+        logits: A tensor of shape `(batch_size, sequence_length, vocab_size)`.
+        target_ids: A tensor of shape `(batch_size, sequence_length)`.
+        max_num_elements: The maximum number of elements of the float32 log-softmax computed at once.
+    """
+    batch_size, sequence_length, vocab_size = logits.shape
+    chunk_size = max(1, max_num_elements // max(1, batch_size * vocab_size))
+    log_probs_list: list[torch.Tensor] = []
+    for chunk_start in range(0, sequence_length, chunk_size):
+        chunk_log_probs = F.log_softmax(logits[:, chunk_start : chunk_start + chunk_size].float(), dim=-1)
+        log_probs_list.append(
+            chunk_log_probs.gather(
+                dim=-1,
+                index=target_ids[:, chunk_start : chunk_start + chunk_size].unsqueeze(-1),
+            ).squeeze(-1),
+        )
+    if not log_probs_list:
+        return torch.zeros_like(target_ids, dtype=torch.float32)
+    return torch.cat(log_probs_list, dim=1)
+
+
+def normalize_model_kwargs(model_kwargs: dict[str, Any] | None) -> dict[str, Any]:
+    """Fill the default `device_map` and `torch_dtype` of the keyword arguments for `from_pretrained()`."""
+    model_kwargs = model_kwargs or {}
+    model_kwargs = {**model_kwargs}  # copy kwargs to avoid modifying the original dict
+    if "device_map" not in model_kwargs:
+        model_kwargs["device_map"] = "auto"
+    if "torch_dtype" not in model_kwargs or model_kwargs["torch_dtype"] == "auto":
+        # You need to set torch_dtype to use the optimal dtype for the model.
+        # https://huggingface.co/docs/transformers/main/main_classes/model#model-instantiation-dtype
+        model_kwargs["torch_dtype"] = "auto"
+    else:
+        # Convert string to torch.dtype
+        model_kwargs["torch_dtype"] = getattr(torch, model_kwargs["torch_dtype"])
+        if not isinstance(model_kwargs["torch_dtype"], torch.dtype):
+            msg = f"Invalid torch_dtype: {model_kwargs['torch_dtype']}"
+            raise ValueError(msg)
+    return model_kwargs
+
+
+def load_causal_lm(model_name: str, model_kwargs: dict[str, Any], load_peft: bool = False) -> PreTrainedModel:
+    """Load a causal language model in the evaluation mode."""
+    if not load_peft:
+        model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            **model_kwargs,
+        )
+    else:
+        from peft import AutoPeftModelForCausalLM
+
+        model = AutoPeftModelForCausalLM.from_pretrained(
+            model_name,
+            **model_kwargs,
+        )
+        # For models such as LoRA, we can merge the additional weights to run inference faster.
+        if hasattr(model, "merge_and_unload"):
+            model = model.merge_and_unload()
+
+    model.eval()
+    return model
+
+
 class HuggingFaceLM(LanguageModel):
     """
     LanguageModel implementation using Hugging Face Transformers.
@@ -153,6 +445,50 @@ class HuggingFaceLM(LanguageModel):
         load_peft: Should be set to True when loading the model from PEFT weights.
         custom_chat_template: A custom chat template for chatbot models.
             If specified, this overrides the default chat template of the tokenizer.
+        reuse_prefix_cache: Whether to encode each distinct prefix only once in `batch_compute_log_probs`.
+            The key-value cache of the prefix is shared among the texts with the same prefix
+            (e.g., the choices of a multiple-choice question), and only the continuation tokens are fed to the model.
+            The model must return `past_key_values` in the standard `(batch, heads, seq, dim)` layout.
+        rolling_kv_cache: Whether to carry the key-value cache across windows when computing log probabilities
+            of texts longer than the context of the model.
+            Instead of re-feeding each overlapping window from scratch, the text is fed in blocks of `stride` tokens
+            and the cache keeps the last `max_position_embeddings - stride` tokens, so each token is forwarded once.
+            The position ids keep increasing beyond the context length,
+            so this only works with models using relative position encodings such as RoPE,
+            and a model with learned absolute position embeddings raises an error.
+            Note that the cached states of the kept tokens were computed with the evicted tokens in the context,
+            so the results slightly differ from those of re-feeding windows.
+        torch_compile: Whether to run the base model compiled with `torch.compile`.
+            Generation uses a static key-value cache of a bucketed length if the model supports it,
+            and the inputs are padded to lengths of powers of two to limit recompilation.
+            The compile time and the steady-state throughput are reported in the statistics.
+        torch_compile_kwargs: Keyword arguments for `torch.compile`, e.g., `{"backend": "eager"}`.
+        quantization: Quantize the linear layers of the model after loading, except for the LM head.
+            `dynamic_int8` quantizes both the weights and the activations with `torch.ao.quantization`,
+            and requires the model to be loaded on CPU in float32.
+            `weight_only_int8` only stores the weights in int8, which reduces the memory traffic of decoding.
+            The int8 kernel of PyTorch on CPU is fast with bfloat16 activations, so load the model in bfloat16.
+            Checkpoints that are already quantized (e.g., GPTQ or AWQ) are loaded as they are by `from_pretrained()`,
+            so leave this unset for them.
+        quantization_parity_texts: If specified with `quantization`, the log probabilities of these texts
+            are computed before and after quantization.
+            The differences per token and the speedup are reported in the statistics.
+        continuous_batching_size: If specified, texts are generated with continuous batching,
+            where at most this number of sequences are decoded at the same time.
+            Finished sequences are evicted from the running batch and the waiting inputs take their slots,
+            so the evaluation feeds the whole dataset to the model at once.
+            The log probabilities of the whole dataset are computed in batches of this size.
+            Only greedy decoding and sampling with `temperature`, `top_k`, and `top_p` are supported.
+        draft_model_name: The name or path of a small model that drafts tokens for speculative decoding
+            in `batch_complete_text`. The draft model must share the tokenizer with the main model.
+            The drafted tokens are verified by the main model, so greedy outputs do not change.
+            Assisted generation of Hugging Face Transformers only supports a batch size of 1,
+            so each text in a batch is generated one by one.
+            The acceptance rate of the drafted tokens is reported in the statistics.
+        draft_model_kwargs: Keyword arguments for the draft model instantiation by `from_pretrained()`.
+        prompt_lookup_num_tokens: If specified, the tokens are drafted by looking up the n-grams in the prompt
+            instead of using a draft model, proposing at most this number of tokens at each step.
+            This works well for tasks that copy spans from the prompt, such as extractive QA and summarization.
     """
 
     def __init__(
@@ -166,47 +502,71 @@ class HuggingFaceLM(LanguageModel):
         random_seed: int = 42,
         load_peft: bool = False,
         custom_chat_template: str | None = None,
+        reuse_prefix_cache: bool = False,
+        rolling_kv_cache: bool = False,
+        torch_compile: bool = False,
+        torch_compile_kwargs: dict[str, Any] | None = None,
+        quantization: Literal["dynamic_int8", "weight_only_int8"] | None = None,
+        quantization_parity_texts: list[str] | None = None,
+        continuous_batching_size: int | None = None,
+        draft_model_name: str | None = None,
+        draft_model_kwargs: dict[str, Any] | None = None,
+        prompt_lookup_num_tokens: int | None = None,
     ) -> None:
         tokenizer_name = tokenizer_name if tokenizer_name else model_name
         tokenizer_kwargs = tokenizer_kwargs or {}
         self._tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(tokenizer_name, **tokenizer_kwargs)
         self._custom_chat_template = custom_chat_template
+        self._stop_token_id_cache: dict[str, int | None] = {}
         self._add_special_tokens = add_special_tokens
 
-        model_kwargs = model_kwargs or {}
-        model_kwargs = {**model_kwargs}  # copy kwargs to avoid modifying the original dict
-        if "device_map" not in model_kwargs:
-            model_kwargs["device_map"] = "auto"
-        if "torch_dtype" not in model_kwargs or model_kwargs["torch_dtype"] == "auto":
-            # You need to set torch_dtype to use the optimal dtype for the model.
-            # https://huggingface.co/docs/transformers/main/main_classes/model#model-instantiation-dtype
-            model_kwargs["torch_dtype"] = "auto"
-        else:
-            # Convert string to torch.dtype
-            model_kwargs["torch_dtype"] = getattr(torch, model_kwargs["torch_dtype"])
-            if not isinstance(model_kwargs["torch_dtype"], torch.dtype):
-                msg = f"Invalid torch_dtype: {model_kwargs['torch_dtype']}"
-                raise ValueError(msg)
-
-        if not load_peft:
-            self._model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                **model_kwargs,
-            )
-        else:
-            from peft import AutoPeftModelForCausalLM
+        if draft_model_name is not None and prompt_lookup_num_tokens is not None:
+            msg = "Only one of draft_model_name and prompt_lookup_num_tokens can be specified."
+            raise ValueError(msg)
+        if (draft_model_name is not None or prompt_lookup_num_tokens is not None) and continuous_batching_size:
+            msg = "Speculative decoding cannot be used with continuous batching."
+            raise ValueError(msg)
 
-            self._model = AutoPeftModelForCausalLM.from_pretrained(
-                model_name,
-                **model_kwargs,
+        self._model = load_causal_lm(model_name, normalize_model_kwargs(model_kwargs), load_peft=load_peft)
+        self._draft_model: PreTrainedModel | None = None
+        if draft_model_name is not None:
+            self._draft_model = load_causal_lm(draft_model_name, normalize_model_kwargs(draft_model_kwargs))
+        self._prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self._speculative_stats: dict[str, int] = {}
+
+        self._amp_dtype = amp_dtype
+        self._reuse_prefix_cache = reuse_prefix_cache
+        self._rolling_kv_cache = rolling_kv_cache
+        if rolling_kv_cache and has_absolute_position_embeddings(self._model):
+            msg = (
+                "rolling_kv_cache cannot be used with models with absolute position embeddings, "
+                "because the position ids exceed `max_position_embeddings`."
             )
-            # For models such as LoRA, we can merge the additional weights to run inference faster.
-            if hasattr(self._model, "merge_and_unload"):
-                self._model: PreTrainedModel = self._model.merge_and_unload()
+            raise ValueError(msg)
 
-        self._model.eval()
+        self._torch_compile = torch_compile
+        self._static_cache: tuple[int, Any] | None = None
+        self._compile_stats: dict[str, float] = {}
+        self.reset_stats()
 
-        self._amp_dtype = amp_dtype
+        # quantize before compilation so that the compiled graph includes the quantized layers
+        self._quantization_stats: dict[str, float] = {}
+        if quantization is not None:
+            self._quantize_model(quantization, quantization_parity_texts)
+
+        if torch_compile:
+            self._compile_base_model(torch_compile_kwargs or {})
+
+        self._continuous_batching_size = continuous_batching_size
+        self._continuous_batching_generator = None
+        if continuous_batching_size is not None:
+            from .hf_continuous_batching import ContinuousBatchingGenerator
+
+            self._continuous_batching_generator = ContinuousBatchingGenerator(
+                self._model,
+                self._tokenizer,
+                max_batch_size=continuous_batching_size,
+            )
 
         transformers.set_seed(random_seed)
 
@@ -214,6 +574,151 @@ class HuggingFaceLM(LanguageModel):
         logger.info(f"model dtype: {self._model.dtype}")
         logger.info(f"amp_dtype: {amp_dtype}")
         logger.info(f"random seed: {random_seed}")
+        logger.info(f"reuse_prefix_cache: {reuse_prefix_cache}")
+        logger.info(f"rolling_kv_cache: {rolling_kv_cache}")
+        logger.info(f"torch_compile: {torch_compile}")
+        logger.info(f"continuous_batching_size: {continuous_batching_size}")
+        logger.info(f"draft_model_name: {draft_model_name}")
+        logger.info(f"prompt_lookup_num_tokens: {prompt_lookup_num_tokens}")
+
+    def _compile_base_model(self, torch_compile_kwargs: dict[str, Any]) -> None:
+        """Replace the forward of the base model with the compiled one that records the time of each call.
+
+        The LM head is not compiled so that the hooks of `keep_last_logits` can be attached to it.
+        A call is counted as compilation if it produces a new graph, and otherwise as steady state.
+        """
+        import torch._dynamo
+
+        base_model = self._model.base_model
+        compiled_forward = torch.compile(base_model.forward, **torch_compile_kwargs)
+
+        def timed_forward(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+            num_graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"]  # noqa: SLF001
+            start_time = time.perf_counter()
+            outputs = compiled_forward(*args, **kwargs)
+            if self._model.device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed_time = time.perf_counter() - start_time
+
+            if torch._dynamo.utils.counters["stats"]["unique_graphs"] > num_graphs:  # noqa: SLF001
+                self._compile_stats["compile_time"] += elapsed_time
+                self._compile_stats["num_compilations"] += 1
+            else:
+                input_ids = kwargs.get("input_ids", args[0] if args else None)
+                self._compile_stats["steady_state_forward_time"] += elapsed_time
+                self._compile_stats["steady_state_num_tokens"] += input_ids.numel() if input_ids is not None else 0
+            return outputs
+
+        base_model.forward = timed_forward
+
+    def _quantize_model(
+        self,
+        quantization: Literal["dynamic_int8", "weight_only_int8"],
+        parity_texts: list[str] | None,
+    ) -> None:
+        """Quantize the linear layers of the model, checking the parity of the log probabilities if requested.
+
+        The results are kept in the statistics throughout the lifetime of the model.
+        """
+        from .hf_quantization import quantize_linear_layers
+
+        if parity_texts:
+            # warm up so that the one-time initialization is not included in the time
+            self.batch_compute_log_probs(parity_texts[:1])
+            start_time = time.perf_counter()
+            log_probs = self.batch_compute_log_probs(parity_texts)
+            unquantized_time = time.perf_counter() - start_time
+
+        if quantization == "weight_only_int8" and self._model.dtype == torch.float32:
+            logger.warning("weight_only_int8 quantization can be slower than float32 without bfloat16 activations.")
+        num_quantized_layers = quantize_linear_layers(self._model, quantization)
+        logger.info(f"Quantized {num_quantized_layers} linear layers with {quantization}.")
+        self._quantization_stats["quantization_num_layers"] = num_quantized_layers
+
+        if parity_texts:
+            self.batch_compute_log_probs(parity_texts[:1])
+            start_time = time.perf_counter()
+            quantized_log_probs = self.batch_compute_log_probs(parity_texts)
+            quantized_time = time.perf_counter() - start_time
+
+            diffs_per_token = [
+                abs(quantized_log_prob - log_prob) / max(num_tokens, 1)
+                for log_prob, quantized_log_prob, num_tokens in zip(
+                    log_probs,
+                    quantized_log_probs,
+                    self.count_tokens(parity_texts),
+                )
+            ]
+            self._quantization_stats.update(
+                {
+                    "quantization_parity_mean_abs_log_prob_diff_per_token": sum(diffs_per_token) / len(diffs_per_token),
+                    "quantization_parity_max_abs_log_prob_diff_per_token": max(diffs_per_token),
+                    "quantization_parity_speedup": unquantized_time / quantized_time,
+                },
+            )
+            logger.info(f"Quantization parity: {self._quantization_stats}")
+
+    def get_stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = dict(self._quantization_stats)
+        if self._torch_compile:
+            stats.update(self._compile_stats)
+            if stats["steady_state_forward_time"] > 0:
+                stats["steady_state_tokens_per_second"] = (
+                    stats["steady_state_num_tokens"] / stats["steady_state_forward_time"]
+                )
+        if self._uses_speculative_decoding():
+            stats.update(self._speculative_stats)
+            if stats["speculative_num_target_forwards"] > 0:
+                stats["speculative_tokens_per_target_forward"] = (
+                    stats["speculative_num_generated_tokens"] / stats["speculative_num_target_forwards"]
+                )
+            if stats["speculative_num_drafted_tokens"] > 0:
+                stats["speculative_acceptance_rate"] = (
+                    stats["speculative_num_accepted_tokens"] / stats["speculative_num_drafted_tokens"]
+                )
+        return stats
+
+    def reset_stats(self) -> None:
+        self._compile_stats = {
+            "compile_time": 0.0,
+            "num_compilations": 0,
+            "steady_state_forward_time": 0.0,
+            "steady_state_num_tokens": 0,
+        }
+        self._speculative_stats = {
+            "speculative_num_target_forwards": 0,
+            "speculative_num_generated_tokens": 0,
+            "speculative_num_drafted_tokens": 0,
+            "speculative_num_accepted_tokens": 0,
+        }
+
+    def _uses_speculative_decoding(self) -> bool:
+        return self._draft_model is not None or self._prompt_lookup_num_tokens is not None
+
+    @contextlib.contextmanager
+    def _record_speculative_stats(self, prompt_length: int) -> Iterator[None]:
+        """Count the tokens drafted and accepted during an assisted generation of a single sequence.
+
+        Each forward of the main model verifies the drafted tokens fed after the last generated token,
+        and every forward produces one token of its own in addition to the accepted ones.
+        """
+        num_tokens_fed = 0
+
+        def _count_drafted_tokens(_module: torch.nn.Module, args: tuple[Any, ...], kwargs: dict[str, Any]) -> None:
+            nonlocal num_tokens_fed
+            input_ids = kwargs.get("input_ids", args[0] if args else None)
+            num_input_tokens = input_ids.size(1)
+            # the first forward also encodes the prompt
+            num_context_tokens = prompt_length if num_tokens_fed == 0 else 1
+            self._speculative_stats["speculative_num_target_forwards"] += 1
+            self._speculative_stats["speculative_num_drafted_tokens"] += max(num_input_tokens - num_context_tokens, 0)
+            num_tokens_fed += num_input_tokens
+
+        handle = self._model.register_forward_pre_hook(_count_drafted_tokens, with_kwargs=True)
+        try:
+            yield
+        finally:
+            handle.remove()
 
     def _get_amp_context(self) -> contextlib.AbstractContextManager:
         if self._amp_dtype is None:
@@ -232,29 +737,93 @@ class HuggingFaceLM(LanguageModel):
         msg = f"Invalid amp_dtype: {self._amp_dtype}"
         raise ValueError(msg)
 
+    def _pad_to_bucketed_length(
+        self,
+        batch_encoding: BatchEncoding,
+        padding_side: Literal["left", "right"],
+    ) -> BatchEncoding:
+        """Pad the inputs to the bucketed length unless it exceeds the context of the model."""
+        bucketed_length = get_bucketed_length(batch_encoding.input_ids.size(1))
+        if bucketed_length > self._model.config.max_position_embeddings:
+            return batch_encoding
+        return pad_batch_encoding(
+            batch_encoding,
+            bucketed_length,
+            pad_token_id=self._tokenizer.pad_token_id,
+            padding_side=padding_side,
+        )
+
+    def _get_static_cache(self, batch_size: int, max_cache_length: int) -> Any:  # noqa: ANN401
+        """Return a `StaticCache` for generation, reusing the previous one if it is large enough.
+
+        The cache is created here instead of by `generate(cache_implementation="static")`,
+        which fails for models loaded only on CPU with `device_map`.
+        """
+        from transformers import StaticCache
+
+        if self._static_cache is not None:
+            cached_batch_size, static_cache = self._static_cache
+            if cached_batch_size == batch_size and static_cache.max_cache_len >= max_cache_length:
+                static_cache.reset()
+                return static_cache
+
+        static_cache = StaticCache(
+            self._model.config,
+            batch_size,
+            max_cache_length,
+            self._model.device,
+            self._model.dtype,
+        )
+        self._static_cache = (batch_size, static_cache)
+        return static_cache
+
+    def _get_stop_token_id(self, stop_seq: str) -> int | None:
+        """Return the token id that corresponds to `stop_seq` itself, or None if there is no such token.
+
+        The results are cached because this is called with the same stop sequences for every batch.
+        """
+        if stop_seq in self._stop_token_id_cache:
+            return self._stop_token_id_cache[stop_seq]
+
+        # Try to convert string to id using `convert_tokens_to_ids`
+        # We do not use the `encode` method
+        # because in the case of sentencepiece-based tokenizers,
+        # calling the encode method adds a redundant space at the beginning of the string,
+        stop_token_id = self._tokenizer.convert_tokens_to_ids(stop_seq)
+
+        # NeoXTokenizer returns Unk when calling convert_tokens_ids
+        # because each token is stored in a peculiar way
+        # Ex. "」" -> "ãĢį"
+        if stop_token_id == self._tokenizer.unk_token_id:
+            # In such a case, we try to get the ID by calling the encode method.
+            stop_token_id = self._tokenizer.encode(stop_seq, add_special_tokens=False)[-1]
+        # If the token does not match the specified string itself, it is not a stop token id
+        if self._tokenizer.decode(stop_token_id) != stop_seq:
+            stop_token_id = None
+
+        self._stop_token_id_cache[stop_seq] = stop_token_id
+        return stop_token_id
+
     def _get_stop_token_ids(self, stop_sequences: list[str]) -> list[int]:
         stop_token_ids: list[int] = []
         for stop_seq in stop_sequences:
-            # Try to convert string to id using `convert_tokens_to_ids`
-            # We do not use the `encode` method
-            # because in the case of sentencepiece-based tokenizers,
-            # calling the encode method adds a redundant space at the beginning of the string,
-            stop_token_id = self._tokenizer.convert_tokens_to_ids(stop_seq)
-
-            # NeoXTokenizer returns Unk when calling convert_tokens_ids
-            # because each token is stored in a peculiar way
-            # Ex. "」" -> "ãĢį"
-            if stop_token_id == self._tokenizer.unk_token_id:
-                # In such a case, we try to get the ID by calling the encode method.
-                stop_token_id = self._tokenizer.encode(stop_seq, add_special_tokens=False)[-1]
-            # If the token does not match the specified string itself, we do not include it as a stop token id
-            if self._tokenizer.decode(stop_token_id) != stop_seq:
-                continue
-
-            stop_token_ids.append(stop_token_id)
+            stop_token_id = self._get_stop_token_id(stop_seq)
+            if stop_token_id is not None:
+                stop_token_ids.append(stop_token_id)
         return stop_token_ids
 
-    @torch.inference_mode()
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        model_inputs = self._tokenizer(
+            text_list,
+            add_special_tokens=self._add_special_tokens,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+        )
+        return [len(input_ids) for input_ids in model_inputs.input_ids]
+
+    def prefers_whole_dataset(self) -> bool:
+        return self._continuous_batching_generator is not None
+
     def batch_complete_text(
         self,
         text_list: list[str],
@@ -264,15 +833,88 @@ class HuggingFaceLM(LanguageModel):
         include_stop_str_in_output: bool = False,
         **kwargs,
     ) -> list[str]:
-        kwargs = kwargs.copy()  # avoid modifying the original kwargs
+        return self._complete_text(
+            text_list,
+            num_samples=1,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            ignore_eos=ignore_eos,
+            include_stop_str_in_output=include_stop_str_in_output,
+            **kwargs,
+        )
 
-        model_inputs = tokenize_text_for_lm_prefix(
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        ignore_eos: bool = False,
+        include_stop_str_in_output: bool = False,
+        **kwargs,
+    ) -> list[list[str]]:
+        """Generate `num_samples` continuations for each text.
+
+        Each prompt is encoded only once and its key-value cache is shared by all the samples.
+        """
+        output_texts = self._complete_text(
             text_list,
-            self._tokenizer,
-            add_special_tokens=self._add_special_tokens,
-        ).to(self._model.device)
-        input_token_length = model_inputs["input_ids"].shape[1]
+            num_samples=num_samples,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            ignore_eos=ignore_eos,
+            include_stop_str_in_output=include_stop_str_in_output,
+            **kwargs,
+        )
+        return [output_texts[i : i + num_samples] for i in range(0, len(output_texts), num_samples)]
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        ignore_eos: bool = False,
+        include_stop_str_in_output: bool = False,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        """With continuous batching, yield each text as soon as its sequence is evicted from the running batch."""
+        if self._continuous_batching_generator is None:
+            yield from super().iter_complete_text(
+                text_list,
+                stop_sequences=stop_sequences,
+                max_new_tokens=max_new_tokens,
+                ignore_eos=ignore_eos,
+                include_stop_str_in_output=include_stop_str_in_output,
+                **kwargs,
+            )
+            return
 
+        kwargs = kwargs.copy()  # avoid modifying the original kwargs
+        stop_sequences, stop_token_ids, multi_token_stop_sequences = self._prepare_stop_sequences(
+            stop_sequences,
+            ignore_eos,
+            kwargs,
+        )
+        for index, output_token_ids in self._iter_continuous_batching(
+            text_list,
+            num_samples=1,
+            stop_token_ids=stop_token_ids,
+            multi_token_stop_sequences=multi_token_stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        ):
+            yield index, self._decode_output_text(output_token_ids, stop_sequences, include_stop_str_in_output)
+
+    def _prepare_stop_sequences(
+        self,
+        stop_sequences: str | list[str] | None,
+        ignore_eos: bool,
+        kwargs: dict[str, Any],
+    ) -> tuple[list[str], list[int], list[str]]:
+        """Return the stop sequences, the stop token ids, and the stop sequences that are not a single token.
+
+        `stop_strings` is popped from `kwargs`.
+        """
         stop_sequences = normalize_stop_sequences(
             stop_sequences=stop_sequences,
             stop_from_kwargs=kwargs.pop("stop_strings", None),
@@ -280,6 +922,179 @@ class HuggingFaceLM(LanguageModel):
             ignore_eos=ignore_eos,
         )
         stop_token_ids = self._get_stop_token_ids(stop_sequences)
+        # the stop sequences that are not a single token are detected from the decoded text during generation
+        multi_token_stop_sequences = [
+            stop_seq for stop_seq in stop_sequences if self._get_stop_token_id(stop_seq) is None and stop_seq
+        ]
+        return stop_sequences, stop_token_ids, multi_token_stop_sequences
+
+    def _iter_continuous_batching(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_token_ids: list[int],
+        multi_token_stop_sequences: list[str],
+        max_new_tokens: int | None,
+        **kwargs,
+    ) -> Iterator[tuple[int, list[int]]]:
+        """Generate with continuous batching, yielding `(index, generated_token_ids)` as each sequence finishes.
+
+        The samples of each text are indexed consecutively.
+        """
+        input_ids_list = self._tokenizer(
+            text_list,
+            add_special_tokens=self._add_special_tokens,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+        ).input_ids
+        outputs_iterator = self._continuous_batching_generator.iter_generate(
+            [input_ids for input_ids in input_ids_list for _ in range(num_samples)],
+            stop_token_ids=stop_token_ids,
+            stop_sequences=multi_token_stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+        while True:
+            # the autocast context is entered for each step so that it does not leak into the caller between yields
+            with self._get_amp_context():
+                output = next(outputs_iterator, None)
+            if output is None:
+                return
+            yield output
+
+    def _decode_output_text(
+        self,
+        output_token_ids: list[int],
+        stop_sequences: list[str],
+        include_stop_str_in_output: bool,
+    ) -> str:
+        output_tokens = [t for t in output_token_ids if t != self._tokenizer.pad_token_id]
+        decoded_text = self._tokenizer.decode(output_tokens, skip_special_tokens=False)
+        if include_stop_str_in_output:
+            return decoded_text
+
+        # We strip the stop sequences from the output text.
+        for stop_seq in stop_sequences:
+            idx = decoded_text.find(stop_seq)
+            if idx != -1:
+                decoded_text = decoded_text[:idx]
+        return decoded_text
+
+    @torch.inference_mode()
+    def _complete_text(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None,
+        max_new_tokens: int | None,
+        ignore_eos: bool,
+        include_stop_str_in_output: bool,
+        **kwargs,
+    ) -> list[str]:
+        """Generate `num_samples` continuations for each text, returning the samples of each text consecutively."""
+        kwargs = kwargs.copy()  # avoid modifying the original kwargs
+        stop_sequences, stop_token_ids, multi_token_stop_sequences = self._prepare_stop_sequences(
+            stop_sequences,
+            ignore_eos,
+            kwargs,
+        )
+
+        if self._continuous_batching_generator is not None:
+            output_token_ids_list: list[list[int]] = [[] for _ in range(len(text_list) * num_samples)]
+            for index, output_token_ids in self._iter_continuous_batching(
+                text_list,
+                num_samples=num_samples,
+                stop_token_ids=stop_token_ids,
+                multi_token_stop_sequences=multi_token_stop_sequences,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            ):
+                output_token_ids_list[index] = output_token_ids
+        elif num_samples > 1 and (self._uses_speculative_decoding() or self._torch_compile):
+            # assisted generation and the static cache fix the batch size, so the prompts are simply repeated
+            output_token_ids_list = self._generate_token_ids(
+                [text for text in text_list for _ in range(num_samples)],
+                stop_token_ids=stop_token_ids,
+                multi_token_stop_sequences=multi_token_stop_sequences,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+        else:
+            output_token_ids_list = self._generate_token_ids(
+                text_list,
+                num_samples=num_samples,
+                stop_token_ids=stop_token_ids,
+                multi_token_stop_sequences=multi_token_stop_sequences,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+
+        return [
+            self._decode_output_text(output_token_ids, stop_sequences, include_stop_str_in_output)
+            for output_token_ids in output_token_ids_list
+        ]
+
+    def _generate_token_ids(
+        self,
+        text_list: list[str],
+        stop_token_ids: list[int],
+        multi_token_stop_sequences: list[str],
+        max_new_tokens: int | None,
+        num_samples: int = 1,
+        **kwargs,
+    ) -> list[list[int]]:
+        """Generate the continuations of each text as a static batch with `model.generate`.
+
+        When `num_samples` is more than one, the samples of each text are returned consecutively.
+        """
+        if self._uses_speculative_decoding():
+            if len(text_list) > 1:
+                return [
+                    output_token_ids
+                    for text in text_list
+                    for output_token_ids in self._generate_token_ids(
+                        [text],
+                        stop_token_ids=stop_token_ids,
+                        multi_token_stop_sequences=multi_token_stop_sequences,
+                        max_new_tokens=max_new_tokens,
+                        **kwargs,
+                    )
+                ]
+            if self._draft_model is not None:
+                kwargs["assistant_model"] = self._draft_model
+            else:
+                kwargs["prompt_lookup_num_tokens"] = self._prompt_lookup_num_tokens
+
+        model_inputs = tokenize_text_for_lm_prefix(
+            text_list,
+            self._tokenizer,
+            add_special_tokens=self._add_special_tokens,
+        ).to(self._model.device)
+        if self._torch_compile:
+            model_inputs = self._pad_to_bucketed_length(model_inputs, padding_side="left")
+        input_token_length = model_inputs["input_ids"].shape[1]
+
+        if num_samples > 1:
+            model_inputs = self._prefill_prompts(model_inputs, num_samples, kwargs)
+
+        # assisted generation does not support the static cache
+        if (
+            self._torch_compile
+            and getattr(self._model, "_supports_static_cache", False)
+            and not self._uses_speculative_decoding()
+        ):
+            if max_new_tokens is not None:
+                max_cache_length = input_token_length + max_new_tokens
+            else:
+                max_cache_length = kwargs.get("max_length", self._model.generation_config.max_length)
+            kwargs["past_key_values"] = self._get_static_cache(len(text_list), get_bucketed_length(max_cache_length))
+
+        if multi_token_stop_sequences:
+            stopping_criteria = StoppingCriteriaList(kwargs.pop("stopping_criteria", None) or [])
+            stopping_criteria.append(
+                StopSequenceCriteria(self._tokenizer, multi_token_stop_sequences, prompt_length=input_token_length),
+            )
+            kwargs["stopping_criteria"] = stopping_criteria
 
         kwargs.update(
             {
@@ -289,26 +1104,73 @@ class HuggingFaceLM(LanguageModel):
             },
         )
 
-        with self._get_amp_context():
-            lm_outputs = self._model.generate(**model_inputs, **kwargs)
+        if not self._uses_speculative_decoding():
+            with self._get_amp_context():
+                lm_outputs = self._model.generate(**model_inputs, **kwargs)
+        else:
+            lm_outputs = self._generate_with_speculative_stats(model_inputs, input_token_length, **kwargs)
 
         # `lm_outputs` contains full text including the input text.
-        # We strip the input text and stop sequences from the output text.
-        output_texts: list[str] = []
-        for output_tensor in lm_outputs[:, input_token_length:]:
-            output_tokens = [t for t in output_tensor.tolist() if t != self._tokenizer.pad_token_id]
-            decoded_text = self._tokenizer.decode(output_tokens, skip_special_tokens=False)
-
-            if include_stop_str_in_output:
-                output_texts.append(decoded_text)
-                continue
-
-            for stop_seq in stop_sequences:
-                idx = decoded_text.find(stop_seq)
-                if idx != -1:
-                    decoded_text = decoded_text[:idx]
-            output_texts.append(decoded_text)
-        return output_texts
+        return lm_outputs[:, input_token_length:].tolist()
+
+    def _generate_with_speculative_stats(
+        self,
+        model_inputs: BatchEncoding,
+        input_token_length: int,
+        max_new_tokens: int | None,
+        **kwargs,
+    ) -> torch.Tensor:
+        num_target_forwards_before = self._speculative_stats["speculative_num_target_forwards"]
+        with self._get_amp_context(), self._record_speculative_stats(prompt_length=input_token_length):
+            lm_outputs = self._model.generate(**model_inputs, max_new_tokens=max_new_tokens, **kwargs)
+        num_target_forwards = self._speculative_stats["speculative_num_target_forwards"] - num_target_forwards_before
+        num_untruncated_tokens = lm_outputs.size(1) - input_token_length
+        # prompt lookup may accept more tokens than `max_new_tokens` at the last step
+        if max_new_tokens is not None:
+            lm_outputs = lm_outputs[:, : input_token_length + max_new_tokens]
+        num_generated_tokens = lm_outputs.size(1) - input_token_length
+        self._speculative_stats["speculative_num_generated_tokens"] += num_generated_tokens
+        # Every forward of the main model produces one token of its own after the accepted drafted tokens,
+        # so the truncation removes the own token of the last forward first.
+        # Only the accepted tokens that are kept in the output are counted.
+        num_own_tokens = num_target_forwards - int(num_generated_tokens < num_untruncated_tokens)
+        num_accepted_tokens = min(max(num_generated_tokens - num_own_tokens, 0), num_generated_tokens)
+        self._speculative_stats["speculative_num_accepted_tokens"] += num_accepted_tokens
+        return lm_outputs
+
+    def _prefill_prompts(
+        self,
+        model_inputs: BatchEncoding,
+        num_samples: int,
+        generate_kwargs: dict[str, Any],
+    ) -> BatchEncoding:
+        """Encode the prompts except the last token once and share the key-value cache among the samples.
+
+        The cache is set to `generate_kwargs`, and the inputs repeated for the samples are returned.
+        `generate` then feeds only the tokens that are not in the cache, i.e., the last token of each prompt.
+        """
+        repeated_inputs = BatchEncoding(
+            {key: value.repeat_interleave(num_samples, dim=0) for key, value in model_inputs.items()},
+        )
+        if model_inputs["input_ids"].size(1) == 1:
+            return repeated_inputs
+
+        input_ids = model_inputs["input_ids"][:, :-1]
+        attention_mask = model_inputs["attention_mask"][:, :-1]
+        # the logits are not used
+        with self._get_amp_context(), keep_last_logits(self._model, 1):
+            prefill_outputs = self._model.forward(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=get_position_ids(attention_mask),
+                use_cache=True,
+            )
+        sample_indices = torch.arange(input_ids.size(0), device=input_ids.device).repeat_interleave(num_samples)
+        generate_kwargs["past_key_values"] = to_model_cache_format(
+            self._model,
+            select_past_key_values(prefill_outputs.past_key_values, sample_indices),
+        )
+        return repeated_inputs
 
     def batch_generate_chat_response(
         self,
@@ -333,6 +1195,20 @@ class HuggingFaceLM(LanguageModel):
         prefix_list: list[str] | None = None,
         stride: int | None = None,
     ) -> list[float]:
+        if self._continuous_batching_size is not None and len(text_list) > self._continuous_batching_size:
+            # the evaluation passes the whole dataset to the model with continuous batching
+            prefix_list = prefix_list or [""] * len(text_list)
+            chunk_size = self._continuous_batching_size
+            return [
+                log_prob
+                for i in range(0, len(text_list), chunk_size)
+                for log_prob in self.batch_compute_log_probs(
+                    text_list[i : i + chunk_size],
+                    prefix_list[i : i + chunk_size],
+                    stride=stride,
+                )
+            ]
+
         batch_size = len(text_list)
 
         # prepare prefix encoding
@@ -343,6 +1219,11 @@ class HuggingFaceLM(LanguageModel):
             if prefix_list[i] == "":
                 prefix_list[i] = self._tokenizer.bos_token
 
+        if self._reuse_prefix_cache and stride is None and len(set(prefix_list)) < batch_size:
+            log_probs = self._batch_compute_log_probs_with_shared_prefix(text_list, prefix_list)
+            if log_probs is not None:
+                return log_probs
+
         prefix_encoding = tokenize_text_for_lm_prefix(
             prefix_list,
             self._tokenizer,
@@ -366,7 +1247,38 @@ class HuggingFaceLM(LanguageModel):
                 dim=1,
             )
         input_encoding = BatchEncoding(input_data_dict)
+        if self._torch_compile:
+            input_encoding = self._pad_to_bucketed_length(input_encoding, padding_side="right")
+
+        # the log probs of the prefix tokens are not needed
+        prefix_length = prefix_encoding.input_ids.shape[1]
+        start_index = max(prefix_length - 1, 0)
+
+        with self._get_amp_context():
+            log_prob_of_next = self._compute_log_probs_of_next_tokens(input_encoding, stride, start_index)
+
+            log_prob_mask = input_encoding.attention_mask.clone()
+            # replace the last token's log prob with 0
+            for i in range(log_prob_mask.shape[0]):
+                last_non_pad_index = log_prob_mask[i].nonzero(as_tuple=True)[0][-1].item()
+                log_prob_mask[i, last_non_pad_index] = 0
+            # mask out log probs of prefix tokens
+            log_prob_mask[:, :start_index] = 0
+            total_log_probs = (log_prob_of_next * log_prob_mask).sum(dim=-1)
+        return total_log_probs.tolist()
 
+    def _compute_log_probs_of_next_tokens(
+        self,
+        input_encoding: BatchEncoding,
+        stride: int | None,
+        start_index: int = 0,
+    ) -> torch.Tensor:
+        """Compute the log probability of the next token at each position of the input.
+
+        Inputs longer than the context of the model are processed with a sliding window of the given stride.
+        The logits are computed only for the positions from `start_index`, and the log probabilities
+        before `start_index` are left as zero.
+        """
         max_length = self._model.config.max_position_embeddings
         stride = stride or max_length // 2
         if not (0 < stride < max_length):
@@ -374,61 +1286,187 @@ class HuggingFaceLM(LanguageModel):
             raise ValueError(msg)
         sequence_length = input_encoding.input_ids.size(1)
 
-        with self._get_amp_context():
-            # stores log probabilities of the next token for each input token
-            last_computed_index: int = 0
-            log_prob_of_next = torch.zeros_like(
-                input_encoding.input_ids,
-                dtype=torch.float32,
-            )
-            for chunk_start in range(0, sequence_length, stride):
-                chunk_end = min(chunk_start + max_length, sequence_length)
+        if self._rolling_kv_cache and sequence_length > max_length:
+            return self._compute_log_probs_of_next_tokens_with_rolling_cache(input_encoding, stride, start_index)
+
+        # stores log probabilities of the next token for each input token
+        last_computed_index: int = start_index
+        log_prob_of_next = torch.zeros_like(
+            input_encoding.input_ids,
+            dtype=torch.float32,
+        )
+        for chunk_start in range(0, sequence_length, stride):
+            chunk_end = min(chunk_start + max_length, sequence_length)
 
-                # Visualize the input / output processing
-                # input_encoding.input_ids: [ 0  1  2  3  4 ]
-                # chunk_input_ids:          [ 0  1  2  3    ]
-                # chunk_target_ids:         [    1  2  3  4 ]
+            # Visualize the input / output processing
+            # input_encoding.input_ids: [ 0  1  2  3  4 ]
+            # chunk_input_ids:          [ 0  1  2  3    ]
+            # chunk_target_ids:         [    1  2  3  4 ]
 
-                input_start = chunk_start
-                input_end = chunk_end - 1
+            input_start = chunk_start
+            input_end = chunk_end - 1
 
+            # The windows that only cover the positions before `start_index` can be skipped.
+            num_logits_to_keep = input_end - max(last_computed_index, input_start)
+            if num_logits_to_keep > 0:
                 chunk_input_ids = input_encoding.input_ids[:, input_start:input_end].to(self._model.device)
                 chunk_input_mask = input_encoding.attention_mask[:, input_start:input_end].to(self._model.device)
-                chunk_target_ids = input_encoding.input_ids[:, chunk_start + 1 : chunk_end].to(self._model.device)
+                chunk_target_ids = input_encoding.input_ids[:, input_end - num_logits_to_keep + 1 : chunk_end].to(
+                    self._model.device,
+                )
 
                 chunk_model_inputs = self._model.prepare_inputs_for_generation(
                     chunk_input_ids,
                     attention_mask=chunk_input_mask,
                 )
-                lm_outputs = self._model.forward(**chunk_model_inputs)
+                # Only compute the logits of the positions whose log probs are needed
+                with keep_last_logits(self._model, num_logits_to_keep):
+                    lm_outputs = self._model.forward(**chunk_model_inputs)
+                chunk_logits = lm_outputs.logits[:, -num_logits_to_keep:]
 
-                chunk_log_probs = F.log_softmax(lm_outputs.logits, dim=-1)
-                # shape of chunk_log_probs: (batch_size, sequence_length, vocab_size)
-                # shape of target_ids: (batch_size, sequence_length)
+                # shape of chunk_logits: (batch_size, num_logits_to_keep, vocab_size)
+                # shape of target_ids: (batch_size, num_logits_to_keep)
                 # get the log probs of the target ids
-                chunk_next_log_probs = chunk_log_probs.gather(
-                    dim=-1,
-                    index=chunk_target_ids.unsqueeze(-1),
-                ).squeeze(-1)
-
-                log_prob_of_next[:, last_computed_index:input_end] = chunk_next_log_probs[
-                    :,
-                    last_computed_index - input_start :,
-                ]
+                log_prob_of_next[:, input_end - num_logits_to_keep : input_end] = gather_log_probs(
+                    chunk_logits,
+                    chunk_target_ids,
+                )
 
-                last_computed_index = input_end
+            last_computed_index = max(last_computed_index, input_end)
 
-                if chunk_end == sequence_length:
-                    break
+            if chunk_end == sequence_length:
+                break
+        return log_prob_of_next
 
-            log_prob_mask = input_encoding.attention_mask.clone()
-            # replace the last token's log prob with 0
-            for i in range(log_prob_mask.shape[0]):
-                last_non_pad_index = log_prob_mask[i].nonzero(as_tuple=True)[0][-1].item()
-                log_prob_mask[i, last_non_pad_index] = 0
-            # mask out log probs of prefix tokens
-            prefix_length = prefix_encoding.input_ids.shape[1]
-            if prefix_length > 0:
-                log_prob_mask[:, : prefix_length - 1] = 0
-            total_log_probs = (log_prob_of_next * log_prob_mask).sum(dim=-1)
+    def _compute_log_probs_of_next_tokens_with_rolling_cache(
+        self,
+        input_encoding: BatchEncoding,
+        stride: int,
+        start_index: int = 0,
+    ) -> torch.Tensor:
+        """Compute the log probability of the next token at each position by carrying the key-value cache.
+
+        The input is fed in blocks of `stride` tokens.
+        After each block, the oldest entries are evicted from the cache so that the cache and the next block
+        fit in the context of the model.
+        Compared to re-feeding overlapping windows, each token is forwarded only once,
+        and every token is predicted with at least `max_position_embeddings - stride` preceding tokens.
+        """
+        num_cached_tokens = self._model.config.max_position_embeddings - stride
+        device = self._model.device
+
+        input_ids = input_encoding.input_ids.to(device)
+        attention_mask = input_encoding.attention_mask.to(device)
+        # position ids are computed over the whole sequence and keep increasing across blocks
+        position_ids = get_position_ids(attention_mask)
+        sequence_length = input_ids.size(1)
+
+        log_prob_of_next = torch.zeros_like(input_ids, dtype=torch.float32)
+        past_key_values = None
+        past_attention_mask = attention_mask[:, :0]
+        # the last token does not have the next token to predict
+        for block_start in range(0, sequence_length - 1, stride):
+            block_end = min(block_start + stride, sequence_length - 1)
+            block_attention_mask = torch.cat([past_attention_mask, attention_mask[:, block_start:block_end]], dim=1)
+
+            num_logits_to_keep = block_end - max(block_start, start_index)
+            # the blocks before `start_index` are fed only to fill the cache
+            with keep_last_logits(self._model, max(num_logits_to_keep, 1)):
+                lm_outputs = self._model.forward(
+                    input_ids=input_ids[:, block_start:block_end],
+                    attention_mask=block_attention_mask,
+                    position_ids=position_ids[:, block_start:block_end],
+                    past_key_values=to_model_cache_format(self._model, past_key_values),
+                    use_cache=True,
+                )
+            if num_logits_to_keep > 0:
+                log_prob_of_next[:, block_end - num_logits_to_keep : block_end] = gather_log_probs(
+                    lm_outputs.logits[:, -num_logits_to_keep:],
+                    input_ids[:, block_end - num_logits_to_keep + 1 : block_end + 1],
+                )
+
+            past_key_values = trim_past_key_values(lm_outputs.past_key_values, num_cached_tokens)
+            past_attention_mask = block_attention_mask[:, -num_cached_tokens:]
+        return log_prob_of_next.cpu()
+
+    def _batch_compute_log_probs_with_shared_prefix(
+        self,
+        text_list: list[str],
+        prefix_list: list[str],
+    ) -> list[float] | None:
+        """Compute log probabilities by encoding each distinct prefix only once.
+
+        The key-value cache of each prefix is expanded over the texts sharing the prefix,
+        and only the continuation tokens are fed to the model.
+        Returns None if the input does not fit in the context of the model,
+        in which case the caller falls back to the sliding-window computation.
+        """
+        unique_prefix_list = list(dict.fromkeys(prefix_list))
+        prefix_id_map = {prefix: i for i, prefix in enumerate(unique_prefix_list)}
+        prefix_indices = torch.tensor([prefix_id_map[prefix] for prefix in prefix_list], dtype=torch.long)
+
+        prefix_encoding = tokenize_text_for_lm_prefix(
+            unique_prefix_list,
+            self._tokenizer,
+            add_special_tokens=self._add_special_tokens,
+        )
+        # If the last token is a special token, it is treated as a beginning of a new sentence.
+        unique_as_continuation = [
+            prefix_ids[-1] not in self._tokenizer.all_special_ids for prefix_ids in prefix_encoding.input_ids
+        ]
+        continuation_encoding = tokenize_text_for_lm_continuation(
+            text_list,
+            self._tokenizer,
+            as_continuation=[unique_as_continuation[i] for i in prefix_indices.tolist()],
+        )
+        continuation_ids = continuation_encoding.input_ids.long()
+        continuation_mask = continuation_encoding.attention_mask.long()
+
+        prefix_length = prefix_encoding.input_ids.size(1)
+        continuation_length = continuation_ids.size(1)
+        if prefix_length + continuation_length > self._model.config.max_position_embeddings:
+            return None
+
+        device = self._model.device
+        with self._get_amp_context():
+            prefix_mask = prefix_encoding.attention_mask.long().to(device)
+            # only the logits of the last prefix token are needed
+            with keep_last_logits(self._model, 1):
+                prefix_outputs = self._model.forward(
+                    input_ids=prefix_encoding.input_ids.long().to(device),
+                    attention_mask=prefix_mask,
+                    position_ids=get_position_ids(prefix_mask),
+                    use_cache=True,
+                )
+            prefix_indices = prefix_indices.to(device)
+            continuation_ids = continuation_ids.to(device)
+            continuation_mask = continuation_mask.to(device)
+            total_log_probs = torch.zeros(len(text_list), dtype=torch.float32, device=device)
+            if continuation_length == 0:
+                return total_log_probs.tolist()
+
+            # the last logits of the prefix predict the first token of the continuation
+            first_token_log_probs = F.log_softmax(prefix_outputs.logits[:, -1].float(), dim=-1)
+            first_token_log_probs = first_token_log_probs.index_select(0, prefix_indices)
+            total_log_probs += (
+                first_token_log_probs.gather(dim=-1, index=continuation_ids[:, :1]).squeeze(-1)
+                * continuation_mask[:, 0]
+            )
+            if continuation_length == 1:
+                return total_log_probs.tolist()
+
+            # feed the continuation tokens except the last one with the expanded prefix cache
+            attention_mask = torch.cat([prefix_mask.index_select(0, prefix_indices), continuation_mask], dim=1)
+            lm_outputs = self._model.forward(
+                input_ids=continuation_ids[:, :-1],
+                attention_mask=attention_mask[:, :-1],
+                position_ids=get_position_ids(attention_mask)[:, prefix_length:-1],
+                past_key_values=to_model_cache_format(
+                    self._model,
+                    select_past_key_values(prefix_outputs.past_key_values, prefix_indices),
+                ),
+                use_cache=True,
+            )
+            continuation_log_probs = gather_log_probs(lm_outputs.logits, continuation_ids[:, 1:])
+            total_log_probs += (continuation_log_probs * continuation_mask[:, 1:]).sum(dim=-1)
         return total_log_probs.tolist()
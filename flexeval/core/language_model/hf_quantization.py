@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from typing import Literal
+
+import torch
+import torch.nn.functional as F  # noqa: N812
+from transformers.pytorch_utils import Conv1D
+
+
+class WeightOnlyInt8Linear(torch.nn.Module):
+    """A linear layer that stores the weight in int8 with a scale for each output channel.
+
+    The activations stay in floating point.
+    On CPU, the matrix multiplication is done by the int8 kernel of PyTorch if it is available,
+    which reads a quarter of the memory of float32 weights.
+    Otherwise, the weight is dequantized on the fly.
+    """
+
+    def __init__(self, weight: torch.Tensor, bias: torch.Tensor | None) -> None:
+        super().__init__()
+        self.in_features = weight.size(1)
+        self.out_features = weight.size(0)
+
+        weight = weight.detach().float()
+        scales = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8)
+        int8_weight = torch.round(weight / scales.unsqueeze(1)).clamp(-128, 127).to(torch.int8)
+        self.register_buffer("int8_weight", int8_weight)
+        self.register_buffer("scales", scales)
+        self.bias = None if bias is None else torch.nn.Parameter(bias.detach(), requires_grad=False)
+
+    @classmethod
+    def from_linear(cls: type[WeightOnlyInt8Linear], linear: torch.nn.Linear) -> WeightOnlyInt8Linear:
+        return cls(linear.weight, linear.bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.device.type == "cpu" and hasattr(torch.ops.aten, "_weight_int8pack_mm"):
+            output = torch.ops.aten._weight_int8pack_mm(  # noqa: SLF001
+                x.reshape(-1, self.in_features).contiguous(),
+                self.int8_weight,
+                self.scales.to(x.dtype),
+            ).reshape(*x.shape[:-1], self.out_features)
+            if self.bias is not None:
+                output = output + self.bias.to(x.dtype)
+            return output
+
+        weight = self.int8_weight.to(x.dtype) * self.scales.to(x.dtype).unsqueeze(1)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def _to_linear(module: torch.nn.Linear | Conv1D) -> torch.nn.Linear:
+    """Convert the `Conv1D` layer of GPT-2 style models, which is a linear layer with a transposed weight."""
+    if isinstance(module, torch.nn.Linear):
+        return module
+    linear = torch.nn.Linear(
+        module.weight.size(0),
+        module.weight.size(1),
+        bias=module.bias is not None,
+        device=module.weight.device,
+        dtype=module.weight.dtype,
+    )
+    linear.weight.data = module.weight.data.t().contiguous()
+    if module.bias is not None:
+        linear.bias.data = module.bias.data
+    return linear
+
+
+def quantize_linear_layers(
+    model: torch.nn.Module,
+    method: Literal["dynamic_int8", "weight_only_int8"],
+    skip_modules: list[torch.nn.Module] | None = None,
+) -> int:
+    """Replace the `torch.nn.Linear` (and `Conv1D`) layers of the model with quantized ones in place.
+
+    Args:
+        model: The model to quantize.
+        method: `dynamic_int8` quantizes both the weights and the activations to int8 with
+            `torch.ao.quantization.quantize_dynamic`, which only runs on CPU with float32 activations.
+            `weight_only_int8` only quantizes the weights and works with any activation dtype.
+        skip_modules: The modules that are kept in floating point.
+            Defaults to the output embeddings of the model (i.e., the LM head whatever its name is),
+            because the logits are sensitive to quantization errors.
+
+    Returns:
+        The number of the quantized layers.
+    """
+    if method not in ("dynamic_int8", "weight_only_int8"):
+        msg = f"Invalid quantization method: {method}"
+        raise ValueError(msg)
+    if method == "dynamic_int8":
+        if any(param.device.type != "cpu" for param in model.parameters()):
+            msg = "dynamic_int8 quantization is only supported for models on CPU."
+            raise ValueError(msg)
+        if any(param.dtype != torch.float32 for param in model.parameters()):
+            msg = "dynamic_int8 quantization requires the model to be loaded in float32."
+            raise ValueError(msg)
+
+    if skip_modules is None:
+        output_embeddings = model.get_output_embeddings() if hasattr(model, "get_output_embeddings") else None
+        skip_modules = [] if output_embeddings is None else [output_embeddings]
+    # the modules are compared by identity, because the name of the LM head differs among models
+    skip_module_ids = {id(module) for module in skip_modules}
+    target_names = [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, (torch.nn.Linear, Conv1D)) and id(module) not in skip_module_ids
+    ]
+    for name in target_names:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = _to_linear(getattr(parent, child_name))
+        if method == "weight_only_int8":
+            linear = WeightOnlyInt8Linear.from_linear(linear)
+        setattr(parent, child_name, linear)
+
+    if method == "dynamic_int8":
+        from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+        quantize_dynamic(
+            model,
+            qconfig_spec={name: default_dynamic_qconfig for name in target_names},
+            dtype=torch.qint8,
+            inplace=True,
+        )
+    return len(target_names)
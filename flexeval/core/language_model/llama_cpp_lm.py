@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .base import LanguageModel
+from .hf_lm import normalize_stop_sequences
+
+
+class LlamaCppLM(LanguageModel):
+    """
+    LanguageModel implementation using llama.cpp through `llama-cpp-python`, which runs quantized GGUF models fast
+    on CPUs. Install it with the `llama_cpp` extra, e.g., `pip install flexeval[llama_cpp]`.
+
+    The inputs are processed one at a time, and the prompt tokens are evaluated in batches of `n_batch` tokens.
+    The texts are processed in sorted order, so that consecutive prompts share long prefixes
+    (e.g., few-shot examples) and only the tokens after the prefix shared with the previous prompt are evaluated.
+
+    Chat responses are generated with the chat template in the metadata of the GGUF file,
+    which is converted from the tokenizer of the original model.
+    Pass `chat_format` in `model_kwargs` to use one of the formats built into `llama-cpp-python` instead.
+
+    `batch_compute_log_probs` computes the log probabilities from the logits of every position,
+    which requires `logits_all=True` (the default here).
+    Set `model_kwargs={"logits_all": False}` to save memory when only generating text.
+
+    Args:
+        model_name: The path to a GGUF file, or the name of a repository on the Hugging Face Hub.
+        model_file: The file name (or a glob pattern) of the GGUF file in the repository,
+            e.g., `"*Q4_K_M.gguf"`. Required when `model_name` is a repository.
+        n_ctx: The context length. The prompt and the generated tokens must fit in it.
+        n_batch: The maximum number of prompt tokens evaluated in a single batch.
+        n_threads: The number of threads for generation. Defaults to the choice of llama.cpp.
+        n_threads_batch: The number of threads for evaluating the prompt. Defaults to the choice of llama.cpp.
+        model_kwargs: Additional keyword arguments to pass to `llama_cpp.Llama`.
+
+    Examples:
+        >>> flexeval_lm \\
+        ...   --language_model LlamaCppLM \\
+        ...   --language_model.model_name "Qwen/Qwen2-0.5B-Instruct-GGUF" \\
+        ...   --language_model.model_file "*q4_k_m.gguf" \\
+        ...   --language_model.n_threads 16 \\
+        ...   --eval_setup "commonsense_qa" \\
+        ...   --save_dir "results/commonsense_qa"
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        model_file: str | None = None,
+        n_ctx: int = 4096,
+        n_batch: int = 512,
+        n_threads: int | None = None,
+        n_threads_batch: int | None = None,
+        model_kwargs: dict[str, Any] | None = None,
+    ) -> None:
+        from llama_cpp import Llama
+
+        model_kwargs = {
+            "n_ctx": n_ctx,
+            "n_batch": n_batch,
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            "logits_all": True,
+            "verbose": False,
+            **(model_kwargs or {}),
+        }
+        self._logits_all = model_kwargs["logits_all"]
+        if Path(model_name).exists():
+            self._llm = Llama(model_path=model_name, **model_kwargs)
+        else:
+            if model_file is None:
+                msg = f"`model_file` must be specified to load the model from the repository `{model_name}`."
+                raise ValueError(msg)
+            self._llm = Llama.from_pretrained(repo_id=model_name, filename=model_file, **model_kwargs)
+
+    def _tokenize(self, text: str, add_bos: bool) -> list[int]:
+        return self._llm.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        return [len(self._tokenize(text, add_bos=False)) for text in text_list]
+
+    @staticmethod
+    def _prepare_generation_kwargs(
+        stop_sequences: str | list[str] | None,
+        max_new_tokens: int | None,
+        kwargs: dict[str, Any],
+    ) -> dict[str, Any]:
+        kwargs = kwargs.copy()  # avoid modifying the original kwargs
+
+        # use greedy decoding by default
+        if "temperature" not in kwargs:
+            kwargs["temperature"] = 0.0
+
+        if max_new_tokens is not None:
+            if "max_tokens" in kwargs:
+                msg = (
+                    "`max_new_tokens` will be normalized to `max_tokens` before fed into llama.cpp. "
+                    "You can not specify both."
+                )
+                raise ValueError(msg)
+            kwargs["max_tokens"] = max_new_tokens
+
+        # llama.cpp stops at the eos token by itself
+        kwargs["stop"] = normalize_stop_sequences(
+            stop_sequences=stop_sequences,
+            stop_from_kwargs=kwargs.pop("stop", None),
+        )
+        return kwargs
+
+    def batch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        kwargs = self._prepare_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        generated_texts = [""] * len(text_list)
+        for index in sorted(range(len(text_list)), key=lambda i: text_list[i]):
+            completion = self._llm.create_completion(prompt=text_list[index], **kwargs)
+            generated_texts[index] = completion["choices"][0]["text"]
+        return generated_texts
+
+    def batch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        kwargs = self._prepare_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        return [
+            self._llm.create_chat_completion(messages=chat_messages, **kwargs)["choices"][0]["message"]["content"]
+            for chat_messages in chat_messages_list
+        ]
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        """
+        Compute the log probabilities of the texts from the logits of each position.
+
+        The prefix and the text are tokenized together, and the tokens after the common part with the tokenized
+        prefix are counted as the text.
+        If the model does not add a bos token, it is prepended to compute the log probability of the first token.
+        """
+        if stride is not None:
+            msg = f"{self.__class__.__name__} does not support `stride`."
+            raise ValueError(msg)
+        if not self._logits_all:
+            msg = f"{self.__class__.__name__} requires `logits_all=True` to compute log probabilities."
+            raise ValueError(msg)
+
+        prefix_list = prefix_list or [""] * len(text_list)
+        total_log_probs = [0.0] * len(text_list)
+        for index in sorted(range(len(text_list)), key=lambda i: prefix_list[i] + text_list[i]):
+            total_log_probs[index] = self._compute_log_prob(text_list[index], prefix_list[index])
+        return total_log_probs
+
+    def _compute_log_prob(self, text: str, prefix: str) -> float:
+        prefix_ids = self._tokenize(prefix, add_bos=True)
+        input_ids = self._tokenize(prefix + text, add_bos=True)
+        if not prefix_ids:
+            prefix_ids = [self._llm.token_bos()]
+            input_ids = [self._llm.token_bos(), *input_ids]
+
+        num_common_tokens = 0
+        for prefix_id, input_id in zip(prefix_ids, input_ids):
+            if prefix_id != input_id:
+                break
+            num_common_tokens += 1
+        # the first token has no log probability
+        start_index = max(num_common_tokens, 1)
+        if start_index >= len(input_ids):
+            return 0.0
+
+        # Reuse the key-value cache of the prefix shared with the previously evaluated tokens as `Llama.generate` does.
+        # At least the last token is evaluated, and `eval` drops the cache after `n_tokens`.
+        num_cached_tokens = 0
+        for cached_id, input_id in zip(self._llm.input_ids[: self._llm.n_tokens].tolist(), input_ids[:-1]):
+            if cached_id != input_id:
+                break
+            num_cached_tokens += 1
+        self._llm.n_tokens = num_cached_tokens
+        self._llm.eval(input_ids[num_cached_tokens:])
+        # the logits at position i predict the token at position i + 1
+        logits = np.asarray(self._llm.scores[start_index - 1 : len(input_ids) - 1], dtype=np.float64)
+        max_logits = logits.max(axis=-1, keepdims=True)
+        log_normalizers = max_logits[:, 0] + np.log(np.exp(logits - max_logits).sum(axis=-1))
+        target_logits = logits[np.arange(len(logits)), input_ids[start_index:]]
+        return float((target_logits - log_normalizers).sum())
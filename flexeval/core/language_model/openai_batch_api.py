@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+from openai import AsyncOpenAI
+from openai.types import Batch
+
+logger = logging.getLogger(__name__)
+
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def load_batch_job_state(state_file: str | os.PathLike[str]) -> dict[str, str]:
+    """Load the map from the digest of the requests to the id of the submitted batch job."""
+    if not Path(state_file).exists():
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_batch_job_state(state_file: str | os.PathLike[str], state: dict[str, str]) -> None:
+    """Save the state atomically so that an interruption does not leave a broken file."""
+    Path(state_file).parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = Path(f"{state_file}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2)
+    tmp_file.replace(state_file)
+
+
+async def wait_for_batch_job(client: AsyncOpenAI, batch_id: str, poll_interval: float) -> Batch:
+    """Poll the batch job until it reaches a terminal status."""
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in BATCH_TERMINAL_STATUSES:
+            return batch
+        if batch.request_counts is not None:
+            logger.info(
+                f"Batch job {batch_id} is {batch.status}: "
+                f"{batch.request_counts.completed}/{batch.request_counts.total} completed.",
+            )
+        await asyncio.sleep(poll_interval)
+
+
+async def run_batch_job(
+    client: AsyncOpenAI,
+    endpoint: str,
+    request_bodies: list[dict[str, Any]],
+    state_file: str | os.PathLike[str] | None = None,
+    poll_interval: float = 60.0,
+) -> list[dict[str, Any] | None]:
+    """
+    Run the requests as a job of the OpenAI Batch API and return the response body of each request in order.
+    The response is None for the requests that failed.
+
+    If `state_file` is given, the id of the submitted job is saved with the digest of the requests,
+    and a later call with the same requests resumes polling the job instead of submitting a new one.
+
+    Args:
+        client: The OpenAI client.
+        endpoint: The endpoint of the requests, e.g., `/v1/chat/completions`.
+        request_bodies: The bodies of the requests.
+        state_file: The path to the file to save the ids of the submitted jobs.
+        poll_interval: The interval in seconds to check the status of the job.
+    """
+    input_lines = [
+        json.dumps({"custom_id": f"request-{i}", "method": "POST", "url": endpoint, "body": body}, ensure_ascii=False)
+        for i, body in enumerate(request_bodies)
+    ]
+    input_jsonl = "\n".join(input_lines) + "\n"
+    requests_digest = hashlib.sha256(input_jsonl.encode()).hexdigest()
+
+    state = load_batch_job_state(state_file) if state_file is not None else {}
+    batch_id = state.get(requests_digest)
+    if batch_id is None:
+        input_file = await client.files.create(file=("batch_input.jsonl", input_jsonl.encode()), purpose="batch")
+        batch = await client.batches.create(input_file_id=input_file.id, endpoint=endpoint, completion_window="24h")
+        batch_id = batch.id
+        logger.info(f"Submitted batch job {batch_id} with {len(input_lines)} requests.")
+        if state_file is not None:
+            state[requests_digest] = batch_id
+            save_batch_job_state(state_file, state)
+    else:
+        logger.info(f"Resume polling batch job {batch_id}.")
+
+    batch = await wait_for_batch_job(client, batch_id, poll_interval)
+    if batch.status != "completed":
+        msg = f"Batch job {batch_id} ended with status `{batch.status}`: {batch.errors}"
+        raise RuntimeError(msg)
+
+    response_bodies: list[dict[str, Any] | None] = [None] * len(request_bodies)
+    if batch.output_file_id is not None:
+        output_content = await client.files.content(batch.output_file_id)
+        for line in output_content.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                response_bodies[int(result["custom_id"].split("-")[-1])] = response["body"]
+    return response_bodies
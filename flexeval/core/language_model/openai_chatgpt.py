@@ -2,12 +2,19 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from typing import Awaitable, Callable, TypeVar
+import random
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Iterator, TypeVar
 
+import numpy as np
 import openai
-from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
 
+from .async_openai_runner import AsyncOpenAIRunner
 from .base import LanguageModel
+from .openai_batch_api import run_batch_job
+from .rate_limiter import RateLimiter, estimate_num_tokens, get_shared_rate_limiter, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +25,7 @@ async def _retry_on_error(
     openai_call: Callable[[], Awaitable[T]],
     max_num_trials: int = 5,
     first_wait_time: int = 10,
+    rate_limiter: RateLimiter | None = None,
 ) -> Awaitable[T] | None:
     for i in range(max_num_trials):
         try:
@@ -28,72 +36,288 @@ async def _retry_on_error(
             if i == max_num_trials - 1:
                 raise
             logger.info(f"エラーを受け取りました：{e}")
-            wait_time_seconds = first_wait_time * (2**i)
-            logger.info(f"{wait_time_seconds}秒待機します")
+            # サーバーが指定する待機時間を優先する
+            response = getattr(e, "response", None)
+            wait_time_seconds = parse_retry_after(response.headers) if response is not None else None
+            if wait_time_seconds is None:
+                wait_time_seconds = first_wait_time * (2**i)
+            # レート制限に達した場合は、同じ制限を共有する他のリクエストも待機させる
+            if rate_limiter is not None and isinstance(e, openai.RateLimitError):
+                rate_limiter.pause(wait_time_seconds)
+            # 並行するリクエストが一斉に再試行しないようにジッターを加える
+            wait_time_seconds *= random.uniform(1.0, 1.5)
+            logger.info(f"{wait_time_seconds:.1f}秒待機します")
             await asyncio.sleep(wait_time_seconds)
     return None
 
 
+def _normalize_generation_kwargs(
+    stop_sequences: str | list[str] | None,
+    max_new_tokens: int | None,
+    kwargs: dict[str, Any],
+) -> dict[str, Any]:
+    """Convert the arguments of `LanguageModel` into the parameters of the OpenAI API."""
+    if stop_sequences is not None:
+        if "stop" in kwargs:
+            msg = (
+                "You specified both `stop_sequences` and `stop` in generation kwargs. "
+                "However, `stop_sequences` will be normalized into `stop`. "
+                "Please specify only one of them."
+            )
+            raise ValueError(msg)
+        kwargs["stop"] = stop_sequences
+
+    if max_new_tokens is not None:
+        if "max_tokens" in kwargs:
+            msg = (
+                "You specified both `max_new_tokens` and `max_tokens` in generation kwargs. "
+                "However, `max_new_tokens` will be normalized into `max_tokens`. "
+                "Please specify only one of them."
+            )
+            raise ValueError(msg)
+        kwargs["max_tokens"] = max_new_tokens
+    return kwargs
+
+
 class OpenAIChatGPT(LanguageModel):
     """
     LanguageModel implementation using OpenAI's ChatGPT API.
 
+    The requests are sent from an event loop running in a background thread throughout the lifetime of the model,
+    so that the connection pool of the client is reused.
+    The evaluation passes the whole dataset to this model, and up to `max_concurrency` requests are in flight
+    at any time regardless of the batch size.
+
     Args:
         model_name: The name of the model to use.
         api_headers: A dictionary of headers to use when making requests to the OpenAI API.
+        max_concurrency: The maximum number of requests sent to the API at the same time.
+        requests_per_minute: The budget of requests per minute. No limit if None.
+        tokens_per_minute: The budget of tokens per minute. No limit if None.
+            The tokens of each request are estimated from the length of the messages and `max_tokens`,
+            and corrected with the actual usage returned by the API.
+        rate_limit_group: The models with the same group share the budgets in the process,
+            e.g., the evaluated model and an LLM judge using the same API quota.
+            Defaults to the model name.
+        request_timeout: The timeout in seconds of each request. A request that timed out is retried.
+        use_batch_api: Whether to send all the requests of each call as a job of the Batch API,
+            which is cheaper but takes time to complete.
+            The requests that failed in the job are sent again to the chat endpoint.
+        batch_api_state_file: The path to the file to save the ids of the submitted batch jobs.
+            An interrupted run with the same requests resumes polling the submitted job.
+            Delete the file to submit the requests again.
+        batch_api_poll_interval: The interval in seconds to check the status of the batch job.
+        stream: Whether to receive the responses as streams to measure the latency of each request.
+            The time to first token, the mean inter-token latency, the total latency, and the number of output tokens
+            of each request are saved with the outputs, and their percentiles are saved with the metrics.
+            This allows a run against a local OpenAI-compatible server to serve as a latency benchmark.
+
+    When the API responds with a rate limit error, all the requests sharing the budgets wait for
+    the time specified by the `Retry-After` header before they are retried.
     """
 
     def __init__(
         self,
         model_name: str = "gpt-3.5-turbo",
         api_headers: dict[str, str] | None = None,
+        max_concurrency: int = 16,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        rate_limit_group: str | None = None,
+        request_timeout: float | None = None,
+        use_batch_api: bool = False,
+        batch_api_state_file: str | None = None,
+        batch_api_poll_interval: float = 60.0,
+        stream: bool = False,
     ) -> None:
+        if stream and use_batch_api:
+            msg = "`stream` cannot be used with `use_batch_api`."
+            raise ValueError(msg)
         self._model_name = model_name
-        if api_headers is None:
-            api_headers = {}
-        self._client = AsyncOpenAI(**api_headers)
+        self._rate_limiter: RateLimiter | None = None
+        if requests_per_minute is not None or tokens_per_minute is not None:
+            self._rate_limiter = get_shared_rate_limiter(
+                rate_limit_group or model_name,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+            )
+        self._request_timeout = request_timeout
+        self._use_batch_api = use_batch_api
+        self._batch_api_state_file = batch_api_state_file
+        self._batch_api_poll_interval = batch_api_poll_interval
+        self._stream = stream
+        # the latencies are recorded in the event loop and read after the requests finish
+        self._latency_records: list[dict[str, Any]] = []
+        self._instance_stats: dict[int, dict[str, Any]] = {}
+        self._runner = AsyncOpenAIRunner(api_headers, max_concurrency=max_concurrency)
 
-    async def _async_batch_run_chatgpt(
+    async def _async_chat_completion(
         self,
-        messages_list: list[list[dict[str, str]]],
-        stop_sequences: str | list[str] | None = None,
-        max_new_tokens: int | None = None,
+        messages: list[dict[str, str]],
+        request_index: int | None = None,
         **kwargs,
-    ) -> list[str]:
-        """Send multiple chat requests to the OpenAI in parallel."""
-        if stop_sequences is not None:
-            if "stop" in kwargs:
-                msg = (
-                    "You specified both `stop_sequences` and `stop` in generation kwargs. "
-                    "However, `stop_sequences` will be normalized into `stop`. "
-                    "Please specify only one of them."
-                )
-                raise ValueError(msg)
-            kwargs["stop"] = stop_sequences
-
-        if max_new_tokens is not None:
-            if "max_tokens" in kwargs:
-                msg = (
-                    "You specified both `max_new_tokens` and `max_tokens` in generation kwargs. "
-                    "However, `max_new_tokens` will be normalized into `max_tokens`. "
-                    "Please specify only one of them."
-                )
-                raise ValueError(msg)
-            kwargs["max_tokens"] = max_new_tokens
-
-        tasks = [
-            _retry_on_error(
-                # Define an anonymous function with a lambda expression and pass it,
-                # and call it inside the _retry_on_error function
-                openai_call=lambda x=ms: self._client.chat.completions.create(
+    ) -> ChatCompletion:
+        """Send a chat request. In the streaming mode, the latency is recorded with `request_index`."""
+        if self._request_timeout is not None:
+            kwargs = {"timeout": self._request_timeout, **kwargs}
+        # the API counts `max_tokens` of every choice against the budget of tokens when the request is received
+        num_estimated_tokens = sum(estimate_num_tokens(message["content"]) for message in messages) + (
+            kwargs.get("max_tokens") or 0
+        ) * kwargs.get("n", 1)
+
+        async def _rate_limited_call() -> ChatCompletion:
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire(num_estimated_tokens)
+            if self._stream:
+                response, latency = await self._streaming_chat_completion(messages, **kwargs)
+                self._latency_records.append(latency)
+                if request_index is not None:
+                    self._instance_stats[request_index] = latency
+            else:
+                response = await self._runner.client.chat.completions.create(
                     model=self._model_name,
-                    messages=x,
+                    messages=messages,
                     **kwargs,
-                ),
-            )
-            for ms in messages_list
+                )
+            if self._rate_limiter is not None and response.usage is not None:
+                self._rate_limiter.adjust_tokens(response.usage.total_tokens - num_estimated_tokens)
+            return response
+
+        async with self._runner.semaphore:
+            return await _retry_on_error(openai_call=_rate_limited_call, rate_limiter=self._rate_limiter)
+
+    async def _streaming_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+        **kwargs,
+    ) -> tuple[ChatCompletion, dict[str, Any]]:
+        """Receive the response as a stream, and return the merged response and the latency of the request."""
+        start_time = time.perf_counter()
+        stream = await self._runner.client.chat.completions.create(
+            model=self._model_name,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs,
+        )
+        contents: dict[int, list[str]] = defaultdict(list)
+        finish_reasons: dict[int, str | None] = {}
+        chunk_times: list[float] = []
+        response_body: dict[str, Any] = {"object": "chat.completion", "usage": None}
+        async for chunk in stream:
+            response_body.update(id=chunk.id, created=chunk.created, model=chunk.model)
+            if chunk.usage is not None:
+                response_body["usage"] = chunk.usage.model_dump()
+            for choice in chunk.choices:
+                finish_reasons.setdefault(choice.index, None)
+                if choice.delta.content:
+                    contents[choice.index].append(choice.delta.content)
+                    chunk_times.append(time.perf_counter())
+                if choice.finish_reason is not None:
+                    finish_reasons[choice.index] = choice.finish_reason
+        end_time = time.perf_counter()
+
+        response_body["choices"] = [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": "".join(contents[index])},
+                "finish_reason": finish_reasons[index],
+            }
+            for index in sorted(finish_reasons)
         ]
-        return await asyncio.gather(*tasks)
+        # a chunk may contain multiple tokens, so the number of tokens is taken from the usage if available
+        usage = response_body["usage"]
+        num_output_tokens = usage["completion_tokens"] if usage is not None else len(chunk_times)
+        latency: dict[str, Any] = {
+            "time_to_first_token": (chunk_times[0] if chunk_times else end_time) - start_time,
+            "inter_token_latency": None,
+            "latency": end_time - start_time,
+            "num_output_tokens": num_output_tokens,
+        }
+        if num_output_tokens > 1 and chunk_times:
+            latency["inter_token_latency"] = (chunk_times[-1] - chunk_times[0]) / (num_output_tokens - 1)
+        return ChatCompletion.construct(**response_body), latency
+
+    async def _async_batch_job_chat_completions(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[ChatCompletion]:
+        """Send the chat requests as a batch job and map the results back to the requests."""
+        response_bodies = await run_batch_job(
+            self._runner.client,
+            "/v1/chat/completions",
+            [{"model": self._model_name, "messages": messages, **kwargs} for messages in messages_list],
+            state_file=self._batch_api_state_file,
+            poll_interval=self._batch_api_poll_interval,
+        )
+        failed_indices = [i for i, body in enumerate(response_bodies) if body is None]
+        if failed_indices:
+            logger.warning(f"{len(failed_indices)} requests failed in the batch job. Sending them to the endpoint.")
+        retried_responses = await asyncio.gather(
+            *[self._async_chat_completion(messages_list[i], **kwargs) for i in failed_indices],
+        )
+        responses = [body and ChatCompletion.construct(**body) for body in response_bodies]
+        for i, response in zip(failed_indices, retried_responses):
+            responses[i] = response
+        return responses
+
+    def _iter_chat_completions(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, ChatCompletion]]:
+        """Send the chat requests concurrently and yield `(index, response)` as each request finishes."""
+        kwargs = _normalize_generation_kwargs(
+            kwargs.pop("stop_sequences", None),
+            kwargs.pop("max_new_tokens", None),
+            kwargs,
+        )
+        self._instance_stats.clear()
+        if self._use_batch_api:
+            if messages_list:
+                yield from enumerate(
+                    self._runner.run(self._async_batch_job_chat_completions(messages_list, **kwargs)),
+                )
+            return
+
+        yield from self._runner.iter_as_completed(
+            [
+                self._async_chat_completion(messages, request_index=index, **kwargs)
+                for index, messages in enumerate(messages_list)
+            ],
+        )
+
+    def _run_chat_completions(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[ChatCompletion]:
+        responses: list[ChatCompletion | None] = [None] * len(messages_list)
+        for index, response in self._iter_chat_completions(messages_list, **kwargs):
+            responses[index] = response
+        return responses
+
+    async def _arun_chat_completions(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[ChatCompletion]:
+        """Send the chat requests from the background event loop and wait for them in the caller's event loop."""
+        kwargs = _normalize_generation_kwargs(
+            kwargs.pop("stop_sequences", None),
+            kwargs.pop("max_new_tokens", None),
+            kwargs,
+        )
+        if not messages_list:
+            return []
+
+        async def _run_all() -> list[ChatCompletion]:
+            if self._use_batch_api:
+                return await self._async_batch_job_chat_completions(messages_list, **kwargs)
+            return list(await asyncio.gather(*[self._async_chat_completion(m, **kwargs) for m in messages_list]))
+
+        return await self._runner.arun(_run_all())
 
     def batch_complete_text(
         self,
@@ -103,22 +327,136 @@ class OpenAIChatGPT(LanguageModel):
         **kwargs,
     ) -> list[str]:
         messages_list = [[{"role": "user", "content": text}] for text in text_list]
-        api_responses = asyncio.run(
-            self._async_batch_run_chatgpt(
-                messages_list,
-                stop_sequences=stop_sequences,
-                max_new_tokens=max_new_tokens,
-                **kwargs,
-            ),
+        api_responses = self._run_chat_completions(
+            messages_list,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
         )
         return [res.choices[0].message.content for res in api_responses]
 
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        messages_list = [[{"role": "user", "content": text}] for text in text_list]
+        for index, res in self._iter_chat_completions(
+            messages_list,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        ):
+            yield index, res.choices[0].message.content
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        """Generate `num_samples` responses for each text in a single request with the `n` parameter,
+        so that the input tokens are billed only once.
+        """
+        messages_list = [[{"role": "user", "content": text}] for text in text_list]
+        api_responses = self._run_chat_completions(
+            messages_list,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            n=num_samples,
+            **kwargs,
+        )
+        return [
+            [choice.message.content for choice in sorted(res.choices, key=lambda choice: choice.index)]
+            for res in api_responses
+        ]
+
     def batch_generate_chat_response(
         self,
         chat_messages_list: list[list[dict[str, str]]],
         **kwargs,
     ) -> list[str]:
-        api_responses = asyncio.run(
-            self._async_batch_run_chatgpt(chat_messages_list, **kwargs),
+        api_responses = self._run_chat_completions(chat_messages_list, **kwargs)
+        return [res.choices[0].message.content for res in api_responses]
+
+    def iter_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        for index, res in self._iter_chat_completions(chat_messages_list, **kwargs):
+            yield index, res.choices[0].message.content
+
+    async def abatch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        api_responses = await self._arun_chat_completions(
+            [[{"role": "user", "content": text}] for text in text_list],
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
         )
         return [res.choices[0].message.content for res in api_responses]
+
+    async def abatch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        api_responses = await self._arun_chat_completions(
+            [[{"role": "user", "content": text}] for text in text_list],
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            n=num_samples,
+            **kwargs,
+        )
+        return [
+            [choice.message.content for choice in sorted(res.choices, key=lambda choice: choice.index)]
+            for res in api_responses
+        ]
+
+    async def abatch_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> list[str]:
+        api_responses = await self._arun_chat_completions(chat_messages_list, **kwargs)
+        return [res.choices[0].message.content for res in api_responses]
+
+    def prefers_whole_dataset(self) -> bool:
+        return True
+
+    def get_stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = {}
+        for key in ["time_to_first_token", "inter_token_latency", "latency"]:
+            values = [record[key] for record in self._latency_records if record[key] is not None]
+            if not values:
+                continue
+            for percentile in [50, 90, 99]:
+                stats[f"{key}_p{percentile}"] = float(np.percentile(values, percentile))
+        if self._latency_records:
+            num_output_tokens = [record["num_output_tokens"] for record in self._latency_records]
+            stats["num_output_tokens_mean"] = sum(num_output_tokens) / len(num_output_tokens)
+        return stats
+
+    def reset_stats(self) -> None:
+        self._latency_records = []
+
+    def pop_instance_stats(self) -> dict[int, dict[str, Any]]:
+        # the stats are popped one by one because the event loop may add new ones concurrently
+        return {index: self._instance_stats.pop(index) for index in list(self._instance_stats)}
+
+    def close(self) -> None:
+        """Close the client and stop the background event loop."""
+        self._runner.close()
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from typing import Any, Callable, Iterator
+
+from openai.types import Completion
+from openai.types.completion_choice import Logprobs
+from transformers import AutoTokenizer, PreTrainedTokenizer
+
+from .async_openai_runner import AsyncOpenAIRunner
+from .base import LanguageModel
+from .hf_lm import tokenize_prefix_and_continuation_ids
+from .openai_chatgpt import _normalize_generation_kwargs, _retry_on_error
+
+# one token is generated because some servers reject `max_tokens=0`, and it is excluded by its offset
+_LOG_PROB_REQUEST_KWARGS: dict[str, Any] = {"echo": True, "logprobs": 0, "max_tokens": 1, "temperature": 0.0}
+
+
+class OpenAICompletionLM(LanguageModel):
+    """
+    LanguageModel implementation for the completions endpoint of OpenAI-compatible servers, e.g., vLLM or TGI.
+
+    Unlike `OpenAIChatGPT`, the prompts are sent as raw text without a chat template,
+    and the log probabilities are computed from the prompt tokens returned with the `echo` and `logprobs` parameters.
+    The requests are sent concurrently from an event loop running in a background thread,
+    so that the connection pool of the client is reused throughout the lifetime of the model.
+
+    Args:
+        model_name: The name of the model served by the server.
+        api_headers: A dictionary of headers to use when making requests to the API, e.g., `base_url` and `api_key`.
+        max_concurrency: The maximum number of requests sent to the server at the same time.
+            Note that the log probabilities are computed for each batch of the evaluation,
+            so `batch_size` should be large enough to keep the server busy.
+        request_timeout: The timeout in seconds of each request. A request that timed out is retried.
+        tokenizer: The name of the tokenizer of the served model. If specified, the prompts to compute
+            log probabilities are sent as token ids tokenized in the same way as `HuggingFaceLM`,
+            so that the boundary between the prefix and the text is exactly the same.
+            Otherwise, the prompts are sent as text and the boundary is determined by the character offsets.
+        tokenizer_kwargs: Keyword arguments for the tokenizer instantiation by `from_pretrained()`.
+        add_special_tokens: Whether to add special tokens to the prefixes tokenized by `tokenizer`.
+
+    Examples:
+        >>> flexeval_lm \\
+        ...   --language_model OpenAICompletionLM \\
+        ...   --language_model.model_name "sbintuitions/tiny-lm" \\
+        ...   --language_model.api_headers.base_url "http://localhost:8000/v1" \\
+        ...   --language_model.api_headers.api_key "EMPTY" \\
+        ...   --eval_setup "commonsense_qa" \\
+        ...   --eval_setup.batch_size 64 \\
+        ...   --save_dir "results/commonsense_qa"
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        api_headers: dict[str, str] | None = None,
+        max_concurrency: int = 16,
+        request_timeout: float | None = None,
+        tokenizer: str | None = None,
+        tokenizer_kwargs: dict[str, Any] | None = None,
+        add_special_tokens: bool = False,
+    ) -> None:
+        self._model_name = model_name
+        self._request_timeout = request_timeout
+        self._tokenizer: PreTrainedTokenizer | None = None
+        if tokenizer is not None:
+            self._tokenizer = AutoTokenizer.from_pretrained(tokenizer, **(tokenizer_kwargs or {}))
+        self._add_special_tokens = add_special_tokens
+        self._runner = AsyncOpenAIRunner(api_headers, max_concurrency=max_concurrency)
+
+    async def _async_completion(self, prompt: str | list[int], **kwargs) -> Completion:
+        if self._request_timeout is not None:
+            kwargs = {"timeout": self._request_timeout, **kwargs}
+        async with self._runner.semaphore:
+            return await _retry_on_error(
+                openai_call=lambda: self._runner.client.completions.create(
+                    model=self._model_name,
+                    prompt=prompt,
+                    **kwargs,
+                ),
+            )
+
+    def _iter_completions(self, prompts: list[str], **kwargs) -> Iterator[tuple[int, Completion]]:
+        """Send the completion requests concurrently and yield `(index, response)` as each request finishes."""
+        return self._runner.iter_as_completed([self._async_completion(prompt, **kwargs) for prompt in prompts])
+
+    def _run_completions(self, prompts: list[str] | list[list[int]], **kwargs) -> list[Completion]:
+        return self._runner.run_all([self._async_completion(prompt, **kwargs) for prompt in prompts])
+
+    async def _arun_completions(self, prompts: list[str] | list[list[int]], **kwargs) -> list[Completion]:
+        """Send the completion requests from the background event loop and wait for them in the caller's event loop."""
+
+        async def _run_all() -> list[Completion]:
+            return list(await asyncio.gather(*[self._async_completion(prompt, **kwargs) for prompt in prompts]))
+
+        return await self._runner.arun(_run_all())
+
+    def batch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        kwargs = _normalize_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        return [res.choices[0].text for res in self._run_completions(text_list, **kwargs)]
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        kwargs = _normalize_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        for index, res in self._iter_completions(text_list, **kwargs):
+            yield index, res.choices[0].text
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        kwargs = _normalize_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        return [
+            [choice.text for choice in sorted(res.choices, key=lambda choice: choice.index)]
+            for res in self._run_completions(text_list, n=num_samples, **kwargs)
+        ]
+
+    async def abatch_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[str]:
+        kwargs = _normalize_generation_kwargs(stop_sequences, max_new_tokens, kwargs)
+        return [res.choices[0].text for res in await self._arun_completions(text_list, **kwargs)]
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        """
+        Compute the log probabilities of the texts from the prompt tokens echoed back by the server.
+
+        If `tokenizer` is specified, the log probabilities of the tokens of the text are summed up.
+        Otherwise, the prefix and the text are concatenated and tokenized by the server,
+        and the tokens ending within the text are counted by their character offsets,
+        so a token crossing the boundary is counted as part of the text.
+        The first token of the prompt has no log probability,
+        so an empty prefix relies on the server adding a bos token.
+        """
+        prompts, sum_log_probs_fns = self._build_log_prob_requests(text_list, prefix_list, stride)
+        responses = self._run_completions(prompts, **_LOG_PROB_REQUEST_KWARGS)
+        return [sum_log_probs(response) for sum_log_probs, response in zip(sum_log_probs_fns, responses)]
+
+    async def abatch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        prompts, sum_log_probs_fns = self._build_log_prob_requests(text_list, prefix_list, stride)
+        responses = await self._arun_completions(prompts, **_LOG_PROB_REQUEST_KWARGS)
+        return [sum_log_probs(response) for sum_log_probs, response in zip(sum_log_probs_fns, responses)]
+
+    def _build_log_prob_requests(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None,
+        stride: int | None,
+    ) -> tuple[list[str] | list[list[int]], list[Callable[[Completion], float]]]:
+        """Build the prompts and the functions to sum up the log probabilities of the text from each response."""
+        if stride is not None:
+            msg = f"{self.__class__.__name__} does not support `stride`."
+            raise ValueError(msg)
+        if self._tokenizer is not None:
+            prefix_ids_list, continuation_ids_list = tokenize_prefix_and_continuation_ids(
+                text_list,
+                prefix_list,
+                self._tokenizer,
+                add_special_tokens=self._add_special_tokens,
+            )
+            return (
+                [
+                    prefix_ids + continuation_ids
+                    for prefix_ids, continuation_ids in zip(prefix_ids_list, continuation_ids_list)
+                ],
+                [
+                    functools.partial(self._sum_token_log_probs, len(prefix_ids), len(continuation_ids))
+                    for prefix_ids, continuation_ids in zip(prefix_ids_list, continuation_ids_list)
+                ],
+            )
+        prefix_list = prefix_list or [""] * len(text_list)
+        prompts = [prefix + text for prefix, text in zip(prefix_list, text_list)]
+        return prompts, [
+            functools.partial(self._sum_text_log_probs, len(prefix), len(prompt))
+            for prefix, prompt in zip(prefix_list, prompts)
+        ]
+
+    @staticmethod
+    def _get_prompt_logprobs(response: Completion) -> Logprobs:
+        logprobs = response.choices[0].logprobs
+        if logprobs is None or logprobs.token_logprobs is None or logprobs.text_offset is None:
+            msg = "The server did not return the log probabilities of the prompt."
+            raise RuntimeError(msg)
+        return logprobs
+
+    @staticmethod
+    def _sum_token_log_probs(num_prefix_tokens: int, num_text_tokens: int, response: Completion) -> float:
+        """Sum up the log probabilities of the `num_text_tokens` prompt tokens following the prefix."""
+        token_logprobs = OpenAICompletionLM._get_prompt_logprobs(response).token_logprobs
+        text_logprobs = token_logprobs[num_prefix_tokens : num_prefix_tokens + num_text_tokens]
+        if len(text_logprobs) != num_text_tokens or None in text_logprobs:
+            msg = f"The server did not return the log probabilities of all the tokens of the text: {text_logprobs}"
+            raise RuntimeError(msg)
+        return sum(text_logprobs)
+
+    @staticmethod
+    def _sum_text_log_probs(prefix_length: int, prompt_length: int, response: Completion) -> float:
+        """Sum up the log probabilities of the prompt tokens ending after `prefix_length` characters."""
+        logprobs = OpenAICompletionLM._get_prompt_logprobs(response)
+        text_offset = logprobs.text_offset
+        # a token ends where the next token starts, and the generated token starts at the end of the prompt
+        token_ends = [*text_offset[1:], prompt_length]
+        total_log_prob = 0.0
+        for start, end, token_logprob in zip(text_offset, token_ends, logprobs.token_logprobs):
+            if start >= prompt_length or end <= prefix_length:
+                continue
+            if token_logprob is None:
+                msg = (
+                    f"The server did not return the log probability of the token at offset {start} in the text. "
+                    "The first token of the prompt has no log probability, so specify a non-empty prefix "
+                    "or `tokenizer` to prepend the bos token."
+                )
+                raise RuntimeError(msg)
+            total_log_prob += token_logprob
+        return total_log_prob
+
+    def prefers_whole_dataset(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        """Close the client and stop the background event loop."""
+        self._runner.close()
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+
+class _TokenBucket:
+    """A bucket that holds up to `capacity` units and refills at `capacity` units per minute.
+
+    The level can go negative so that a reservation larger than the capacity only delays the caller.
+    """
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = capacity
+        self.level = capacity
+        self.refill_rate = capacity / 60.0
+        self.last_refill_time = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.last_refill_time) * self.refill_rate)
+        self.last_refill_time = now
+
+    def take(self, amount: float) -> float:
+        """Take `amount` units and return the seconds until the level is no longer negative."""
+        self.level -= amount
+        return max(0.0, -self.level / self.refill_rate)
+
+
+class RateLimiter:
+    """
+    A thread-safe token-bucket rate limiter for the requests to an API.
+
+    Each request reserves one request and its estimated number of tokens from the budgets per minute,
+    and waits until both budgets are available.
+    The budgets are computed under a lock and the caller sleeps in its own event loop,
+    so the limiter can be shared among the models running in different threads.
+
+    Args:
+        requests_per_minute: The budget of requests per minute. No limit if None.
+        tokens_per_minute: The budget of tokens per minute. No limit if None.
+    """
+
+    def __init__(self, requests_per_minute: float | None = None, tokens_per_minute: float | None = None) -> None:
+        for name, value in [("requests_per_minute", requests_per_minute), ("tokens_per_minute", tokens_per_minute)]:
+            if value is not None and value <= 0:
+                msg = f"{name} must be positive, but got {value}."
+                raise ValueError(msg)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_bucket = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, num_tokens: int = 0) -> float:
+        """Reserve a request with `num_tokens` tokens and return the seconds to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            wait_time = max(0.0, self._paused_until - now)
+            if self._request_bucket is not None:
+                self._request_bucket.refill(now)
+                wait_time = max(wait_time, self._request_bucket.take(1))
+            if self._token_bucket is not None:
+                self._token_bucket.refill(now)
+                wait_time = max(wait_time, self._token_bucket.take(num_tokens))
+            return wait_time
+
+    async def acquire(self, num_tokens: int = 0) -> None:
+        """Wait until a request with `num_tokens` tokens can be sent."""
+        wait_time = self.reserve(num_tokens)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def adjust_tokens(self, num_tokens: int) -> None:
+        """Correct the reserved tokens by `num_tokens` when the actual usage is known after the request."""
+        if self._token_bucket is None:
+            return
+        with self._lock:
+            self._token_bucket.refill(time.monotonic())
+            self._token_bucket.take(num_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Hold all the requests for `seconds`, e.g., when the API asks to retry after a while."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_shared_rate_limiters: dict[str, RateLimiter] = {}
+_shared_rate_limiters_lock = threading.Lock()
+
+
+def get_shared_rate_limiter(
+    name: str,
+    requests_per_minute: float | None = None,
+    tokens_per_minute: float | None = None,
+) -> RateLimiter:
+    """Return the `RateLimiter` shared by the models with the same `name` in this process.
+
+    This lets, e.g., the evaluated model and the LLM judge calling the same API stay within one quota.
+    """
+    with _shared_rate_limiters_lock:
+        if name not in _shared_rate_limiters:
+            _shared_rate_limiters[name] = RateLimiter(requests_per_minute, tokens_per_minute)
+        rate_limiter = _shared_rate_limiters[name]
+    if (rate_limiter.requests_per_minute, rate_limiter.tokens_per_minute) != (requests_per_minute, tokens_per_minute):
+        msg = (
+            f"The rate limiter `{name}` is already configured with "
+            f"requests_per_minute={rate_limiter.requests_per_minute} "
+            f"and tokens_per_minute={rate_limiter.tokens_per_minute}."
+        )
+        raise ValueError(msg)
+    return rate_limiter
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> float | None:
+    """Return the seconds to wait from the `retry-after-ms` or `retry-after` header, or None if not given."""
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # the header can also be an HTTP date
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_num_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in the text without a tokenizer.
+
+    A quarter of the UTF-8 bytes is close to the number of tokens of the OpenAI tokenizers
+    both for English (about 4 characters per token) and Japanese (3 bytes per character).
+    """
+    return len(text.encode("utf-8")) // 4 + 1
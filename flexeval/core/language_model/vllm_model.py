@@ -1,11 +1,27 @@
 from __future__ import annotations
 
-from typing import Any
+import inspect
+import itertools
+from typing import Any, Iterator
 
 from transformers import AutoTokenizer, PreTrainedTokenizer
 
 from .base import LanguageModel
-from .hf_lm import normalize_stop_sequences
+from .hf_lm import normalize_stop_sequences, tokenize_prefix_and_continuation_ids
+
+
+def add_request_to_engine(
+    engine: Any,  # noqa: ANN401
+    request_id: str,
+    prompt_token_ids: list[int],
+    sampling_params: Any,  # noqa: ANN401
+) -> None:
+    """Add a tokenized prompt to `vllm.LLMEngine`, absorbing the change of `add_request()` among the versions."""
+    if "prompt_token_ids" in inspect.signature(engine.add_request).parameters:
+        # vllm<0.4.3 takes the prompt text and token ids separately
+        engine.add_request(request_id, None, sampling_params, prompt_token_ids=prompt_token_ids)
+    else:
+        engine.add_request(request_id, {"prompt_token_ids": prompt_token_ids}, sampling_params)
 
 
 class VllmModel(LanguageModel):
@@ -21,6 +37,14 @@ class VllmModel(LanguageModel):
             Note that whether BOS or EOS tokens are added depends on the tokenizer.
         custom_chat_template: A custom chat template for chatbot models.
             If specified, this overrides the default chat template of the tokenizer.
+
+    The evaluation passes the whole dataset to this model so that the scheduler of vLLM keeps as many sequences
+    in flight as possible, and the generated texts are streamed back as they finish.
+
+    `batch_compute_log_probs` is computed from the prompt logprobs of vLLM.
+    vLLM does not compute the prompt logprobs at the positions served from its prefix cache,
+    so `batch_compute_log_probs` is not supported with `model_kwargs={"enable_prefix_caching": True}`.
+    To share the prefix among the choices of a multiple-choice question, use `HuggingFaceLM` with `reuse_prefix_cache`.
     """
 
     def __init__(
@@ -42,6 +66,19 @@ class VllmModel(LanguageModel):
 
         model_kwargs = model_kwargs or {}
         self._llm = LLM(model_name, trust_remote_code=True, **model_kwargs)
+        self._request_counter = itertools.count()
+
+    def count_tokens(self, text_list: list[str]) -> list[int]:
+        model_inputs = self._tokenizer(
+            text_list,
+            add_special_tokens=self._add_special_tokens,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+        )
+        return [len(input_ids) for input_ids in model_inputs.input_ids]
+
+    def prefers_whole_dataset(self) -> bool:
+        return True
 
     def batch_complete_text(
         self,
@@ -50,6 +87,23 @@ class VllmModel(LanguageModel):
         max_new_tokens: int | None = None,
         **kwargs,
     ) -> list[str]:
+        generated_texts = [""] * len(text_list)
+        for index, generated_text in self.iter_complete_text(
+            text_list,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        ):
+            generated_texts[index] = generated_text
+        return generated_texts
+
+    def _prepare_sampling_kwargs(
+        self,
+        stop_sequences: str | list[str] | None,
+        max_new_tokens: int | None,
+        kwargs: dict[str, Any],
+    ) -> tuple[dict[str, Any], list[str]]:
+        """Return the keyword arguments for `SamplingParams` except `stop` and the normalized stop sequences."""
         kwargs = kwargs.copy()  # avoid modifying the original kwargs
 
         # use greedy decoding by default
@@ -72,6 +126,56 @@ class VllmModel(LanguageModel):
             eos_token=self._tokenizer.eos_token,
             ignore_eos=kwargs.get("ignore_eos", False),
         )
+        return kwargs, stop_sequences
+
+    def iter_complete_text(
+        self,
+        text_list: list[str],
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        for index, generated_texts in self._iter_engine_outputs(
+            text_list,
+            num_samples=1,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            kwargs=kwargs,
+        ):
+            yield index, generated_texts[0]
+
+    def batch_complete_text_samples(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None = None,
+        max_new_tokens: int | None = None,
+        **kwargs,
+    ) -> list[list[str]]:
+        """Generate `num_samples` continuations for each text with the `n` option of `SamplingParams`,
+        which lets the samples share the key-value cache of the prompt.
+        """
+        samples_list: list[list[str]] = [[] for _ in text_list]
+        for index, generated_texts in self._iter_engine_outputs(
+            text_list,
+            num_samples=num_samples,
+            stop_sequences=stop_sequences,
+            max_new_tokens=max_new_tokens,
+            kwargs=kwargs,
+        ):
+            samples_list[index] = generated_texts
+        return samples_list
+
+    def _iter_engine_outputs(
+        self,
+        text_list: list[str],
+        num_samples: int,
+        stop_sequences: str | list[str] | None,
+        max_new_tokens: int | None,
+        kwargs: dict[str, Any],
+    ) -> Iterator[tuple[int, list[str]]]:
+        """Submit all the texts to the engine and yield `(index, generated_texts)` as each request finishes."""
+        kwargs, stop_sequences = self._prepare_sampling_kwargs(stop_sequences, max_new_tokens, kwargs)
 
         model_inputs = self._tokenizer(
             text_list,
@@ -81,29 +185,60 @@ class VllmModel(LanguageModel):
 
         from vllm import SamplingParams
 
-        vllm_outputs = self._llm.generate(
-            prompt_token_ids=model_inputs.input_ids,
-            sampling_params=SamplingParams(**kwargs, stop=stop_sequences),
-            use_tqdm=False,
-        )
-        generated_texts = [self._tokenizer.decode(outputs.outputs[0].token_ids) for outputs in vllm_outputs]
-
-        # The `include_stop_str_in_output` option does not work, because we let llm generate tokens, not strings.
-        # We manually remove the stop sequences from the generated texts.
-        if not kwargs.get("include_stop_str_in_output", False):
-            for stop in stop_sequences:
-                for i, gen_text in enumerate(generated_texts):
-                    stop_index = gen_text.find(stop)
-                    if stop_index != -1:
-                        generated_texts[i] = gen_text[:stop_index]
-        return generated_texts
+        # Submit all the requests to the engine and let its scheduler batch them.
+        sampling_params = SamplingParams(**kwargs, n=num_samples, stop=stop_sequences)
+        engine = self._llm.llm_engine
+        request_id_to_index: dict[str, int] = {}
+        for index, prompt_token_ids in enumerate(model_inputs.input_ids):
+            request_id = str(next(self._request_counter))
+            add_request_to_engine(engine, request_id, prompt_token_ids, sampling_params)
+            request_id_to_index[request_id] = index
+
+        try:
+            while engine.has_unfinished_requests():
+                for request_output in engine.step():
+                    if not request_output.finished:
+                        continue
+                    generated_texts = [self._tokenizer.decode(output.token_ids) for output in request_output.outputs]
+
+                    # The `include_stop_str_in_output` option does not work,
+                    # because we let llm generate tokens, not strings.
+                    # We manually remove the stop sequences from the generated texts.
+                    if not kwargs.get("include_stop_str_in_output", False):
+                        generated_texts = [
+                            self._remove_stop_sequences(generated_text, stop_sequences)
+                            for generated_text in generated_texts
+                        ]
+                    yield request_id_to_index.pop(request_output.request_id), generated_texts
+        finally:
+            # abort the remaining requests when the caller stops consuming the results
+            if request_id_to_index:
+                engine.abort_request(list(request_id_to_index))
+
+    @staticmethod
+    def _remove_stop_sequences(generated_text: str, stop_sequences: list[str]) -> str:
+        for stop in stop_sequences:
+            stop_index = generated_text.find(stop)
+            if stop_index != -1:
+                generated_text = generated_text[:stop_index]
+        return generated_text
 
     def batch_generate_chat_response(
         self,
         chat_messages_list: list[list[dict[str, str]]],
         **kwargs,
     ) -> list[str]:
-        chat_messages_as_string = [
+        return self.batch_complete_text(self._apply_chat_template(chat_messages_list), **kwargs)
+
+    def iter_generate_chat_response(
+        self,
+        chat_messages_list: list[list[dict[str, str]]],
+        **kwargs,
+    ) -> Iterator[tuple[int, str]]:
+        yield from self.iter_complete_text(self._apply_chat_template(chat_messages_list), **kwargs)
+
+    def _apply_chat_template(self, chat_messages_list: list[list[dict[str, str]]]) -> list[str]:
+        return [
             self._tokenizer.apply_chat_template(
                 chat_messages,
                 tokenize=False,
@@ -112,4 +247,51 @@ class VllmModel(LanguageModel):
             )
             for chat_messages in chat_messages_list
         ]
-        return self.batch_complete_text(chat_messages_as_string, **kwargs)
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        if stride is not None:
+            msg = f"{self.__class__.__name__} does not support `stride`."
+            raise ValueError(msg)
+        cache_config = getattr(self._llm.llm_engine, "cache_config", None)
+        if getattr(cache_config, "enable_prefix_caching", False):
+            msg = (
+                f"{self.__class__.__name__} does not support `batch_compute_log_probs` with `enable_prefix_caching`, "
+                "because vLLM does not return the prompt logprobs at the positions served from the prefix cache."
+            )
+            raise ValueError(msg)
+
+        prefix_ids_list, continuation_ids_list = tokenize_prefix_and_continuation_ids(
+            text_list,
+            prefix_list,
+            self._tokenizer,
+            add_special_tokens=self._add_special_tokens,
+        )
+
+        from vllm import SamplingParams
+
+        # `prompt_logprobs=0` returns only the log probabilities of the prompt tokens themselves
+        vllm_outputs = self._llm.generate(
+            prompt_token_ids=[
+                prefix_ids + continuation_ids
+                for prefix_ids, continuation_ids in zip(prefix_ids_list, continuation_ids_list)
+            ],
+            sampling_params=SamplingParams(max_tokens=1, prompt_logprobs=0),
+            use_tqdm=False,
+        )
+
+        total_log_probs: list[float] = []
+        for prefix_ids, continuation_ids, outputs in zip(prefix_ids_list, continuation_ids_list, vllm_outputs):
+            total_log_prob = 0.0
+            for position, token_id in enumerate(continuation_ids, start=len(prefix_ids)):
+                token_log_probs = outputs.prompt_logprobs[position]
+                if not token_log_probs or token_id not in token_log_probs:
+                    msg = f"The prompt logprob at position {position} is not returned by vLLM."
+                    raise RuntimeError(msg)
+                total_log_prob += token_log_probs[token_id].logprob
+            total_log_probs.append(total_log_prob)
+        return total_log_probs
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from collections import Counter
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Callable
 
 
 @dataclass
@@ -43,3 +44,39 @@ class Metric(ABC):
             task_inputs_list: List of task inputs.
         """
         raise NotImplementedError
+
+    def evaluate_samples(
+        self,
+        lm_output_samples: list[list[str]],
+        references_list: list[list[str]],
+        task_inputs_list: list[dict[str, str]] | None = None,
+    ) -> MetricResult:
+        """
+        Evaluate multiple outputs of `LanguageModel` for each instance.
+
+        The default implementation takes the majority vote of the samples (self-consistency)
+        and evaluates the voted outputs with `evaluate()`.
+        The samples are grouped by `get_voting_key()`.
+        Metrics that use all the samples, such as pass@k, should override this.
+
+        Args:
+            lm_output_samples: List of the model outputs for each instance.
+            references_list: List of reference outputs.
+            task_inputs_list: List of task inputs.
+        """
+        voted_outputs = [majority_vote(samples, key=self.get_voting_key) for samples in lm_output_samples]
+        return self.evaluate(voted_outputs, references_list, task_inputs_list)
+
+    def get_voting_key(self, lm_output: str) -> str:
+        """
+        Return the key to group the equivalent outputs in the majority vote.
+        Metrics with a normalizer should return the normalized output, e.g., the extracted final answer.
+        """
+        return lm_output
+
+
+def majority_vote(samples: list[str], key: Callable[[str], str]) -> str:
+    """Return the first sample among the ones with the most frequent key."""
+    keys = [key(sample) for sample in samples]
+    most_common_key, _ = Counter(keys).most_common(1)[0]
+    return samples[keys.index(most_common_key)]
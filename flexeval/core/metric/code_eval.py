@@ -21,14 +21,18 @@ class CodeEval(Metric):
         code_prompt_template: A Jinja2 template string that will prepend the generated code.
             The template should contain variables that will be replaced with the values in `task_inputs_list`.
             If `None`, the code prompt will be the generated code itself.
+        k: The values of k to compute pass@k with multiple samples per instance in `evaluate_samples()`.
+            Each k must not exceed the number of samples.
+            Defaults to 1 and the number of samples.
     """
 
-    def __init__(self, code_prompt_template: str | None = None) -> None:
+    def __init__(self, code_prompt_template: str | None = None, k: list[int] | None = None) -> None:
         self._code_prompt_template = None
         if code_prompt_template is not None:
             self._code_prompt_template = JINJA2_ENV.from_string(
                 code_prompt_template,
             )
+        self._k = k
         self._code_eval = evaluate.load("code_eval")
 
     def evaluate(
@@ -37,40 +41,80 @@ class CodeEval(Metric):
         references_list: list[list[str]],
         task_inputs_list: list[dict[str, str]] | None = None,
     ) -> MetricResult:
+        pass_at_k, results_list = self._run_test_cases(
+            [[lm_output] for lm_output in lm_outputs],
+            references_list,
+            task_inputs_list,
+            k=[1],
+        )
+        # we only have one candidate code per instance, so we take the first result
+        return MetricResult(pass_at_k, instance_details=[results[0] for results in results_list])
+
+    def evaluate_samples(
+        self,
+        lm_output_samples: list[list[str]],
+        references_list: list[list[str]],
+        task_inputs_list: list[dict[str, str]] | None = None,
+    ) -> MetricResult:
+        """Compute the unbiased estimate of pass@k from all the samples of each instance."""
+        num_samples = min(len(samples) for samples in lm_output_samples)
+        k = self._k or sorted({1, num_samples})
+        pass_at_k, results_list = self._run_test_cases(lm_output_samples, references_list, task_inputs_list, k=k)
+        instance_details = [
+            {
+                "num_passed": sum(result["passed"] for result in results),
+                "passed": [result["passed"] for result in results],
+                "result": [result["result"] for result in results],
+            }
+            for results in results_list
+        ]
+        return MetricResult(pass_at_k, instance_details=instance_details)
+
+    def _run_test_cases(
+        self,
+        lm_output_samples: list[list[str]],
+        references_list: list[list[str]],
+        task_inputs_list: list[dict[str, str]] | None,
+        k: list[int],
+    ) -> tuple[dict[str, float], list[list[dict[str, Any]]]]:
+        """Run the test cases on every sample and return pass@k and the results of the samples of each instance."""
         if task_inputs_list is None:
-            task_inputs_list = [{} for _ in lm_outputs]
+            task_inputs_list = [{} for _ in lm_output_samples]
 
-        generated_functions: list[str] = []
+        generated_functions_list: list[list[str]] = []
         test_case_list: list[str] = []
         # in code generation tasks, references_list contains the test cases
-        for lm_output, task_inputs, test_cases in zip(
-            lm_outputs,
+        for samples, task_inputs, test_cases in zip(
+            lm_output_samples,
             task_inputs_list,
             references_list,
         ):
-            generated_function = lm_output
+            code_prompt = ""
             if self._code_prompt_template is not None:
-                generated_function = self._code_prompt_template.render(**task_inputs) + lm_output
+                code_prompt = self._code_prompt_template.render(**task_inputs)
 
-            generated_functions.append(generated_function)
+            generated_functions_list.append([code_prompt + lm_output for lm_output in samples])
             test_case_list.append("\n".join(test_cases))
         pass_at_k, results = self._code_eval.compute(
             references=test_case_list,
-            predictions=[[f] for f in generated_functions],
-            k=[1],
+            predictions=generated_functions_list,
+            k=k,
         )
 
         # `results` contain the detailed results for each test case
         # e.g., {0: [(0, {'task_id': 0, 'passed': False, 'result': "failed", 'completion_id': 0})]}
         results: dict[int, list[tuple[int, dict[str, Any]]]]
 
-        instance_details: list[dict[str, Any]] = []
-        for i in range(len(lm_outputs)):
-            first_result = results[i][0]  # we only assume one candidate code per instance, so we take the first result
-            _, detail_result = first_result  # the first element is just the index so we ignore it
-            # remove unnecessary fields to save space
-            detail_result.pop("completion_id")
-            detail_result.pop("task_id")
-            instance_details.append(detail_result)
-
-        return MetricResult(pass_at_k, instance_details=instance_details)
+        results_list: list[list[dict[str, Any]]] = []
+        for i in range(len(lm_output_samples)):
+            # the results of the samples are not always in order
+            detail_results = sorted(
+                (detail_result for _, detail_result in results[i]),
+                key=lambda r: r["completion_id"],
+            )
+            for detail_result in detail_results:
+                # remove unnecessary fields to save space
+                detail_result.pop("completion_id")
+                detail_result.pop("task_id")
+            results_list.append(detail_results)
+        return pass_at_k, results_list
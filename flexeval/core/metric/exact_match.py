@@ -16,6 +16,11 @@ class ExactMatch(Metric):
     def __init__(self, normalizer: Normalizer | None = None) -> None:
         self.normalizer = normalizer
 
+    def get_voting_key(self, lm_output: str) -> str:
+        if self.normalizer:
+            return self.normalizer.normalize(lm_output)
+        return lm_output
+
     def evaluate(
         self,
         lm_outputs: list[str],
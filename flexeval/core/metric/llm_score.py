@@ -9,6 +9,16 @@ from flexeval.core.utils.data_util import batch_iter
 from .base import Metric, MetricResult
 
 
+def get_evaluator_batch_size(language_model: LanguageModel, batch_size: int, num_inputs: int) -> int:
+    """Return the batch size to feed the inputs to the evaluator.
+
+    Models that schedule the requests by themselves (e.g., API models with a rate limiter) receive all the inputs.
+    """
+    if language_model.prefers_whole_dataset():
+        return max(num_inputs, 1)
+    return batch_size
+
+
 class LLMScore(Metric):
     """Let LanguageModel to evaluate the output of another LanguageModel.
 
@@ -69,7 +79,7 @@ class LLMScore(Metric):
         evaluator_output_list: list[str] = []
         for batch_evaluator_input in batch_iter(
             evaluator_input_list,
-            batch_size=self._batch_size,
+            batch_size=get_evaluator_batch_size(self._language_model, self._batch_size, len(evaluator_input_list)),
         ):
             evaluator_outputs = self._language_model.batch_complete_text(
                 batch_evaluator_input,
@@ -160,7 +170,7 @@ class ChatLLMScore(Metric):
         evaluator_output_list: list[str] = []
         for batch_inputs in batch_iter(
             evaluator_input_list,
-            batch_size=self._batch_size,
+            batch_size=get_evaluator_batch_size(self._language_model, self._batch_size, len(evaluator_input_list)),
         ):
             evaluator_outputs = self._language_model.batch_generate_chat_response(
                 batch_inputs,
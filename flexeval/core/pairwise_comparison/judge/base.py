@@ -53,3 +53,10 @@ class PairwiseJudge(ABC):
         Args:
             batch_model_items: A list of tuples, each containing two model items.
         """
+
+    def prefers_whole_dataset(self) -> bool:
+        """
+        Whether the judge should be given all the matches at once in `batch_judge`,
+        e.g., when its language model schedules the requests by itself.
+        """
+        return False
@@ -80,3 +80,6 @@ class ChatLLMPairwiseJudge(PairwiseJudge):
             input_chat_messages_list.append(input_chat_messages)
         judge_outputs = self._language_model.batch_generate_chat_response(input_chat_messages_list)
         return [self._parse_judge_output(output) for output in judge_outputs]
+
+    def prefers_whole_dataset(self) -> bool:
+        return self._language_model.prefers_whole_dataset()
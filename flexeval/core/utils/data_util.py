@@ -36,3 +36,66 @@ def batch_iter(iterable: Iterable[T], batch_size: int) -> Iterator[list[T]]:
             batch = []
     if len(batch) > 0:
         yield batch
+
+
+def token_budget_batch_indices(
+    lengths: list[int],
+    max_tokens: int,
+    max_batch_size: int | None = None,
+    num_rows: list[int] | None = None,
+) -> list[list[int]]:
+    """
+    Groups items into batches so that the padded size of each batch does not exceed a token budget.
+
+    Items are sorted by length in descending order so that items of similar length share a batch.
+    The cost of a batch is estimated as the total number of rows times the length of its longest item,
+    which is the number of tokens the batch occupies after padding.
+
+    Args:
+        lengths (list[int]): The number of tokens of each item.
+        max_tokens (int): The maximum number of tokens (including padding) per batch.
+            An item that exceeds the budget by itself is put into its own batch.
+        max_batch_size (int | None): The maximum number of items per batch.
+        num_rows (list[int] | None): The number of rows each item occupies in a batch,
+            e.g., the number of choices in a multiple-choice instance. Defaults to 1 for all items.
+
+    Returns:
+        list[list[int]]: Batches of indices into `lengths`.
+
+    Raises:
+        ValueError: If max_tokens or max_batch_size is less than 1.
+
+    Examples:
+        >>> token_budget_batch_indices([1, 5, 2, 4], max_tokens=8)
+        [[1], [3, 2], [0]]
+    """
+
+    if max_tokens < 1:
+        msg = "max_tokens must be at least 1"
+        raise ValueError(msg)
+    if max_batch_size is not None and max_batch_size < 1:
+        msg = "max_batch_size must be at least 1"
+        raise ValueError(msg)
+    num_rows = num_rows or [1] * len(lengths)
+    if len(num_rows) != len(lengths):
+        msg = "The length of num_rows must be the same as the length of lengths."
+        raise ValueError(msg)
+
+    sorted_indices = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_rows = 0
+    for index in sorted_indices:
+        if batch:
+            # items are sorted, so the first item is the longest in the batch
+            padded_size = (batch_rows + num_rows[index]) * lengths[batch[0]]
+            if padded_size > max_tokens or len(batch) == max_batch_size:
+                batches.append(batch)
+                batch = []
+                batch_rows = 0
+        batch.append(index)
+        batch_rows += num_rows[index]
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
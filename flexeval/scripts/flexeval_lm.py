@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
@@ -24,6 +25,9 @@ from flexeval import (
     PromptTemplate,
     TextDataset,
     Tokenizer,
+    aevaluate_chat_response,
+    aevaluate_generation,
+    aevaluate_multiple_choice,
     evaluate_chat_response,
     evaluate_generation,
     evaluate_multiple_choice,
@@ -68,6 +72,8 @@ class ChatResponse(EvalSetup):
     gen_kwargs: dict[str, Any]
     metrics: list[Metric] | Metric | None = None
     batch_size: int = 4
+    max_tokens_per_batch: int | None = None
+    max_batches_in_flight: int | None = None
 
     def evaluate_lm(
         self,
@@ -77,13 +83,17 @@ class ChatResponse(EvalSetup):
         if isinstance(metrics, Metric):
             metrics = [metrics]
 
-        return evaluate_chat_response(
-            language_model=language_model,
-            gen_kwargs=self.gen_kwargs,
-            eval_dataset=self.eval_dataset,
-            metrics=metrics,
-            batch_size=self.batch_size,
-        )
+        kwargs = {
+            "language_model": language_model,
+            "gen_kwargs": self.gen_kwargs,
+            "eval_dataset": self.eval_dataset,
+            "metrics": metrics,
+            "batch_size": self.batch_size,
+            "max_tokens_per_batch": self.max_tokens_per_batch,
+        }
+        if self.max_batches_in_flight is not None:
+            return asyncio.run(aevaluate_chat_response(**kwargs, max_batches_in_flight=self.max_batches_in_flight))
+        return evaluate_chat_response(**kwargs)
 
 
 @dataclass
@@ -94,6 +104,9 @@ class Generation(EvalSetup):
     few_shot_generator: FewShotGenerator | None = None
     metrics: list[Metric] | Metric | None = None
     batch_size: int = 4
+    max_tokens_per_batch: int | None = None
+    num_samples: int = 1
+    max_batches_in_flight: int | None = None
 
     def evaluate_lm(
         self,
@@ -103,15 +116,20 @@ class Generation(EvalSetup):
         if isinstance(metrics, Metric):
             metrics = [metrics]
 
-        return evaluate_generation(
-            language_model=language_model,
-            gen_kwargs=self.gen_kwargs,
-            eval_dataset=self.eval_dataset,
-            prompt_template=self.prompt_template,
-            few_shot_generator=self.few_shot_generator,
-            metrics=metrics,
-            batch_size=self.batch_size,
-        )
+        kwargs = {
+            "language_model": language_model,
+            "gen_kwargs": self.gen_kwargs,
+            "eval_dataset": self.eval_dataset,
+            "prompt_template": self.prompt_template,
+            "few_shot_generator": self.few_shot_generator,
+            "metrics": metrics,
+            "batch_size": self.batch_size,
+            "max_tokens_per_batch": self.max_tokens_per_batch,
+            "num_samples": self.num_samples,
+        }
+        if self.max_batches_in_flight is not None:
+            return asyncio.run(aevaluate_generation(**kwargs, max_batches_in_flight=self.max_batches_in_flight))
+        return evaluate_generation(**kwargs)
 
 
 @dataclass
@@ -120,18 +138,24 @@ class MultipleChoice(EvalSetup):
     prompt_template: PromptTemplate
     few_shot_generator: FewShotGenerator | None = None
     batch_size: int = 4
+    max_tokens_per_batch: int | None = None
+    max_batches_in_flight: int | None = None
 
     def evaluate_lm(
         self,
         language_model: LanguageModel,
     ) -> tuple[dict[str, float], list[dict[str, Any]] | None]:
-        return evaluate_multiple_choice(
-            language_model=language_model,
-            eval_dataset=self.eval_dataset,
-            prompt_template=self.prompt_template,
-            few_shot_generator=self.few_shot_generator,
-            batch_size=self.batch_size,
-        )
+        kwargs = {
+            "language_model": language_model,
+            "eval_dataset": self.eval_dataset,
+            "prompt_template": self.prompt_template,
+            "few_shot_generator": self.few_shot_generator,
+            "batch_size": self.batch_size,
+            "max_tokens_per_batch": self.max_tokens_per_batch,
+        }
+        if self.max_batches_in_flight is not None:
+            return asyncio.run(aevaluate_multiple_choice(**kwargs, max_batches_in_flight=self.max_batches_in_flight))
+        return evaluate_multiple_choice(**kwargs)
 
 
 @dataclass
@@ -139,6 +163,7 @@ class Perplexity(EvalSetup):
     eval_dataset: TextDataset
     batch_size: int = 4
     tokenizer: Tokenizer | None = None
+    max_tokens_per_batch: int | None = None
 
     def evaluate_lm(
         self,
@@ -149,10 +174,30 @@ class Perplexity(EvalSetup):
             eval_dataset=self.eval_dataset,
             batch_size=self.batch_size,
             tokenizer=self.tokenizer,
+            max_tokens_per_batch=self.max_tokens_per_batch,
         )
         return metrics, None
 
 
+def run_eval_setup(
+    eval_setup: EvalSetup,
+    language_model: LanguageModel,
+    language_model_load_time: float | None,
+) -> tuple[dict[str, Any], list[dict[str, Any]] | None]:
+    """Run the evaluation and add the elapsed time and the statistics of the language model to the metrics.
+
+    The load time of the language model is added only if the model was loaded for this evaluation.
+    """
+    language_model.reset_stats()
+    with Timer() as timer:
+        metrics, outputs = eval_setup.evaluate_lm(language_model=language_model)
+    metrics["elapsed_time"] = timer.time
+    if language_model_load_time is not None:
+        metrics["language_model_load_time"] = language_model_load_time
+    metrics.update(language_model.get_stats())
+    return metrics, outputs
+
+
 def as_dict(self: Namespace) -> dict[str, Any]:
     """Converts the nested namespaces into nested dictionaries.
 
@@ -211,6 +256,13 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
         default={},
         help="Metadata to save in config.json",
     )
+    parser.add_argument(
+        "--server",
+        type=str,
+        default=None,
+        help="Path to the socket of a `flexeval_serve` daemon. "
+        "If specified, the evaluation runs in the daemon, which keeps the language model and the datasets loaded.",
+    )
 
     config_preset_directory = os.environ.get(
         "PRESET_CONFIG_EVAL_DIR",
@@ -236,7 +288,13 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
 
     config_dict = as_dict(args)  # this will be used to save the config
 
-    args = parser.instantiate_classes(args)
+    # The language model is instantiated after checking if the results already exist,
+    # so that the model is not loaded when all the evaluation setups are skipped.
+    language_model_config = args.pop("language_model")
+    # the daemon instantiates the evaluation setups by itself, so the datasets are not loaded here
+    if args.server is None:
+        args = parser.instantiate_classes(args)
+    language_model: LanguageModel | None = None
 
     # normalize the format of eval_setups (a single object or a dict of objects) to a list of tuples
     eval_setups_and_metadata: list[list[EvalSetup | str, dict, Path | None]] = []
@@ -250,7 +308,8 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
 
         # Parse the main arguments.
         for setup_name, eval_setup in args.eval_setup.items():
-            if "." in setup_name:
+            # `__path__` is the path to the config file, which remains when the classes are not instantiated
+            if "." in setup_name or setup_name == "__path__":
                 continue
 
             eval_config_dict = config_dict["eval_setup"][setup_name]
@@ -263,7 +322,12 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
                 if eval_config_path is None:
                     msg = f"Invalid eval_setup: {eval_setup}"
                     raise ValueError(msg)
-                eval_setup = instantiate_module_from_path(eval_config_path, EvalSetup, overrides[setup_name])  # noqa: PLW2901
+                if args.server is None:
+                    eval_setup = instantiate_module_from_path(  # noqa: PLW2901
+                        eval_config_path,
+                        EvalSetup,
+                        overrides[setup_name],
+                    )
 
                 # replace config_dict to save with the content of the resolved config file
                 eval_config_dict = as_dict(get_args_from_path(eval_config_path, EvalSetup, overrides[setup_name]))
@@ -284,7 +348,8 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
             if eval_config_path is None:
                 msg = f"Invalid eval_setup: {eval_setup}"
                 raise ValueError(msg)
-            eval_setups_and_metadata[i][0] = instantiate_module_from_path(eval_config_path, EvalSetup)
+            if args.server is None:
+                eval_setups_and_metadata[i][0] = instantiate_module_from_path(eval_config_path, EvalSetup)
 
             # replace config_dict to save with the content of the resolved config file
             eval_config_dict = json.loads(_jsonnet.evaluate_file(eval_config_path))
@@ -320,13 +385,24 @@ def main() -> None:  # noqa: C901, PLR0912, PLR0915
                     f"Overwriting the existing file: {save_dir / CONFIG_FILE_NAME}",
                 )
 
-        try:
+        # the load time is reported only with the setup that loaded the model
+        language_model_load_time: float | None = None
+        if args.server is None and language_model is None:
             with Timer() as timer:
-                metrics, outputs = eval_setup.evaluate_lm(
-                    language_model=args.language_model,
-                )
-            metrics["elapsed_time"] = timer.time
-            logger.info(f"Elapsed time: {timer.time:.2f} sec")
+                language_model = parser.instantiate_classes(
+                    Namespace(language_model=language_model_config),
+                ).language_model
+            language_model_load_time = timer.time
+            logger.info(f"Language model load time: {language_model_load_time:.2f} sec")
+
+        try:
+            if args.server is not None:
+                from .flexeval_serve import evaluate_on_server
+
+                metrics, outputs = evaluate_on_server(args.server, config_dict["language_model"], eval_setup_config)
+            else:
+                metrics, outputs = run_eval_setup(eval_setup, language_model, language_model_load_time)
+            logger.info(f"Elapsed time: {metrics['elapsed_time']:.2f} sec")
 
             if save_dir is not None:
                 save_json(metrics, save_dir / METRIC_FILE_NAME)
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator
+
+from jsonargparse import ArgumentParser
+
+from flexeval import LanguageModel
+
+from .common import Timer
+from .flexeval_lm import EvalSetup, as_dict, run_eval_setup
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "~/.cache/flexeval/serve.sock"
+# the outputs are sent in chunks so that a large evaluation does not produce a single huge message
+OUTPUTS_CHUNK_SIZE = 1000
+
+
+def _send_message(f: BinaryIO, message: dict[str, Any]) -> None:
+    f.write(json.dumps(message, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+    f.flush()
+
+
+def _parse_module_config(config: dict[str, Any], module_type: type) -> tuple[ArgumentParser, Any]:
+    parser = ArgumentParser(parser_mode="jsonnet")
+    parser.add_argument("--module", type=module_type, required=True)
+    return parser, parser.parse_object({"module": config})
+
+
+def _instantiate_module(parser: ArgumentParser, args: Any) -> Any:  # noqa: ANN401
+    return parser.instantiate_classes(args).module
+
+
+def _resolve_relative_paths(config: Any, cwd: str) -> Any:  # noqa: ANN401
+    """Replace the strings in the config that are relative paths of existing files under `cwd` with absolute paths."""
+    if isinstance(config, dict):
+        return {key: _resolve_relative_paths(value, cwd) for key, value in config.items()}
+    if isinstance(config, list):
+        return [_resolve_relative_paths(value, cwd) for value in config]
+    if isinstance(config, str) and config and not Path(config).is_absolute() and (Path(cwd) / config).exists():
+        return str((Path(cwd) / config).resolve())
+    return config
+
+
+def _parse_module_config_in(config: dict[str, Any], module_type: type, cwd: str) -> tuple[ArgumentParser, Any]:
+    """Parse the config with the relative paths resolved against the working directory of the client.
+
+    The config is parsed again after resolving the paths, so that the relative paths in the default values,
+    e.g., the files of the preset configs, are also resolved.
+    """
+    _, args = _parse_module_config(config, module_type)
+    return _parse_module_config(_resolve_relative_paths(as_dict(args)["module"], cwd), module_type)
+
+
+def _make_cache_key(args: Any) -> str:  # noqa: ANN401
+    # The configs are normalized by parsing, so that the same module is found regardless of the default values.
+    # The working directory is not included, because the relative paths are resolved beforehand
+    # and a model on the hub should be reused by the clients in any directory.
+    return json.dumps(as_dict(args)["module"], sort_keys=True, default=str)
+
+
+@contextlib.contextmanager
+def _working_directory(path: str) -> Iterator[None]:
+    """Change the working directory temporarily, which is safe because the jobs are run one at a time."""
+    original_path = Path.cwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(original_path)
+
+
+def _is_listening(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+class EvaluationServer(socketserver.UnixStreamServer):
+    """
+    A daemon that keeps the language models and the evaluation setups loaded between the evaluation jobs.
+
+    The language models are kept up to `max_language_models`, and the least recently used one is released
+    when another model is requested.
+    The evaluation setups, including their datasets, are kept for each distinct config.
+    The relative paths of existing files in the configs are resolved against the working directory of the client
+    before looking up the loaded modules, so the same model is reused by the clients in different directories.
+    The jobs are run one at a time in the order they arrive,
+    in the working directory of the client so that the other relative paths are also resolved as in local runs.
+    """
+
+    def __init__(self, socket_path: str, max_language_models: int = 1) -> None:
+        if max_language_models < 1:
+            msg = f"max_language_models must be a positive integer, but got {max_language_models}."
+            raise ValueError(msg)
+        self.max_language_models = max_language_models
+        self.language_models: OrderedDict[str, LanguageModel] = OrderedDict()
+        self.eval_setups: dict[str, EvalSetup] = {}
+
+        path = Path(socket_path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            if _is_listening(path):
+                msg = f"Another server is already listening on {path}."
+                raise RuntimeError(msg)
+            logger.info(f"Removing the stale socket: {path}")
+            path.unlink()
+        # the server instantiates any class in the configs, so only the owner is allowed to connect,
+        # and the permission is set by umask so that the socket is never accessible by others after `bind`
+        original_umask = os.umask(0o177)
+        try:
+            super().__init__(str(path), EvaluationRequestHandler)
+        finally:
+            os.umask(original_umask)
+
+    def get_language_model(self, config: dict[str, Any], cwd: str) -> tuple[LanguageModel, float | None]:
+        """Return the language model and its load time, which is None if the model was already loaded."""
+        parser, args = _parse_module_config_in(config, LanguageModel, cwd)
+        key = _make_cache_key(args)
+        if key in self.language_models:
+            self.language_models.move_to_end(key)
+            return self.language_models[key], None
+
+        while len(self.language_models) >= self.max_language_models:
+            _, evicted_model = self.language_models.popitem(last=False)
+            logger.info(f"Releasing the language model: {evicted_model.__class__.__name__}")
+            if hasattr(evicted_model, "close"):
+                evicted_model.close()
+        with Timer() as timer:
+            language_model = _instantiate_module(parser, args)
+        logger.info(f"Language model load time: {timer.time:.2f} sec")
+        self.language_models[key] = language_model
+        return language_model, timer.time
+
+    def get_eval_setup(self, config: dict[str, Any], cwd: str) -> EvalSetup:
+        parser, args = _parse_module_config_in(config, EvalSetup, cwd)
+        key = _make_cache_key(args)
+        if key not in self.eval_setups:
+            self.eval_setups[key] = _instantiate_module(parser, args)
+        return self.eval_setups[key]
+
+    def server_close(self) -> None:
+        super().server_close()
+        Path(self.server_address).unlink(missing_ok=True)
+
+
+class EvaluationRequestHandler(socketserver.StreamRequestHandler):
+    """Run an evaluation job and send back the outputs in chunks, followed by the metrics.
+
+    Nothing is sent until the evaluation of the setup finishes, so the progress is only shown in the server log.
+    The client submits each evaluation setup as a separate job, so the results of a suite arrive setup by setup.
+
+    A job is a JSON line with the configs of `language_model` and `eval_setup`, and the working directory `cwd`.
+    The responses are JSON lines of `{"outputs": [...]}`, and finally `{"metrics": {...}, "has_outputs": bool}`.
+    If the evaluation fails, `{"error": "traceback"}` is sent instead.
+    """
+
+    server: EvaluationServer
+
+    def handle(self) -> None:
+        request = json.loads(self.rfile.readline())
+        cwd = request["cwd"]
+        try:
+            with _working_directory(cwd):
+                language_model, language_model_load_time = self.server.get_language_model(
+                    request["language_model"],
+                    cwd,
+                )
+                eval_setup = self.server.get_eval_setup(request["eval_setup"], cwd)
+                logger.info(f"Evaluating with the setup: {request['eval_setup']}")
+                metrics, outputs = run_eval_setup(eval_setup, language_model, language_model_load_time)
+        except Exception:  # noqa: BLE001
+            error = traceback.format_exc()
+            logger.warning(f"Error in evaluation:\n{error}")
+            _send_message(self.wfile, {"error": error})
+            return
+        logger.info(f"Elapsed time: {metrics['elapsed_time']:.2f} sec")
+
+        for i in range(0, len(outputs or []), OUTPUTS_CHUNK_SIZE):
+            _send_message(self.wfile, {"outputs": outputs[i : i + OUTPUTS_CHUNK_SIZE]})
+        _send_message(self.wfile, {"metrics": metrics, "has_outputs": outputs is not None})
+
+
+def evaluate_on_server(
+    socket_path: str,
+    language_model_config: dict[str, Any],
+    eval_setup_config: dict[str, Any],
+) -> tuple[dict[str, Any], list[dict[str, Any]] | None]:
+    """Submit an evaluation job to a `flexeval_serve` daemon and wait for the metrics and the outputs."""
+    outputs: list[dict[str, Any]] = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(Path(socket_path).expanduser()))
+        with sock.makefile("rwb") as f:
+            _send_message(
+                f,
+                {"language_model": language_model_config, "eval_setup": eval_setup_config, "cwd": str(Path.cwd())},
+            )
+            for line in f:
+                message = json.loads(line)
+                if "error" in message:
+                    msg = f"The evaluation failed in the server:\n{message['error']}"
+                    raise RuntimeError(msg)
+                if "outputs" in message:
+                    outputs += message["outputs"]
+                    continue
+                return message["metrics"], outputs if message["has_outputs"] else None
+    msg = "The server closed the connection before sending the metrics."
+    raise ConnectionError(msg)
+
+
+def main() -> None:
+    parser = ArgumentParser(parser_mode="jsonnet")
+    parser.add_argument(
+        "--socket_path",
+        type=str,
+        default=DEFAULT_SOCKET_PATH,
+        help="Path to the Unix domain socket to listen on. Pass the same path to `flexeval_lm --server`.",
+    )
+    parser.add_argument(
+        "--max_language_models",
+        type=int,
+        default=1,
+        help="The maximum number of language models kept loaded at the same time.",
+    )
+    args = parser.parse_args()
+
+    with EvaluationServer(args.socket_path, max_language_models=args.max_language_models) as server:
+        logger.info(f"Listening on {server.server_address}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down the server.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from pytest_mock import MockerFixture
+
+from flexeval.core.language_model import CachedLanguageModel
+from tests.dummy_modules import DummyLanguageModel
+
+
+def test_only_the_cache_misses_are_sent_to_the_wrapped_model(tmp_path: Path, mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    spy = mocker.spy(language_model, "batch_complete_text")
+    cached_lm = CachedLanguageModel(language_model, model_id="dummy", cache_path=str(tmp_path / "cache.sqlite"))
+
+    outputs = cached_lm.batch_complete_text(["a", "b"], max_new_tokens=10)
+    assert outputs == language_model.batch_complete_text(["a", "b"], max_new_tokens=10)
+    spy.reset_mock()
+
+    assert cached_lm.batch_complete_text(["b", "c", "a"], max_new_tokens=10) == [
+        outputs[1],
+        *language_model.batch_complete_text(["c"], max_new_tokens=10),
+        outputs[0],
+    ]
+    assert spy.call_args_list[0].args == (["c"],)
+    assert cached_lm.get_stats() == {"cache_num_hits": 2, "cache_num_misses": 3}
+
+    # the generation arguments are part of the keys
+    spy.reset_mock()
+    cached_lm.batch_complete_text(["a"], max_new_tokens=20)
+    assert spy.call_count == 1
+    cached_lm.close()
+
+    # the cache persists across the instances
+    spy.reset_mock()
+    cached_lm = CachedLanguageModel(language_model, model_id="dummy", cache_path=str(tmp_path / "cache.sqlite"))
+    assert cached_lm.batch_complete_text(["a", "b", "c"], max_new_tokens=10)[:2] == outputs
+    assert spy.call_count == 0
+
+    # a different model id does not share the cache
+    cached_lm = CachedLanguageModel(language_model, model_id="another", cache_path=str(tmp_path / "cache.sqlite"))
+    cached_lm.batch_complete_text(["a"], max_new_tokens=10)
+    assert spy.call_count == 1
+
+
+def test_chat_responses_and_log_probs_are_cached(tmp_path: Path, mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    chat_spy = mocker.spy(language_model, "batch_generate_chat_response")
+    log_probs_spy = mocker.spy(language_model, "batch_compute_log_probs")
+    cached_lm = CachedLanguageModel(language_model, model_id="dummy", cache_path=str(tmp_path / "cache.sqlite"))
+
+    messages = [{"role": "user", "content": "hello"}]
+    for _ in range(2):
+        assert dict(cached_lm.iter_generate_chat_response([messages])) == {0: "This is response."}
+        assert cached_lm.batch_compute_log_probs(["a", "b"], prefix_list=["x", "y"]) == [-1.0, -1.0]
+        assert cached_lm.batch_compute_log_probs(["a"]) == [-1.0]
+    assert chat_spy.call_count == 1
+    assert log_probs_spy.call_count == 2
+    assert log_probs_spy.call_args_list[1].kwargs["prefix_list"] is None
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path: Path, mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    spy = mocker.spy(language_model, "batch_complete_text")
+    # each entry takes about 70 bytes with the key, so only two entries fit
+    cached_lm = CachedLanguageModel(
+        language_model,
+        model_id="dummy",
+        cache_path=str(tmp_path / "cache.sqlite"),
+        max_size_mb=150 / 1024 / 1024,
+    )
+    for text in ["a", "b", "a", "c"]:
+        cached_lm.batch_complete_text([text])
+    assert spy.call_count == 3
+
+    # "b" is evicted when "c" is added because "a" is used more recently
+    spy.reset_mock()
+    cached_lm.batch_complete_text(["a", "b", "c"])
+    assert spy.call_args_list[0].args == (["b"],)
+
+
+def test_instance_stats_are_mapped_to_the_original_indices(tmp_path: Path, mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    cached_lm = CachedLanguageModel(language_model, model_id="dummy", cache_path=str(tmp_path / "cache.sqlite"))
+    cached_lm.batch_complete_text(["a"])
+
+    mocker.patch.object(language_model, "pop_instance_stats", return_value={0: {"latency": 0.1}})
+    cached_lm.batch_complete_text(["a", "b"])
+    assert cached_lm.pop_instance_stats() == {1: {"latency": 0.1}}
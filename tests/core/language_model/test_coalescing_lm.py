@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pytest_mock import MockerFixture
+
+from flexeval.core.language_model import CoalescingLanguageModel
+from tests.dummy_modules import DummyLanguageModel
+
+
+def test_calls_from_threads_are_coalesced_into_a_batch(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    spy = mocker.spy(language_model, "batch_complete_text")
+    # the batch is sent as soon as it is full, long before the deadline
+    coalescing_lm = CoalescingLanguageModel(language_model, max_batch_size=8, max_wait_time=10.0)
+
+    text_lists = [[f"{i}-a", f"{i}-b"] for i in range(4)]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs_list = list(
+            executor.map(lambda text_list: coalescing_lm.batch_complete_text(text_list, max_new_tokens=3), text_lists),
+        )
+    assert time.monotonic() - start < 10.0
+    coalescing_lm.close()
+
+    assert spy.call_count == 1
+    assert sorted(spy.call_args.args[0]) == sorted(text for text_list in text_lists for text in text_list)
+    for text_list, outputs in zip(text_lists, outputs_list):
+        assert outputs == DummyLanguageModel().batch_complete_text(text_list, max_new_tokens=3)
+    assert coalescing_lm.get_stats() == {
+        "coalescing_num_batches": 1,
+        "coalescing_num_requests": 4,
+        "coalescing_mean_batch_size": 8.0,
+    }
+
+
+def test_a_batch_is_sent_at_the_deadline() -> None:
+    coalescing_lm = CoalescingLanguageModel(DummyLanguageModel(), max_batch_size=100, max_wait_time=0.1)
+    start = time.monotonic()
+    assert coalescing_lm.batch_generate_chat_response([[{"role": "user", "content": "hi"}]]) == ["This is response."]
+    assert time.monotonic() - start >= 0.1
+    assert coalescing_lm.batch_complete_text([]) == []
+    coalescing_lm.close()
+
+
+def test_calls_with_different_arguments_are_not_mixed(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    complete_text_spy = mocker.spy(language_model, "batch_complete_text")
+    log_probs_spy = mocker.spy(language_model, "batch_compute_log_probs")
+    coalescing_lm = CoalescingLanguageModel(language_model, max_batch_size=100, max_wait_time=0.1)
+
+    async def _run_concurrently() -> list[list]:
+        return await asyncio.gather(
+            coalescing_lm.abatch_complete_text(["a"], max_new_tokens=1),
+            coalescing_lm.abatch_complete_text(["b"], max_new_tokens=2),
+            coalescing_lm.abatch_complete_text(["c"], max_new_tokens=1),
+            coalescing_lm.abatch_compute_log_probs(["x"], prefix_list=["p"]),
+            coalescing_lm.abatch_compute_log_probs(["y", "z"]),
+        )
+
+    outputs_list = asyncio.run(_run_concurrently())
+    coalescing_lm.close()
+
+    assert outputs_list == [
+        ['a{"max_new_tokens": 1}'],
+        ['b{"max_new_tokens": 2}'],
+        ['c{"max_new_tokens": 1}'],
+        [-1.0],
+        [-1.0, -1.0],
+    ]
+    assert sorted(len(call.args[0]) for call in complete_text_spy.call_args_list) == [1, 2]
+    assert sorted(call.kwargs["prefix_list"] is None for call in log_probs_spy.call_args_list) == [False, True]
+
+
+def test_errors_are_raised_in_all_the_callers(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "batch_complete_text", side_effect=RuntimeError("failed"))
+    coalescing_lm = CoalescingLanguageModel(language_model, max_batch_size=2, max_wait_time=10.0)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(coalescing_lm.batch_complete_text, [text]) for text in ["a", "b"]]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="failed"):
+                future.result()
+
+    # the worker keeps serving the other calls after the error
+    assert coalescing_lm.batch_compute_log_probs(["a", "b"]) == [-1.0, -1.0]
+    coalescing_lm.close()
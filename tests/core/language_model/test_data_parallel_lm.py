@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from flexeval.core.evaluate_multiple_choice import evaluate_multiple_choice
+from flexeval.core.language_model import DataParallelLM
+from flexeval.core.language_model.data_parallel_lm import split_cpu_ids, split_into_batches
+from flexeval.core.prompt_template import Jinja2PromptTemplate
+from tests.dummy_modules import DummyLanguageModel, DummyMultipleChoiceDataset
+
+
+class BatchRecordingLanguageModel(DummyLanguageModel):
+    """Returns the size of the batch as the log probability, and counts the calls as the statistics."""
+
+    def __init__(self, seconds_per_call: float = 0.0) -> None:
+        self._seconds_per_call = seconds_per_call
+        self.reset_stats()
+
+    def batch_compute_log_probs(
+        self,
+        text_list: list[str],
+        prefix_list: list[str] | None = None,
+        stride: int | None = None,
+    ) -> list[float]:
+        self._num_calls += 1
+        time.sleep(self._seconds_per_call)
+        return [float(len(text_list))] * len(text_list)
+
+    def get_stats(self) -> dict[str, int]:
+        return {"num_calls": self._num_calls}
+
+    def reset_stats(self) -> None:
+        self._num_calls = 0
+
+
+@pytest.fixture(scope="module")
+def data_parallel_lm() -> DataParallelLM:
+    lm = DataParallelLM(DummyLanguageModel(), num_workers=3, batch_size=2)
+    yield lm
+    lm.close()
+
+
+def test_batch_complete_text(data_parallel_lm: DataParallelLM) -> None:
+    text_list = [f"text {i}" for i in range(7)]
+    gen_kwargs = {"stop_sequences": ["\n"], "max_new_tokens": 10}
+    assert data_parallel_lm.prefers_whole_dataset()
+    assert data_parallel_lm.batch_complete_text(text_list, **gen_kwargs) == DummyLanguageModel().batch_complete_text(
+        text_list,
+        **gen_kwargs,
+    )
+
+
+def test_iter_complete_text_yields_all_the_results(data_parallel_lm: DataParallelLM) -> None:
+    text_list = [f"text {i}" for i in range(7)]
+    results = dict(data_parallel_lm.iter_complete_text(text_list))
+    assert [results[i] for i in range(len(text_list))] == DummyLanguageModel().batch_complete_text(text_list)
+
+    # the results of an abandoned call do not mix with the next call
+    next(data_parallel_lm.iter_complete_text(["abandoned"] * 7))
+    assert data_parallel_lm.batch_complete_text(text_list) == DummyLanguageModel().batch_complete_text(text_list)
+
+
+def test_batch_generate_chat_response(data_parallel_lm: DataParallelLM) -> None:
+    chat_messages_list = [[{"role": "user", "content": f"message {i}"}] for i in range(5)]
+    responses = data_parallel_lm.batch_generate_chat_response(chat_messages_list)
+    assert responses == DummyLanguageModel().batch_generate_chat_response(chat_messages_list)
+
+
+def test_batch_compute_log_probs(data_parallel_lm: DataParallelLM) -> None:
+    text_list = [f"text {i}" for i in range(5)]
+    assert data_parallel_lm.batch_compute_log_probs(text_list) == [-1.0] * 5
+    assert data_parallel_lm.batch_compute_log_probs(text_list, prefix_list=["prefix"] * 5) == [-1.0] * 5
+
+
+def test_error_in_worker_is_raised(data_parallel_lm: DataParallelLM) -> None:
+    with pytest.raises(RuntimeError):
+        data_parallel_lm.batch_complete_text(["text"], unserializable_kwarg=object())
+
+    # the workers are still available after the error
+    assert len(data_parallel_lm.batch_complete_text(["text"] * 3)) == 3
+
+
+def test_unpicklable_arguments_are_rejected(data_parallel_lm: DataParallelLM) -> None:
+    with pytest.raises(ValueError):
+        data_parallel_lm.batch_complete_text(["text"] * 3, unpicklable_kwarg=lambda x: x)
+
+    # no task is left in the workers
+    assert len(data_parallel_lm.batch_complete_text(["text"] * 3)) == 3
+
+
+def test_texts_with_the_same_prefix_are_sent_to_the_same_worker() -> None:
+    lm = DataParallelLM(BatchRecordingLanguageModel(), num_workers=2, batch_size=2)
+    prefix_list = ["a", "a", "a", "b", "c", "c"]
+    log_probs = lm.batch_compute_log_probs(["text"] * len(prefix_list), prefix_list=prefix_list)
+    lm.close()
+    assert log_probs == [3.0, 3.0, 3.0, 1.0, 2.0, 2.0]
+
+
+def test_stats_of_the_workers_are_collected() -> None:
+    lm = DataParallelLM(BatchRecordingLanguageModel(), num_workers=2, batch_size=1)
+    lm.batch_compute_log_probs(["text"] * 4)
+    assert sum(lm.get_stats().values()) == 4
+    assert set(lm.get_stats()) <= {"worker0_num_calls", "worker1_num_calls"}
+
+    lm.reset_stats()
+    assert lm.get_stats() == {}
+    lm.batch_compute_log_probs(["text"] * 2)
+    stats = lm.get_stats()
+    lm.close()
+    assert sum(stats.values()) == 2
+
+
+def test_all_workers_receive_the_inputs_of_multiple_choice_evaluation() -> None:
+    # each call takes a while so that a single worker cannot take all the tasks
+    lm = DataParallelLM(BatchRecordingLanguageModel(seconds_per_call=0.5), num_workers=2, batch_size=1)
+    start_time = time.perf_counter()
+    evaluate_multiple_choice(
+        language_model=lm,
+        eval_dataset=DummyMultipleChoiceDataset(),
+        prompt_template=Jinja2PromptTemplate("{{text}}"),
+        batch_size=1,
+    )
+    elapsed_time = time.perf_counter() - start_time
+    stats = lm.get_stats()
+    lm.close()
+    assert stats == {"worker0_num_calls": 1, "worker1_num_calls": 1}
+    # the two instances are scored at the same time, not one evaluation batch after another
+    assert elapsed_time < 2 * 0.5
+
+
+@pytest.mark.parametrize(
+    ("group_sizes", "batch_size", "expected"),
+    [
+        ([1, 1, 1, 1, 1], 2, [(0, 2), (2, 4), (4, 5)]),
+        ([3, 1, 2], 2, [(0, 3), (3, 4), (4, 6)]),
+        ([1, 1, 2, 4], 4, [(0, 4), (4, 8)]),
+        ([], 2, []),
+    ],
+)
+def test_split_into_batches(group_sizes: list[int], batch_size: int, expected: list[tuple[int, int]]) -> None:
+    assert split_into_batches(group_sizes, batch_size) == expected
+
+
+@pytest.mark.parametrize(
+    ("cpu_ids", "num_workers", "expected"),
+    [
+        ([0, 1, 2, 3], 2, [[0, 1], [2, 3]]),
+        ([3, 2, 1, 0, 4], 2, [[0, 1], [2, 3, 4]]),
+        ([0, 1], 3, [[0], [1], [0]]),
+    ],
+)
+def test_split_cpu_ids(cpu_ids: list[int], num_workers: int, expected: list[list[int]]) -> None:
+    assert split_cpu_ids(cpu_ids, num_workers) == expected
@@ -1,16 +1,21 @@
+from __future__ import annotations
+
 import functools
-from typing import Callable
+from typing import Any, Callable
 
 import pytest
 import torch
-from transformers import AutoTokenizer, PreTrainedTokenizer
+from transformers import AutoTokenizer, GPTNeoXConfig, GPTNeoXForCausalLM, PreTrainedTokenizer
 
 from flexeval.core.language_model.hf_lm import (
     HuggingFaceLM,
     LanguageModel,
+    gather_log_probs,
+    get_oov_character_length,
     tokenize_text_for_lm_continuation,
     tokenize_text_for_lm_prefix,
 )
+from flexeval.core.language_model.hf_quantization import WeightOnlyInt8Linear, quantize_linear_layers
 
 
 @pytest.mark.parametrize(
@@ -84,6 +89,52 @@ def test_tokenize_text_for_lm_continuation(tokenizer_name: str) -> None:
         assert tokenizer.decode(tokens, skip_special_tokens=True) == text_list[i]
 
 
+@pytest.mark.parametrize("use_fast", [True, False])
+def test_tokenize_text_for_lm_continuation_matches_tokenization_of_each_text(use_fast: bool) -> None:
+    tokenizer = AutoTokenizer.from_pretrained("sbintuitions/tiny-lm", use_fast=use_fast)
+    oov_character = "彁"
+    oov_char_len = len(tokenizer.tokenize(oov_character))
+
+    text_list = ["は続き", "", "これは文頭", "is continuation."]
+    as_continuation = [True, True, False, True]
+    batch_encoding = tokenize_text_for_lm_continuation(
+        text_list,
+        tokenizer,
+        oov_character=oov_character,
+        as_continuation=as_continuation,
+    )
+    for text, as_cont, input_ids, attention_mask in zip(
+        text_list,
+        as_continuation,
+        batch_encoding.input_ids,
+        batch_encoding.attention_mask,
+    ):
+        if as_cont:
+            expected_ids = tokenizer(oov_character + text, add_special_tokens=False).input_ids[oov_char_len:]
+        else:
+            expected_ids = tokenizer(text, add_special_tokens=False).input_ids
+        assert input_ids[attention_mask.bool()].tolist() == expected_ids
+        assert attention_mask.tolist() == sorted(attention_mask.tolist(), reverse=True)
+
+
+def test_oov_character_length_is_recomputed_after_tokens_are_added() -> None:
+    tokenizer = AutoTokenizer.from_pretrained("sbintuitions/tiny-lm")
+    assert get_oov_character_length(tokenizer, "彁") == len(tokenizer.tokenize("彁"))
+
+    tokenizer.add_tokens(["彁"])
+    with pytest.raises(ValueError):
+        get_oov_character_length(tokenizer, "彁")
+
+
+@pytest.mark.parametrize("max_num_elements", [1, 100, 2**24])
+def test_gather_log_probs(max_num_elements: int) -> None:
+    logits = torch.randn(3, 7, 50)
+    target_ids = torch.randint(0, 50, (3, 7))
+    expected = torch.log_softmax(logits, dim=-1).gather(dim=-1, index=target_ids.unsqueeze(-1)).squeeze(-1)
+    log_probs = gather_log_probs(logits, target_ids, max_num_elements=max_num_elements)
+    assert torch.allclose(log_probs, expected)
+
+
 @pytest.fixture(scope="module")
 def lm_init_func(model_name: str = "sbintuitions/tiny-lm") -> Callable[..., HuggingFaceLM]:
     # use float32 because half precision is not supported in some hardware
@@ -136,6 +187,21 @@ def test_stop_sequences(lm: LanguageModel) -> None:
     assert completion.strip() == "1"
 
 
+def test_multi_token_stop_sequences_end_generation(lm: LanguageModel) -> None:
+    # assume that the lm will repeat "10"
+    completion = lm.batch_complete_text(["10 10 10 10 10 10 "], stop_sequences=["0 1"], max_new_tokens=20)[0]
+    assert completion.strip() == "1"
+
+    # the generation stops as soon as the stop sequence appears
+    completion = lm.batch_complete_text(
+        ["10 10 10 10 10 10 "],
+        stop_sequences=["0 1"],
+        max_new_tokens=20,
+        include_stop_str_in_output=True,
+    )[0]
+    assert completion.count("0 1") == 1
+
+
 def test_batch_compute_log_probs_produces_reasonable_comparisons(lm: LanguageModel) -> None:
     # test if the shorter sentence has higher log prob
     log_probs = lm.batch_compute_log_probs(["これは正しい日本語です。", "これは正しい日本語です。そして…"])
@@ -165,6 +231,188 @@ def test_batch_compute_log_probs_is_not_affected_by_batch(lm: LanguageModel) ->
     assert round(log_probs_without_batch[0], 4) == round(log_probs_with_batch[0], 4)
 
 
+def test_batch_compute_log_probs_with_reused_prefix_cache(
+    lm: LanguageModel,
+    lm_init_func: Callable[..., HuggingFaceLM],
+) -> None:
+    lm_with_prefix_cache = lm_init_func(reuse_prefix_cache=True)
+
+    prefix_list = ["日本で一番高い山は", "日本で一番高い山は", "日本で一番高い山は", "Yes, we are", ""]
+    text_list = ["富士山", "エベレスト", "", "富士山", "こんにちは"]
+    log_probs = lm.batch_compute_log_probs(text_list, prefix_list=list(prefix_list))
+    log_probs_with_cache = lm_with_prefix_cache.batch_compute_log_probs(text_list, prefix_list=list(prefix_list))
+    assert [round(p, 4) for p in log_probs] == [round(p, 4) for p in log_probs_with_cache]
+
+
+def test_batch_compute_log_probs_with_rolling_kv_cache(
+    lm: LanguageModel,
+    lm_init_func: Callable[..., HuggingFaceLM],
+) -> None:
+    lm_with_rolling_cache = lm_init_func(rolling_kv_cache=True)
+
+    # the cache is not used when the texts fit in the context
+    text_list = ["これは正しい日本語です。", "こんにちは"]
+    log_probs = lm.batch_compute_log_probs(text_list)
+    log_probs_with_cache = lm_with_rolling_cache.batch_compute_log_probs(text_list)
+    assert [round(p, 4) for p in log_probs] == [round(p, 4) for p in log_probs_with_cache]
+
+    # nothing is evicted from the cache while the text fits in it, so the result matches the single forward pass
+    input_encoding = lm._tokenizer(["これは正しい日本語です。"], return_tensors="pt")  # noqa: SLF001
+    log_prob_of_next = lm._compute_log_probs_of_next_tokens(input_encoding, stride=None)  # noqa: SLF001
+    log_prob_of_next_with_cache = lm_with_rolling_cache._compute_log_probs_of_next_tokens_with_rolling_cache(  # noqa: SLF001
+        input_encoding,
+        stride=2,
+    )
+    assert torch.allclose(log_prob_of_next, log_prob_of_next_with_cache, atol=1e-4)
+
+    # the texts longer than the context are fed block by block
+    max_length = lm_with_rolling_cache._model.config.max_position_embeddings  # noqa: SLF001
+    long_text = "これは正しい日本語です。" * max_length
+    log_probs = lm_with_rolling_cache.batch_compute_log_probs([long_text, "こんにちは"], stride=max_length // 2)
+    assert len(log_probs) == 2
+    assert all(-float("inf") < p < 0 for p in log_probs)
+
+
+@pytest.mark.parametrize("continuous_batching_size", [1, 3])
+def test_batch_complete_text_with_continuous_batching(
+    lm: LanguageModel,
+    lm_init_func: Callable[..., HuggingFaceLM],
+    continuous_batching_size: int,
+) -> None:
+    lm_with_continuous_batching = lm_init_func(continuous_batching_size=continuous_batching_size)
+    assert lm_with_continuous_batching.prefers_whole_dataset()
+
+    text_list = ["こんにちは。今日もいい天気。", "Lorem ipsum", "10 10 10 10 10 10 ", "0 0 0 0 0 0 0 0 0 0"]
+    for gen_kwargs in [
+        {"do_sample": False, "max_new_tokens": 20},
+        {"do_sample": False, "stop_sequences": ["。", "0 1"], "max_new_tokens": 20},
+    ]:
+        # each text is generated separately to avoid the effect of padding
+        expected = [lm.batch_complete_text([text], **gen_kwargs)[0] for text in text_list]
+        assert lm_with_continuous_batching.batch_complete_text(text_list, **gen_kwargs) == expected
+
+
+def test_iter_complete_text_with_continuous_batching(lm_init_func: Callable[..., HuggingFaceLM]) -> None:
+    lm_with_continuous_batching = lm_init_func(continuous_batching_size=2)
+    text_list = ["こんにちは。今日もいい天気。", "Lorem ipsum", "10 10 10 10 10 10 ", "0 0 0 0 0 0 0 0 0 0"]
+    gen_kwargs = {"do_sample": False, "stop_sequences": ["。", "0 1"], "max_new_tokens": 20}
+
+    outputs = list(lm_with_continuous_batching.iter_complete_text(text_list, **gen_kwargs))
+    # the texts are yielded as each sequence finishes, so the order may differ from the inputs
+    assert sorted(index for index, _ in outputs) == list(range(len(text_list)))
+    expected = lm_with_continuous_batching.batch_complete_text(text_list, **gen_kwargs)
+    assert [dict(outputs)[i] for i in range(len(text_list))] == expected
+
+
+def test_torch_compile_mode(lm: LanguageModel, lm_init_func: Callable[..., HuggingFaceLM]) -> None:
+    # use the eager backend to test the compiled mode quickly on CPU
+    compiled_lm = lm_init_func(torch_compile=True, torch_compile_kwargs={"backend": "eager"})
+
+    text_list = ["こんにちは。今日もいい天気。", "Lorem ipsum"]
+    gen_kwargs = {"do_sample": False, "max_new_tokens": 10}
+    for _ in range(2):
+        assert compiled_lm.batch_complete_text(text_list, **gen_kwargs) == lm.batch_complete_text(
+            text_list,
+            **gen_kwargs,
+        )
+
+    log_probs = lm.batch_compute_log_probs(text_list)
+    compiled_log_probs = compiled_lm.batch_compute_log_probs(text_list)
+    assert [round(p, 4) for p in log_probs] == [round(p, 4) for p in compiled_log_probs]
+
+    stats = compiled_lm.get_stats()
+    assert stats["num_compilations"] > 0
+    assert stats["compile_time"] > 0
+    assert stats["steady_state_tokens_per_second"] > 0
+
+    compiled_lm.reset_stats()
+    assert compiled_lm.get_stats()["num_compilations"] == 0
+
+
+@pytest.mark.parametrize("quantization", ["dynamic_int8", "weight_only_int8"])
+def test_quantization(
+    lm: LanguageModel,
+    lm_init_func: Callable[..., HuggingFaceLM],
+    quantization: str,
+) -> None:
+    text_list = ["こんにちは。今日もいい天気。", "Lorem ipsum"]
+    quantized_lm = lm_init_func(quantization=quantization, quantization_parity_texts=text_list)
+
+    stats = quantized_lm.get_stats()
+    assert stats["quantization_num_layers"] > 0
+    assert 0 <= stats["quantization_parity_mean_abs_log_prob_diff_per_token"] < 0.1
+    assert stats["quantization_parity_speedup"] > 0
+
+    log_probs = lm.batch_compute_log_probs(text_list)
+    quantized_log_probs = quantized_lm.batch_compute_log_probs(text_list)
+    assert quantized_log_probs == pytest.approx(log_probs, abs=1.0)
+
+    # the parity check stays in the statistics after resetting the runtime statistics
+    quantized_lm.reset_stats()
+    assert quantized_lm.get_stats() == stats
+
+
+def test_quantization_skips_the_lm_head_whatever_its_name_is() -> None:
+    # the LM head of GPT-NeoX is named `embed_out`
+    config = GPTNeoXConfig(
+        vocab_size=32,
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    model = GPTNeoXForCausalLM(config)
+    assert quantize_linear_layers(model, "weight_only_int8") > 0
+    assert type(model.get_output_embeddings()) is torch.nn.Linear
+    assert isinstance(model.gpt_neox.layers[0].mlp.dense_h_to_4h, WeightOnlyInt8Linear)
+
+
+@pytest.mark.parametrize(
+    "speculative_kwargs",
+    [
+        {"prompt_lookup_num_tokens": 3},
+        {"draft_model_name": "sbintuitions/tiny-lm", "draft_model_kwargs": {"torch_dtype": "float32"}},
+    ],
+)
+def test_speculative_decoding_does_not_change_greedy_outputs(
+    lm: LanguageModel,
+    lm_init_func: Callable[..., HuggingFaceLM],
+    speculative_kwargs: dict[str, Any],
+) -> None:
+    speculative_lm = lm_init_func(**speculative_kwargs)
+
+    # texts that repeat themselves so that the prompt lookup finds candidates
+    text_list = ["こんにちは。こんにちは。こんにちは。", "Lorem ipsum dolor sit amet, Lorem ipsum", "1, 2, 3, 1, 2, 3,"]
+    gen_kwargs = {"do_sample": False, "max_new_tokens": 16}
+    # the texts are generated one by one in speculative decoding,
+    # so they are compared with the outputs without padding
+    assert speculative_lm.batch_complete_text(text_list, **gen_kwargs) == [
+        lm.batch_complete_text([text], **gen_kwargs)[0] for text in text_list
+    ]
+
+    stats = speculative_lm.get_stats()
+    assert stats["speculative_num_generated_tokens"] > 0
+    assert stats["speculative_tokens_per_target_forward"] >= 1
+    assert 0 <= stats["speculative_num_accepted_tokens"] <= stats["speculative_num_drafted_tokens"]
+
+    speculative_lm.reset_stats()
+    assert speculative_lm.get_stats()["speculative_num_generated_tokens"] == 0
+
+
+def test_batch_complete_text_samples_shares_the_prompt_among_the_samples(lm: HuggingFaceLM) -> None:
+    text_list = ["こんにちは、", "Lorem ipsum dolor sit amet,", "1, 2, 3,"]
+    gen_kwargs = {"max_new_tokens": 8}
+
+    # greedy samples are the same as the output of `batch_complete_text`
+    greedy_samples_list = lm.batch_complete_text_samples(text_list, num_samples=3, do_sample=False, **gen_kwargs)
+    greedy_outputs = lm.batch_complete_text(text_list, do_sample=False, **gen_kwargs)
+    assert greedy_samples_list == [[output] * 3 for output in greedy_outputs]
+
+    samples_list = lm.batch_complete_text_samples(text_list, num_samples=4, do_sample=True, **gen_kwargs)
+    assert [len(samples) for samples in samples_list] == [4, 4, 4]
+    assert any(len(set(samples)) > 1 for samples in samples_list)
+
+
 def test_if_random_seed_fixes_the_lm_outputs(lm_init_func: Callable[..., HuggingFaceLM]) -> None:
     # first check if the outputs are different without fixing the seed
     completions = set()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import sys
+from types import ModuleType
+from typing import Any
+
+import numpy as np
+import pytest
+import torch
+from pytest_mock import MockerFixture
+
+from flexeval.core.language_model import LlamaCppLM
+
+VOCAB_SIZE = 260
+BOS_TOKEN_ID = 1
+
+
+class StubLlama:
+    """A stand-in for `llama_cpp.Llama` with a byte-level tokenizer and logits computed from the previous token."""
+
+    def __init__(self, model_path: str, **kwargs) -> None:
+        self.model_path = model_path
+        self.kwargs = kwargs
+        self.completion_calls: list[dict[str, Any]] = []
+        self.scores = np.zeros((kwargs["n_ctx"], VOCAB_SIZE), dtype=np.float32)
+        self.input_ids = np.zeros(kwargs["n_ctx"], dtype=np.intc)
+        self.n_tokens = 0
+        self.num_evaluated_tokens = 0
+
+    @classmethod
+    def from_pretrained(cls: type[StubLlama], repo_id: str, filename: str, **kwargs) -> StubLlama:
+        return cls(model_path=f"{repo_id}/{filename}", **kwargs)
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list[int]:
+        return [BOS_TOKEN_ID] * add_bos + [byte + 2 for byte in text]
+
+    def token_bos(self) -> int:
+        return BOS_TOKEN_ID
+
+    def reset(self) -> None:
+        self.n_tokens = 0
+
+    def eval(self, tokens: list[int]) -> None:
+        for token in tokens:
+            self.input_ids[self.n_tokens] = token
+            self.scores[self.n_tokens] = stub_logits(token)
+            self.n_tokens += 1
+        self.num_evaluated_tokens += len(tokens)
+
+    def create_completion(self, prompt: str, **kwargs) -> dict[str, Any]:
+        self.completion_calls.append({"prompt": prompt, **kwargs})
+        return {"choices": [{"text": prompt.upper()}]}
+
+    def create_chat_completion(self, messages: list[dict[str, str]], **kwargs) -> dict[str, Any]:
+        return {"choices": [{"message": {"role": "assistant", "content": messages[-1]["content"].upper()}}]}
+
+
+def stub_logits(token: int) -> np.ndarray:
+    return np.sin(np.arange(VOCAB_SIZE) * (token % 7 + 1)).astype(np.float32)
+
+
+def expected_log_prob(text: str, prefix: str) -> float:
+    token_ids = [BOS_TOKEN_ID] + [byte + 2 for byte in (prefix + text).encode("utf-8")]
+    log_probs = torch.log_softmax(torch.tensor(np.stack([stub_logits(token) for token in token_ids])), dim=-1)
+    num_prefix_tokens = 1 + len(prefix.encode("utf-8"))
+    return sum(log_probs[i - 1, token_ids[i]].item() for i in range(num_prefix_tokens, len(token_ids)))
+
+
+@pytest.fixture()
+def lm(mocker: MockerFixture) -> LlamaCppLM:
+    stub_llama_cpp = ModuleType("llama_cpp")
+    stub_llama_cpp.Llama = StubLlama
+    mocker.patch.dict(sys.modules, {"llama_cpp": stub_llama_cpp})
+    return LlamaCppLM(model_name="stub/repo", model_file="*.gguf", n_ctx=64, n_threads=4)
+
+
+def test_batch_complete_text(lm: LlamaCppLM) -> None:
+    assert lm._llm.model_path == "stub/repo/*.gguf"  # noqa: SLF001
+    assert lm._llm.kwargs["n_threads"] == 4  # noqa: SLF001
+
+    text_list = ["b", "c", "a"]
+    assert lm.batch_complete_text(text_list, stop_sequences="\n", max_new_tokens=5, stop=["."]) == ["B", "C", "A"]
+    # the texts are processed in sorted order to share the prefixes
+    calls = lm._llm.completion_calls  # noqa: SLF001
+    assert [call["prompt"] for call in calls] == ["a", "b", "c"]
+    assert calls[0]["max_tokens"] == 5
+    assert calls[0]["stop"] == ["\n", "."]
+    assert calls[0]["temperature"] == 0.0
+
+    with pytest.raises(ValueError):
+        lm.batch_complete_text(text_list, max_new_tokens=5, max_tokens=5)
+
+    messages = [{"role": "user", "content": "hello"}]
+    assert lm.batch_generate_chat_response([messages], max_new_tokens=5) == ["HELLO"]
+    assert lm.count_tokens(["abc", "あ"]) == [3, 3]
+
+
+def test_batch_compute_log_probs(lm: LlamaCppLM) -> None:
+    text_list = ["is continuation.", "Lorem ipsum", "ipsum"]
+    for prefix_list in [None, ["This ", "", "Lorem "]]:
+        log_probs = lm.batch_compute_log_probs(text_list, prefix_list=prefix_list)
+        expected = [
+            expected_log_prob(text, prefix) for text, prefix in zip(text_list, prefix_list or [""] * len(text_list))
+        ]
+        assert log_probs == pytest.approx(expected, abs=1e-4)
+
+    with pytest.raises(ValueError):
+        lm.batch_compute_log_probs(text_list, stride=4)
+
+
+def test_batch_compute_log_probs_reuses_the_common_prefix(lm: LlamaCppLM) -> None:
+    text_list = ["Lorem ipsum", "ipsum", "Lorem dolor"]
+    log_probs = lm.batch_compute_log_probs(text_list)
+    assert log_probs == pytest.approx([expected_log_prob(text, "") for text in text_list], abs=1e-4)
+    # "Lorem ipsum" follows "Lorem dolor" in sorted order, so only the tokens after "<Lorem " are evaluated for it
+    assert lm._llm.num_evaluated_tokens == len("<Lorem dolor") + len("ipsum") + len("ipsum")  # noqa: SLF001
+
+
+def test_model_file_is_required_for_repositories(mocker: MockerFixture) -> None:
+    stub_llama_cpp = ModuleType("llama_cpp")
+    stub_llama_cpp.Llama = StubLlama
+    mocker.patch.dict(sys.modules, {"llama_cpp": stub_llama_cpp})
+    with pytest.raises(ValueError):
+        LlamaCppLM(model_name="stub/repo")
+
+    lm = LlamaCppLM(model_name="stub/repo", model_file="*.gguf", n_ctx=64, model_kwargs={"logits_all": False})
+    with pytest.raises(ValueError):
+        lm.batch_compute_log_probs(["text"])
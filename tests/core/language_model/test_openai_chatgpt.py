@@ -0,0 +1,397 @@
+from __future__ import annotations
+
+import asyncio
+import email
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Iterator
+
+import pytest
+from pytest_mock import MockerFixture
+
+from flexeval.core.evaluate_pairwise import evaluate_pairwise
+from flexeval.core.language_model import OpenAIChatGPT
+from flexeval.core.metric import ChatLLMScore
+from flexeval.core.pairwise_comparison import ChatLLMPairwiseJudge
+from flexeval.core.prompt_template import Jinja2PromptTemplate
+
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    """A stand-in for the OpenAI API that echoes the last message after `delay` seconds.
+
+    The first `num_rate_limit_errors` requests are rejected with `Retry-After`.
+    Streaming requests receive the words of the message one by one at the interval of `delay` seconds.
+    The files and batches endpoints of the Batch API are also implemented,
+    where a batch job completes at the second poll and the requests in `failed_custom_ids` fail.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), StubOpenAIHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.num_in_flight = 0
+        self.max_num_in_flight = 0
+        self.client_ports: set[int] = set()
+        self.num_rate_limit_errors = 0
+        self.request_times: list[float] = []
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict[str, Any]] = {}
+        self.failed_custom_ids: set[str] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubOpenAIServer
+
+    def do_POST(self) -> None:  # noqa: N802
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":
+            self._create_file(body)
+        elif self.path == "/v1/batches":
+            self._create_batch(json.loads(body))
+        else:
+            self._create_chat_completion(json.loads(body))
+
+    def do_GET(self) -> None:  # noqa: N802
+        _, _, resource, resource_id, *rest = self.path.split("/")
+        if resource == "batches":
+            self._retrieve_batch(resource_id)
+        elif resource == "files" and rest == ["content"]:
+            self._send_bytes(self.server.files[resource_id], "application/octet-stream")
+
+    def _create_chat_completion(self, request: dict[str, Any]) -> None:
+        with self.server.lock:
+            self.server.request_times.append(time.monotonic())
+            if self.server.num_rate_limit_errors > 0:
+                self.server.num_rate_limit_errors -= 1
+                self._send_json(
+                    {"error": {"message": "Rate limit reached.", "type": "requests", "code": "rate_limit_exceeded"}},
+                    status=429,
+                    headers={"retry-after-ms": "500"},
+                )
+                return
+            self.server.num_in_flight += 1
+            self.server.max_num_in_flight = max(self.server.max_num_in_flight, self.server.num_in_flight)
+            self.server.client_ports.add(self.client_address[1])
+        if request.get("stream"):
+            self._send_chat_completion_chunks(request)
+        else:
+            time.sleep(self.server.delay)
+            self._send_json(self._chat_completion_body(request))
+        with self.server.lock:
+            self.server.num_in_flight -= 1
+
+    def _send_chat_completion_chunks(self, request: dict[str, Any]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = re.findall(r"\S+\s*", request["messages"][-1]["content"])
+        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"]}
+        for i, word in enumerate(words):
+            time.sleep(self.server.delay)
+            delta = {"role": "assistant", "content": word} if i == 0 else {"content": word}
+            finish_reason = "stop" if i == len(words) - 1 else None
+            self._send_event({**chunk, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]})
+        if request.get("stream_options", {}).get("include_usage"):
+            usage = {"prompt_tokens": 1, "completion_tokens": len(words), "total_tokens": 1 + len(words)}
+            self._send_event({**chunk, "choices": [], "usage": usage})
+        self._send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_event(self, data: dict[str, Any] | str) -> None:
+        event = f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode()
+        self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+        self.wfile.flush()
+
+    @staticmethod
+    def _chat_completion_body(request: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": request["messages"][-1]["content"]},
+                    "finish_reason": "stop",
+                }
+                for i in range(request.get("n", 1))
+            ],
+        }
+
+    def _create_file(self, body: bytes) -> None:
+        multipart = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        file_part = next(
+            part for part in multipart.get_payload() if part.get_param("name", header="content-disposition") == "file"
+        )
+        file_id = f"file-{len(self.server.files)}"
+        self.server.files[file_id] = file_part.get_payload(decode=True)
+        self._send_json({"id": file_id, "object": "file", "purpose": "batch", "filename": file_part.get_filename()})
+
+    def _create_batch(self, request: dict[str, Any]) -> None:
+        batch_id = f"batch-{len(self.server.batches)}"
+        self.server.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "status": "in_progress",
+            "num_polls": 0,
+        }
+        self._send_json(self.server.batches[batch_id])
+
+    def _retrieve_batch(self, batch_id: str) -> None:
+        batch = self.server.batches[batch_id]
+        batch["num_polls"] += 1
+        if batch["num_polls"] >= 2 and batch["status"] == "in_progress":
+            output_lines = []
+            for line in self.server.files[batch["input_file_id"]].decode().splitlines():
+                request = json.loads(line)
+                if request["custom_id"] in self.server.failed_custom_ids:
+                    response = {"status_code": 500, "body": {"error": {"message": "Internal error."}}}
+                else:
+                    response = {"status_code": 200, "body": self._chat_completion_body(request["body"])}
+                output_lines.append(json.dumps({"custom_id": request["custom_id"], "response": response}))
+            output_file_id = f"file-{len(self.server.files)}"
+            self.server.files[output_file_id] = "\n".join(output_lines).encode()
+            batch.update({"status": "completed", "output_file_id": output_file_id})
+        self._send_json(batch)
+
+    def _send_json(self, body: dict[str, Any], status: int = 200, headers: dict[str, str] | None = None) -> None:
+        self._send_bytes(json.dumps(body).encode(), "application/json", status=status, headers=headers)
+
+    def _send_bytes(
+        self,
+        body: bytes,
+        content_type: str,
+        status: int = 200,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002, ANN401
+        pass
+
+
+@pytest.fixture()
+def stub_server() -> Iterator[StubOpenAIServer]:
+    server = StubOpenAIServer(delay=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def chatgpt(stub_server: StubOpenAIServer) -> Iterator[OpenAIChatGPT]:
+    lm = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        max_concurrency=3,
+    )
+    yield lm
+    lm.close()
+
+
+def test_batch_complete_text(chatgpt: OpenAIChatGPT) -> None:
+    text_list = [f"text {i}" for i in range(5)]
+    assert chatgpt.batch_complete_text(text_list) == text_list
+    assert chatgpt.batch_generate_chat_response([[{"role": "user", "content": "hello"}]]) == ["hello"]
+    assert chatgpt.batch_complete_text_samples(["hello"], num_samples=2) == [["hello", "hello"]]
+
+
+def test_async_calls_are_processed_concurrently(chatgpt: OpenAIChatGPT, stub_server: StubOpenAIServer) -> None:
+    async def _run() -> list[list[str]]:
+        return await asyncio.gather(
+            chatgpt.abatch_complete_text(["a", "b"]),
+            chatgpt.abatch_generate_chat_response([[{"role": "user", "content": "hello"}]]),
+        )
+
+    assert asyncio.run(_run()) == [["a", "b"], ["hello"]]
+    assert stub_server.max_num_in_flight == 3
+
+
+def test_concurrency_is_bounded_and_the_connections_are_reused(
+    chatgpt: OpenAIChatGPT,
+    stub_server: StubOpenAIServer,
+) -> None:
+    assert chatgpt.prefers_whole_dataset()
+    text_list = [f"text {i}" for i in range(12)]
+    results = dict(chatgpt.iter_complete_text(text_list))
+    assert results == dict(enumerate(text_list))
+    assert stub_server.max_num_in_flight == 3
+
+    # the client is kept alive across the calls, so the connections of the pool are reused
+    chatgpt.batch_complete_text(text_list)
+    assert len(stub_server.client_ports) <= 3
+
+
+def test_rate_limit_error_is_retried_after_the_time_given_by_the_server(stub_server: StubOpenAIServer) -> None:
+    chatgpt = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        max_concurrency=1,
+        requests_per_minute=6000,
+        rate_limit_group="test_rate_limit_error",
+    )
+    stub_server.num_rate_limit_errors = 1
+    start_time = time.monotonic()
+    assert chatgpt.batch_complete_text(["a", "b", "c"]) == ["a", "b", "c"]
+    chatgpt.close()
+
+    # the first request is rejected, and the requests are sent again after `retry-after-ms`
+    assert len(stub_server.request_times) == 4
+    assert all(request_time - start_time >= 0.5 for request_time in stub_server.request_times[1:])
+
+
+def test_requests_are_throttled_by_the_budget(stub_server: StubOpenAIServer) -> None:
+    chatgpt = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        requests_per_minute=120,
+        rate_limit_group="test_requests_are_throttled",
+    )
+    chatgpt.batch_complete_text([f"text {i}" for i in range(122)])
+    chatgpt.close()
+
+    # the budget of 120 requests is used up at once, and then refills at 2 requests per second
+    assert stub_server.request_times[-1] - stub_server.request_times[0] >= 0.9
+
+
+def test_batch_api_mode_maps_the_results_back_to_the_requests(stub_server: StubOpenAIServer, tmp_path: Path) -> None:
+    chatgpt = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        use_batch_api=True,
+        batch_api_state_file=str(tmp_path / "batch_jobs.json"),
+        batch_api_poll_interval=0.01,
+    )
+    stub_server.failed_custom_ids = {"request-1"}
+    text_list = [f"text {i}" for i in range(5)]
+    assert chatgpt.batch_complete_text(text_list, max_new_tokens=10) == text_list
+    chatgpt.close()
+
+    assert len(stub_server.batches) == 1
+    # the request that failed in the batch job is sent to the chat endpoint
+    assert len(stub_server.request_times) == 1
+
+
+def test_pairwise_judge_and_llm_score_send_all_the_requests_as_one_batch_job(
+    stub_server: StubOpenAIServer,
+    tmp_path: Path,
+) -> None:
+    chatgpt = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        use_batch_api=True,
+        batch_api_state_file=str(tmp_path / "batch_jobs.json"),
+        batch_api_poll_interval=0.01,
+    )
+    num_items = 5
+    _, match_info_list = evaluate_pairwise(
+        model_items={
+            model: [{"lm_output": f"{model} output {i}", "references": []} for i in range(num_items)]
+            for model in ["model1", "model2"]
+        },
+        judge=ChatLLMPairwiseJudge(
+            chatgpt,
+            prompt_template=Jinja2PromptTemplate("{{ model1_item.lm_output }} vs {{ model2_item.lm_output }}"),
+        ),
+        batch_size=4,
+    )
+    # the matches are more than `batch_size`, but they are judged in a single batch job
+    assert len(match_info_list) == 2 * num_items
+    assert len(stub_server.batches) == 1
+
+    metric = ChatLLMScore(chatgpt, prompt_template=Jinja2PromptTemplate("{{ lm_output }}"), batch_size=4)
+    metric.evaluate([f"score {i}" for i in range(num_items)], references_list=[[] for _ in range(num_items)])
+    chatgpt.close()
+    assert len(stub_server.batches) == 2
+
+
+def test_batch_api_mode_resumes_polling_the_submitted_job(
+    stub_server: StubOpenAIServer,
+    tmp_path: Path,
+    mocker: MockerFixture,
+) -> None:
+    lm_kwargs = {
+        "model_name": "stub-model",
+        "api_headers": {"api_key": "dummy", "base_url": stub_server.base_url},
+        "use_batch_api": True,
+        "batch_api_state_file": str(tmp_path / "batch_jobs.json"),
+        "batch_api_poll_interval": 0.01,
+    }
+    text_list = [f"text {i}" for i in range(5)]
+
+    # the run is interrupted while waiting for the batch job
+    chatgpt = OpenAIChatGPT(**lm_kwargs)
+    wait_for_batch_job = mocker.patch(
+        "flexeval.core.language_model.openai_batch_api.wait_for_batch_job",
+        side_effect=RuntimeError("interrupted"),
+    )
+    with pytest.raises(RuntimeError, match="interrupted"):
+        chatgpt.batch_complete_text(text_list)
+    chatgpt.close()
+    mocker.stop(wait_for_batch_job)
+    assert len(stub_server.batches) == 1
+
+    chatgpt = OpenAIChatGPT(**lm_kwargs)
+    assert chatgpt.batch_complete_text(text_list) == text_list
+    chatgpt.close()
+    assert len(stub_server.batches) == 1
+
+    # different requests are submitted as a new job
+    chatgpt = OpenAIChatGPT(**lm_kwargs)
+    assert chatgpt.batch_complete_text(text_list[:2]) == text_list[:2]
+    chatgpt.close()
+    assert len(stub_server.batches) == 2
+
+
+def test_streaming_mode_records_the_latency_of_each_request(stub_server: StubOpenAIServer) -> None:
+    chatgpt = OpenAIChatGPT(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        stream=True,
+    )
+    text_list = ["one", "one two", "one two three four"]
+    results = dict(chatgpt.iter_complete_text(text_list))
+    assert results == dict(enumerate(text_list))
+
+    instance_stats = chatgpt.pop_instance_stats()
+    assert chatgpt.pop_instance_stats() == {}
+    assert [instance_stats[i]["num_output_tokens"] for i in range(3)] == [1, 2, 4]
+    assert instance_stats[0]["inter_token_latency"] is None
+    # the first word is sent after `delay`, and each of the rest after another `delay`
+    min_delay = stub_server.delay * 0.8
+    for stats in instance_stats.values():
+        assert min_delay <= stats["time_to_first_token"] < stats["latency"]
+    assert instance_stats[2]["inter_token_latency"] >= min_delay
+    assert instance_stats[2]["latency"] >= min_delay * 4
+
+    stats = chatgpt.get_stats()
+    for key in ["time_to_first_token", "inter_token_latency", "latency"]:
+        assert stats[f"{key}_p50"] <= stats[f"{key}_p90"] <= stats[f"{key}_p99"]
+    assert stats["num_output_tokens_mean"] == 7 / 3
+    chatgpt.reset_stats()
+    assert chatgpt.get_stats() == {}
+    chatgpt.close()
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator
+
+import pytest
+
+from flexeval.core.language_model import OpenAICompletionLM
+from flexeval.core.language_model.hf_lm import tokenize_prefix_and_continuation_ids
+
+
+class StubCompletionServer(ThreadingHTTPServer):
+    """A stand-in for an OpenAI-compatible completions endpoint.
+
+    The prompt is split into words as tokens, and the log probability of each token is minus its length.
+    A prompt of token ids is echoed back as is, and the log probability of each token is minus its id.
+    The generated text is `" done"` after `delay` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), StubCompletionHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.num_in_flight = 0
+        self.max_num_in_flight = 0
+        self.requests: list[dict[str, Any]] = []
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubCompletionServer
+
+    def do_POST(self) -> None:  # noqa: N802
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append(request)
+            self.server.num_in_flight += 1
+            self.server.max_num_in_flight = max(self.server.max_num_in_flight, self.server.num_in_flight)
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.num_in_flight -= 1
+
+        prompt = request["prompt"]
+        generated_text = " done"
+        logprobs = None
+        if request.get("logprobs") is not None:
+            if isinstance(prompt, list):
+                tokens = [str(token_id) for token_id in prompt] if request.get("echo") else []
+                token_logprobs = [-float(token_id) for token_id in prompt]
+                prompt = "".join(tokens)
+            else:
+                tokens = re.findall(r"\S+\s*", prompt) if request.get("echo") else []
+                token_logprobs = [-float(len(token.strip())) for token in tokens]
+            text_offset = [sum(len(token) for token in tokens[:i]) for i in range(len(tokens))]
+            if token_logprobs:
+                token_logprobs[0] = None
+            logprobs = {
+                "tokens": [*tokens, generated_text],
+                "token_logprobs": [*token_logprobs, -0.5],
+                "text_offset": [*text_offset, len(prompt)],
+                "top_logprobs": None,
+            }
+        text = prompt + generated_text if request.get("echo") else generated_text
+        body = {
+            "id": "cmpl-stub",
+            "object": "text_completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [
+                {"index": i, "text": text, "logprobs": logprobs, "finish_reason": "length"}
+                for i in range(request.get("n", 1))
+            ],
+        }
+        encoded_body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002, ANN401
+        pass
+
+
+@pytest.fixture()
+def stub_server() -> Iterator[StubCompletionServer]:
+    server = StubCompletionServer(delay=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def lm(stub_server: StubCompletionServer) -> Iterator[OpenAICompletionLM]:
+    lm = OpenAICompletionLM(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        max_concurrency=3,
+    )
+    yield lm
+    lm.close()
+
+
+def test_batch_complete_text(lm: OpenAICompletionLM, stub_server: StubCompletionServer) -> None:
+    text_list = [f"text {i}" for i in range(8)]
+    assert lm.batch_complete_text(text_list, stop_sequences=["\n"], max_new_tokens=5) == [" done"] * 8
+    assert stub_server.max_num_in_flight == 3
+    assert sorted(request["prompt"] for request in stub_server.requests) == text_list
+    assert all(request["stop"] == ["\n"] and request["max_tokens"] == 5 for request in stub_server.requests)
+
+    assert dict(lm.iter_complete_text(["a", "b"])) == {0: " done", 1: " done"}
+    assert lm.batch_complete_text_samples(["a"], num_samples=2) == [[" done", " done"]]
+    assert asyncio.run(lm.abatch_complete_text(["a", "b"])) == [" done", " done"]
+
+
+def test_batch_compute_log_probs(lm: OpenAICompletionLM) -> None:
+    log_probs = lm.batch_compute_log_probs(["yy zzz", "aa bbb"], prefix_list=["x ", "w "])
+    # the log probabilities of the prefix, the first token, and the generated token are excluded
+    assert log_probs == [-5.0, -5.0]
+    assert asyncio.run(lm.abatch_compute_log_probs(["yy zzz", "aa bbb"], prefix_list=["x ", "w "])) == log_probs
+
+    # the token "xa " crossing the boundary between the prefix and the text is counted as part of the text
+    assert lm.batch_compute_log_probs(["a yy"], prefix_list=["w x"]) == [-4.0]
+
+    # the first token of the prompt has no log probability
+    with pytest.raises(RuntimeError):
+        lm.batch_compute_log_probs(["w xx yyy"])
+
+    with pytest.raises(ValueError):
+        lm.batch_compute_log_probs(["text"], stride=1)
+
+
+def test_batch_compute_log_probs_with_tokenizer(stub_server: StubCompletionServer) -> None:
+    lm = OpenAICompletionLM(
+        model_name="stub-model",
+        api_headers={"api_key": "dummy", "base_url": stub_server.base_url},
+        tokenizer="sbintuitions/tiny-lm",
+    )
+    tokenizer = lm._tokenizer  # noqa: SLF001
+    text_list = ["こんにちは", "世界"]
+    prefix_list = ["", "ハロー"]
+    log_probs = lm.batch_compute_log_probs(text_list, prefix_list=prefix_list)
+    lm.close()
+
+    # the prompts are tokenized in the same way as `HuggingFaceLM`, where an empty prefix is the bos token
+    prefix_ids_list, continuation_ids_list = tokenize_prefix_and_continuation_ids(text_list, prefix_list, tokenizer)
+    assert prefix_ids_list[0] == [tokenizer.bos_token_id]
+    assert [request["prompt"] for request in stub_server.requests] == [
+        prefix_ids + continuation_ids for prefix_ids, continuation_ids in zip(prefix_ids_list, continuation_ids_list)
+    ]
+    # the stub returns minus the token id as the log probability of each token
+    assert log_probs == [-float(sum(continuation_ids)) for continuation_ids in continuation_ids_list]
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import pytest
+
+from flexeval.core.language_model.rate_limiter import (
+    RateLimiter,
+    estimate_num_tokens,
+    get_shared_rate_limiter,
+    parse_retry_after,
+)
+
+
+def test_requests_wait_when_the_budget_of_requests_runs_out() -> None:
+    rate_limiter = RateLimiter(requests_per_minute=60)
+    assert [rate_limiter.reserve() for _ in range(60)] == [0.0] * 60
+    # the budget refills at one request per second
+    assert rate_limiter.reserve() == pytest.approx(1.0, abs=0.05)
+    assert rate_limiter.reserve() == pytest.approx(2.0, abs=0.05)
+
+
+def test_requests_wait_when_the_budget_of_tokens_runs_out() -> None:
+    rate_limiter = RateLimiter(tokens_per_minute=600)
+    assert rate_limiter.reserve(600) == 0.0
+    assert rate_limiter.reserve(60) == pytest.approx(6.0, abs=0.05)
+
+    # the tokens that turned out not to be used are returned to the budget
+    rate_limiter.adjust_tokens(-60)
+    assert rate_limiter.reserve(0) == pytest.approx(0.0, abs=0.05)
+
+
+def test_pause_holds_all_the_requests() -> None:
+    rate_limiter = RateLimiter(requests_per_minute=1000)
+    rate_limiter.pause(2.0)
+    assert rate_limiter.reserve() == pytest.approx(2.0, abs=0.05)
+    assert rate_limiter.reserve() == pytest.approx(2.0, abs=0.05)
+
+
+def test_get_shared_rate_limiter() -> None:
+    rate_limiter = get_shared_rate_limiter("test-group", requests_per_minute=10)
+    assert get_shared_rate_limiter("test-group", requests_per_minute=10) is rate_limiter
+    assert get_shared_rate_limiter("another-group", requests_per_minute=10) is not rate_limiter
+    with pytest.raises(ValueError):
+        get_shared_rate_limiter("test-group", requests_per_minute=20)
+
+
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [
+        ({"retry-after": "3"}, 3.0),
+        ({"retry-after-ms": "1500", "retry-after": "3"}, 1.5),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0.0),
+        ({"retry-after": "invalid"}, None),
+        ({}, None),
+    ],
+)
+def test_parse_retry_after(headers: dict[str, str], expected: float | None) -> None:
+    assert parse_retry_after(headers) == expected
+
+
+def test_estimate_num_tokens() -> None:
+    assert estimate_num_tokens("This is a pen.") == 4
+    assert estimate_num_tokens("これはペンです。") == 7
@@ -1,5 +1,14 @@
+from __future__ import annotations
+
+import sys
+from types import ModuleType, SimpleNamespace
+
 import pytest
+import torch
+from pytest_mock import MockerFixture
+from transformers import AutoModelForCausalLM
 
+from flexeval.core.language_model.hf_lm import HuggingFaceLM
 from flexeval.core.language_model.vllm_model import LanguageModel, VllmModel
 
 
@@ -124,3 +133,105 @@ def test_if_stop_sequences_work_as_expected(chat_lm: VllmModel) -> None:
     # check if ignore_eos=True works
     response = chat_lm.batch_generate_chat_response(test_inputs, max_new_tokens=50, ignore_eos=True)[0]
     assert eos_token in response[: -len(eos_token)]
+
+
+class StubLLMEngine:
+    """A stand-in for `vllm.LLMEngine` that echoes the prompts `n` times,
+    finishing one request at each step in reverse order.
+    """
+
+    def __init__(self) -> None:
+        self.requests: dict[str, tuple[list[int], int]] = {}
+
+    def add_request(self, request_id: str, inputs: dict[str, list[int]], params: dict) -> None:
+        self.requests[request_id] = (inputs["prompt_token_ids"], params["n"])
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.requests) > 0
+
+    def step(self) -> list[SimpleNamespace]:
+        request_id, (token_ids, n) = self.requests.popitem()
+        outputs = [SimpleNamespace(token_ids=token_ids) for _ in range(n)]
+        return [SimpleNamespace(request_id=request_id, finished=True, outputs=outputs)]
+
+    def abort_request(self, request_ids: list[str]) -> None:
+        for request_id in request_ids:
+            self.requests.pop(request_id)
+
+
+class StubLLM:
+    """A stand-in for `vllm.LLM` that computes the prompt logprobs with a Hugging Face model."""
+
+    def __init__(self, model: str, **kwargs) -> None:
+        self._model = AutoModelForCausalLM.from_pretrained(model, torch_dtype=torch.float32)
+        self.llm_engine = StubLLMEngine()
+
+    def generate(
+        self,
+        prompt_token_ids: list[list[int]],
+        sampling_params: dict,
+        use_tqdm: bool = True,
+    ) -> list[SimpleNamespace]:
+        assert sampling_params["prompt_logprobs"] == 0
+        outputs = []
+        for token_ids in prompt_token_ids:
+            with torch.no_grad():
+                log_probs = self._model(torch.tensor([token_ids])).logits[0].log_softmax(dim=-1)
+            prompt_logprobs = [None] + [
+                {token_id: SimpleNamespace(logprob=log_probs[i, token_id].item())}
+                for i, token_id in enumerate(token_ids[1:])
+            ]
+            outputs.append(SimpleNamespace(prompt_logprobs=prompt_logprobs))
+        return outputs
+
+
+@pytest.fixture()
+def lm_with_stub_engine(mocker: MockerFixture) -> VllmModel:
+    stub_vllm = ModuleType("vllm")
+    stub_vllm.LLM = StubLLM
+    stub_vllm.SamplingParams = dict
+    mocker.patch.dict(sys.modules, {"vllm": stub_vllm})
+    return VllmModel(model_name="sbintuitions/tiny-lm", tokenizer_kwargs={"use_fast": False})
+
+
+def test_batch_compute_log_probs_matches_hf_lm(lm_with_stub_engine: VllmModel) -> None:
+    hf_lm = HuggingFaceLM(
+        model_name="sbintuitions/tiny-lm",
+        model_kwargs={"torch_dtype": "float32"},
+        tokenizer_kwargs={"use_fast": False},
+    )
+
+    text_list = ["は続き", "これは文頭", "is continuation.", "Lorem ipsum"]
+    for prefix_list in [None, ["これ", "", "This", "Lorem ipsum dolor"]]:
+        log_probs = lm_with_stub_engine.batch_compute_log_probs(text_list, prefix_list=prefix_list)
+        expected = hf_lm.batch_compute_log_probs(text_list, prefix_list=prefix_list)
+        assert log_probs == pytest.approx(expected, abs=1e-4)
+
+
+def test_batch_compute_log_probs_rejects_prefix_caching(lm_with_stub_engine: VllmModel) -> None:
+    lm_with_stub_engine._llm.llm_engine.cache_config = SimpleNamespace(enable_prefix_caching=True)  # noqa: SLF001
+    with pytest.raises(ValueError):
+        lm_with_stub_engine.batch_compute_log_probs(["これは文頭"])
+
+
+def test_iter_complete_text_streams_the_results(lm_with_stub_engine: VllmModel) -> None:
+    text_list = ["こんにちは", "Lorem ipsum", "10 10 10"]
+    assert lm_with_stub_engine.prefers_whole_dataset()
+
+    # the stub engine finishes the requests in reverse order
+    results = list(lm_with_stub_engine.iter_complete_text(text_list))
+    assert [index for index, _ in results] == [2, 1, 0]
+    assert lm_with_stub_engine.batch_complete_text(text_list) == [text for _, text in reversed(results)]
+
+    # the stop sequences are removed from the outputs
+    assert lm_with_stub_engine.batch_complete_text(text_list, stop_sequences=["ipsum"])[1] == "Lorem "
+
+    # the remaining requests are aborted when the results are not consumed to the end
+    next(lm_with_stub_engine.iter_complete_text(text_list))
+    assert not lm_with_stub_engine._llm.llm_engine.has_unfinished_requests()  # noqa: SLF001
+
+
+def test_batch_complete_text_samples_returns_all_the_samples(lm_with_stub_engine: VllmModel) -> None:
+    text_list = ["こんにちは", "Lorem ipsum"]
+    samples_list = lm_with_stub_engine.batch_complete_text_samples(text_list, num_samples=3)
+    assert samples_list == [[text] * 3 for text in lm_with_stub_engine.batch_complete_text(text_list)]
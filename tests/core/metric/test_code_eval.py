@@ -43,3 +43,18 @@ def test_correct_code_with_prompt(prompt: str, code: str, test_case: str) -> Non
     metric_result = code_eval.evaluate([code], references_list=[[test_case]], task_inputs_list=[{"prompt": prompt}])
     assert metric_result.summary == {"pass@1": 1.0}
     assert metric_result.instance_details[0]["passed"]
+
+
+def test_pass_at_k_with_multiple_samples() -> None:
+    code_eval = CodeEval()
+    lm_output_samples = [
+        ["def add(a, b):\n    return a - b", "def add(a, b):\n    return a + b"],
+        ["def add(a, b):\n    return a - b", "def add(a, b):\n    return a * b"],
+    ]
+    metric_result = code_eval.evaluate_samples(
+        lm_output_samples,
+        references_list=[["assert add(1, 2) == 3"], ["assert add(1, 2) == 3"]],
+    )
+    assert metric_result.summary == {"pass@1": 0.25, "pass@2": 0.5}
+    assert metric_result.instance_details[0]["passed"] == [False, True]
+    assert metric_result.instance_details[1]["num_passed"] == 0
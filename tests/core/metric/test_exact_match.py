@@ -3,6 +3,7 @@ from __future__ import annotations
 import pytest
 
 from flexeval.core.metric import ExactMatch
+from flexeval.core.metric.normalizer import RegexNormalizer
 
 
 @pytest.mark.parametrize(
@@ -17,3 +18,14 @@ def test_exact_match(lm_outputs: list[str], expected_outputs: list[list[str]], s
     metric_result = metric.evaluate(lm_outputs, references_list=expected_outputs)
     assert metric_result.summary["exact_match"] == score
     assert isinstance(metric_result.instance_details[0]["exact_match"], int)
+
+
+def test_exact_match_with_majority_vote() -> None:
+    metric = ExactMatch(normalizer=RegexNormalizer(pattern=r"-?[0-9.,]+"))
+    lm_output_samples = [
+        ["The answer is 3", "So 3", "The answer is 4"],
+        ["It is 5", "It is 6", "6 is the answer"],
+    ]
+    metric_result = metric.evaluate_samples(lm_output_samples, references_list=[["3"], ["5"]])
+    assert metric_result.summary["exact_match"] == 0.5
+    assert [detail["exact_match"] for detail in metric_result.instance_details] == [True, False]
@@ -1,17 +1,20 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import tempfile
+import time
 
 import pytest
+from pytest_mock import MockerFixture
 
-from flexeval.core.evaluate_chat_response import evaluate_chat_response
+from flexeval.core.evaluate_chat_response import aevaluate_chat_response, evaluate_chat_response
 from flexeval.core.evaluate_from_file import evaluate_from_file
-from flexeval.core.evaluate_generation import evaluate_generation
-from flexeval.core.evaluate_multiple_choice import evaluate_multiple_choice
+from flexeval.core.evaluate_generation import aevaluate_generation, evaluate_generation
+from flexeval.core.evaluate_multiple_choice import aevaluate_multiple_choice, evaluate_multiple_choice
 from flexeval.core.evaluate_pairwise import Match, evaluate_pairwise
 from flexeval.core.evaluate_perplexity import evaluate_perplexity
-from flexeval.core.metric import ExactMatch
+from flexeval.core.metric import ExactMatch, MetricResult
 from flexeval.core.prompt_template import Jinja2PromptTemplate
 from tests.dummy_modules import (
     DummyChatDataset,
@@ -24,7 +27,8 @@ from tests.dummy_modules import (
 
 
 @pytest.mark.parametrize("require_incremental_response", [True, False])
-def test_evaluate_chat_response(require_incremental_response: bool) -> None:
+@pytest.mark.parametrize("max_tokens_per_batch", [None, 16])
+def test_evaluate_chat_response(require_incremental_response: bool, max_tokens_per_batch: int | None) -> None:
     metrics, outputs = evaluate_chat_response(
         language_model=DummyLanguageModel(),
         gen_kwargs={},
@@ -33,12 +37,14 @@ def test_evaluate_chat_response(require_incremental_response: bool) -> None:
         ),
         metrics=[],
         batch_size=1,
+        max_tokens_per_batch=max_tokens_per_batch,
     )
     assert isinstance(metrics, dict)
     assert isinstance(outputs, list)
 
 
-def test_evaluate_generation() -> None:
+@pytest.mark.parametrize("max_tokens_per_batch", [None, 16])
+def test_evaluate_generation(max_tokens_per_batch: int | None) -> None:
     metrics, outputs = evaluate_generation(
         language_model=DummyLanguageModel(),
         gen_kwargs={},
@@ -46,31 +52,138 @@ def test_evaluate_generation() -> None:
         prompt_template=Jinja2PromptTemplate("{{text}}"),
         metrics=[ExactMatch()],
         batch_size=1,
+        max_tokens_per_batch=max_tokens_per_batch,
     )
     assert isinstance(metrics, dict)
     assert isinstance(outputs, list)
 
 
-def test_evaluate_multiple_choice() -> None:
+def test_evaluate_generation_with_token_budget_keeps_the_original_order() -> None:
+    eval_kwargs = {
+        "language_model": DummyLanguageModel(),
+        "gen_kwargs": {},
+        "eval_dataset": DummyGenerationDataset(),
+        "prompt_template": Jinja2PromptTemplate("{{text}}"),
+        "metrics": [ExactMatch()],
+        "batch_size": 4,
+    }
+    _, outputs = evaluate_generation(**eval_kwargs)
+    _, outputs_with_budget = evaluate_generation(**eval_kwargs, max_tokens_per_batch=32)
+    assert outputs == outputs_with_budget
+
+
+def test_evaluate_generation_feeds_the_whole_dataset_if_preferred(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "prefers_whole_dataset", return_value=True)
+    spy = mocker.spy(language_model, "batch_complete_text")
+    eval_dataset = DummyGenerationDataset()
+    _, outputs = evaluate_generation(
+        language_model=language_model,
+        gen_kwargs={},
+        eval_dataset=eval_dataset,
+        prompt_template=Jinja2PromptTemplate("{{text}}"),
+        metrics=[ExactMatch()],
+        batch_size=1,
+    )
+    assert spy.call_count == 1
+    assert len(outputs) == len(eval_dataset)
+
+
+def test_evaluate_generation_warns_that_the_token_budget_is_ignored_if_the_whole_dataset_is_preferred(
+    mocker: MockerFixture,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "prefers_whole_dataset", return_value=True)
+    eval_dataset = DummyGenerationDataset()
+    _, outputs = evaluate_generation(
+        language_model=language_model,
+        gen_kwargs={},
+        eval_dataset=eval_dataset,
+        prompt_template=Jinja2PromptTemplate("{{text}}"),
+        metrics=[ExactMatch()],
+        batch_size=1,
+        max_tokens_per_batch=16,
+    )
+    assert len(outputs) == len(eval_dataset)
+    assert "`max_tokens_per_batch` is ignored" in caplog.text
+
+
+def test_evaluate_generation_with_multiple_samples(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    spy = mocker.spy(language_model, "batch_complete_text_samples")
+    eval_dataset = DummyGenerationDataset()
+    metrics, outputs = evaluate_generation(
+        language_model=language_model,
+        gen_kwargs={},
+        eval_dataset=eval_dataset,
+        prompt_template=Jinja2PromptTemplate("{{text}}"),
+        metrics=[ExactMatch()],
+        batch_size=2,
+        num_samples=3,
+    )
+    assert spy.call_count == (len(eval_dataset) + 1) // 2
+    assert "exact_match" in metrics
+    for output in outputs:
+        assert output["lm_output_samples"] == [output["lm_output"]] * 3
+
+
+def test_evaluate_chat_response_streams_the_whole_dataset_if_preferred(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "prefers_whole_dataset", return_value=True)
+    spy = mocker.spy(language_model, "iter_generate_chat_response")
+    eval_dataset = DummyChatDataset()
+    _, outputs = evaluate_chat_response(
+        language_model=language_model,
+        gen_kwargs={},
+        eval_dataset=eval_dataset,
+        metrics=[],
+        batch_size=1,
+    )
+    assert spy.call_count == 1
+    assert [output["lm_output"] for output in outputs] == ["This is response."] * len(eval_dataset)
+
+
+@pytest.mark.parametrize("max_tokens_per_batch", [None, 16])
+def test_evaluate_multiple_choice(max_tokens_per_batch: int | None) -> None:
     metrics, outputs = evaluate_multiple_choice(
         language_model=DummyLanguageModel(),
         eval_dataset=DummyMultipleChoiceDataset(),
         prompt_template=Jinja2PromptTemplate("{{text}}"),
         batch_size=1,
+        max_tokens_per_batch=max_tokens_per_batch,
     )
     assert isinstance(metrics, dict)
     assert isinstance(outputs, list)
 
 
-def test_evaluate_perplexity() -> None:
+@pytest.mark.parametrize("max_tokens_per_batch", [None, 16])
+def test_evaluate_perplexity(max_tokens_per_batch: int | None) -> None:
     metrics = evaluate_perplexity(
         language_model=DummyLanguageModel(),
         eval_dataset=DummyTextDataset(),
         batch_size=1,
+        max_tokens_per_batch=max_tokens_per_batch,
     )
     assert isinstance(metrics, dict)
 
 
+def test_evaluate_perplexity_feeds_the_whole_dataset_if_preferred(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "prefers_whole_dataset", return_value=True)
+    spy = mocker.spy(language_model, "batch_compute_log_probs")
+    metrics = evaluate_perplexity(
+        language_model=language_model,
+        eval_dataset=DummyTextDataset(),
+        batch_size=1,
+        max_tokens_per_batch=16,
+    )
+    assert spy.call_count == 1
+    assert spy.call_args.args[0] == list(DummyTextDataset())
+    expected = evaluate_perplexity(language_model=DummyLanguageModel(), eval_dataset=DummyTextDataset(), batch_size=1)
+    assert metrics == expected
+
+
 def test_evaluate_from_file() -> None:
     items = [
         {"lm_output": "This is test", "references": "This is test"},
@@ -122,3 +235,118 @@ def test_evaluate_pairwise(cached_matches: list[Match] | None) -> None:
     assert len(match_info_list) == 2 * num_items
     if cached_matches:
         assert match_info_list[0]["rationale"] == "cache test"
+
+
+def test_evaluate_generation_saves_the_stats_of_each_instance(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    mocker.patch.object(language_model, "prefers_whole_dataset", return_value=True)
+    mocker.patch.object(language_model, "pop_instance_stats", return_value={0: {"latency": 0.1}})
+    eval_dataset = DummyGenerationDataset()
+    _, outputs = evaluate_generation(
+        language_model=language_model,
+        gen_kwargs={},
+        eval_dataset=eval_dataset,
+        prompt_template=Jinja2PromptTemplate("{{text}}"),
+        metrics=[],
+        batch_size=1,
+    )
+    assert outputs[0]["latency"] == 0.1
+    assert all("latency" not in output for output in outputs[1:])
+
+
+@pytest.mark.parametrize("num_samples", [1, 3])
+def test_aevaluate_generation_matches_evaluate_generation(num_samples: int) -> None:
+    kwargs = {
+        "language_model": DummyLanguageModel(),
+        "gen_kwargs": {"max_new_tokens": 8},
+        "eval_dataset": DummyGenerationDataset(),
+        "prompt_template": Jinja2PromptTemplate("{{text}}"),
+        "metrics": [ExactMatch()],
+        "batch_size": 1,
+        "num_samples": num_samples,
+    }
+    assert asyncio.run(aevaluate_generation(**kwargs, max_batches_in_flight=3)) == evaluate_generation(**kwargs)
+
+
+@pytest.mark.parametrize("require_incremental_response", [True, False])
+def test_aevaluate_chat_response_matches_evaluate_chat_response(require_incremental_response: bool) -> None:
+    kwargs = {
+        "language_model": DummyLanguageModel(),
+        "gen_kwargs": {},
+        "eval_dataset": DummyChatDataset(require_incremental_response=require_incremental_response),
+        "metrics": [ExactMatch()],
+        "batch_size": 1,
+    }
+    assert asyncio.run(aevaluate_chat_response(**kwargs, max_batches_in_flight=3)) == evaluate_chat_response(**kwargs)
+
+
+def test_aevaluate_multiple_choice_matches_evaluate_multiple_choice() -> None:
+    kwargs = {
+        "language_model": DummyLanguageModel(),
+        "eval_dataset": DummyMultipleChoiceDataset(),
+        "prompt_template": Jinja2PromptTemplate("{{text}}"),
+        "batch_size": 1,
+    }
+    expected = evaluate_multiple_choice(**kwargs)
+    assert asyncio.run(aevaluate_multiple_choice(**kwargs, max_batches_in_flight=3)) == expected
+
+
+def test_aevaluate_generation_keeps_the_batches_in_flight(mocker: MockerFixture) -> None:
+    language_model = DummyLanguageModel()
+    num_in_flight = 0
+    max_num_in_flight = 0
+
+    async def abatch_complete_text(text_list: list[str], **kwargs) -> list[str]:  # noqa: ARG001
+        nonlocal num_in_flight, max_num_in_flight
+        num_in_flight += 1
+        max_num_in_flight = max(max_num_in_flight, num_in_flight)
+        await asyncio.sleep(0.01)
+        num_in_flight -= 1
+        return text_list
+
+    mocker.patch.object(language_model, "abatch_complete_text", side_effect=abatch_complete_text)
+    asyncio.run(
+        aevaluate_generation(
+            language_model=language_model,
+            gen_kwargs={},
+            eval_dataset=DummyGenerationDataset(),
+            prompt_template=Jinja2PromptTemplate("{{text}}"),
+            metrics=[],
+            batch_size=1,
+            max_batches_in_flight=2,
+        ),
+    )
+    assert max_num_in_flight == 2
+
+
+def test_aevaluate_generation_computes_the_metrics_one_by_one(mocker: MockerFixture) -> None:
+    num_running = 0
+    max_num_running = 0
+    metrics = [ExactMatch(), ExactMatch()]
+
+    def evaluate(
+        lm_outputs: list[str],  # noqa: ARG001
+        references_list: list[list[str]],  # noqa: ARG001
+        task_inputs_list: list[dict[str, str]] | None = None,  # noqa: ARG001
+    ) -> MetricResult:
+        nonlocal num_running, max_num_running
+        num_running += 1
+        max_num_running = max(max_num_running, num_running)
+        time.sleep(0.05)
+        num_running -= 1
+        return MetricResult(summary={})
+
+    for metric in metrics:
+        mocker.patch.object(metric, "evaluate", side_effect=evaluate)
+    asyncio.run(
+        aevaluate_generation(
+            language_model=DummyLanguageModel(),
+            gen_kwargs={},
+            eval_dataset=DummyGenerationDataset(),
+            prompt_template=Jinja2PromptTemplate("{{text}}"),
+            metrics=metrics,
+            batch_size=1,
+        ),
+    )
+    # LLM judges may share a model, which must not be called from multiple threads
+    assert max_num_running == 1
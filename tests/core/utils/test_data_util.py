@@ -1,6 +1,6 @@
 import pytest
 
-from flexeval.core.utils.data_util import batch_iter
+from flexeval.core.utils.data_util import batch_iter, token_budget_batch_indices
 
 
 def test_batch_iter_normal_case() -> None:
@@ -30,3 +30,36 @@ def test_batch_iter_large_batch_size() -> None:
 def test_batch_iter_invalid_batch_size() -> None:
     with pytest.raises(ValueError):
         list(batch_iter(range(5), 0))
+
+
+def test_token_budget_batch_indices_normal_case() -> None:
+    batches = token_budget_batch_indices([1, 5, 2, 4], max_tokens=8)
+    assert batches == [[1], [3, 2], [0]]
+
+
+def test_token_budget_batch_indices_covers_all_items() -> None:
+    lengths = [3, 7, 1, 9, 4, 4, 2, 8]
+    batches = token_budget_batch_indices(lengths, max_tokens=16)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 16
+
+
+def test_token_budget_batch_indices_with_max_batch_size() -> None:
+    batches = token_budget_batch_indices([1, 1, 1, 1, 1], max_tokens=100, max_batch_size=2)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_token_budget_batch_indices_with_num_rows() -> None:
+    # each item occupies 3 rows, so only one item fits in the budget
+    batches = token_budget_batch_indices([2, 2, 2], max_tokens=10, num_rows=[3, 3, 3])
+    assert batches == [[0], [1], [2]]
+
+
+def test_token_budget_batch_indices_invalid_arguments() -> None:
+    with pytest.raises(ValueError):
+        token_budget_batch_indices([1, 2], max_tokens=0)
+    with pytest.raises(ValueError):
+        token_budget_batch_indices([1, 2], max_tokens=10, max_batch_size=0)
+    with pytest.raises(ValueError):
+        token_budget_batch_indices([1, 2], max_tokens=10, num_rows=[1])
@@ -98,13 +98,19 @@ def test_evaluate_suite_cli() -> None:
         result = subprocess.run(command, check=False)
         assert result.returncode == 0
 
+        # the load time of the language model is reported only with the first setup, which loaded the model
+        setups_with_load_time: list[str] = []
         for task_name in ["generation", "multiple_choice", "perplexity"]:
             check_if_eval_results_are_correctly_saved(Path(f) / task_name, no_outputs=task_name == "perplexity")
+            with open(Path(f) / task_name / METRIC_FILE_NAME) as f_json:
+                if "language_model_load_time" in json.load(f_json):
+                    setups_with_load_time.append(task_name)
 
             # check if the saved config is reusable
             command = ["flexeval_lm", "--config", str(Path(f) / task_name / CONFIG_FILE_NAME)]
             result = subprocess.run(command, check=False)
             assert result.returncode == 0
+        assert len(setups_with_load_time) == 1
 
 
 @pytest.mark.parametrize(
@@ -210,6 +216,27 @@ def test_if_cli_raises_error_when_save_data_exists(command: list[str]) -> None:
         assert config_file.read_text() == ""
 
 
+def test_if_language_model_is_not_loaded_when_all_setups_are_skipped() -> None:
+    with tempfile.TemporaryDirectory() as f:
+        result = subprocess.run([*PERPLEXITY_CMD, "--save_dir", f], check=False)
+        assert result.returncode == 0
+        with open(Path(f) / METRIC_FILE_NAME) as f_json:
+            assert "language_model_load_time" in json.load(f_json)
+
+        # the model does not exist, so loading it would fail
+        # fmt: off
+        command = [
+            "flexeval_lm",
+            "--language_model", "HuggingFaceLM",
+            "--language_model.model_name", "this-model/does-not-exist",
+            *PERPLEXITY_CMD[3:],
+            "--save_dir", f,
+        ]
+        # fmt: on
+        result = subprocess.run(command, check=False)
+        assert result.returncode == 0
+
+
 @pytest.mark.parametrize(
     "command",
     [CHAT_RESPONSE_CMD, GENERATION_CMD, MULTIPLE_CHOICE_CMD, PERPLEXITY_CMD],
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from flexeval.scripts.common import CONFIG_FILE_NAME, METRIC_FILE_NAME, OUTPUTS_FILE_NAME
+
+from .test_flexeval_lm import (
+    CHAT_RESPONSE_CMD,
+    GENERATION_CMD,
+    MULTIPLE_CHOICE_CMD,
+    PERPLEXITY_CMD,
+    check_if_eval_results_are_correctly_saved,
+    read_jsonl,
+)
+
+
+@contextlib.contextmanager
+def run_server() -> Iterator[str]:
+    # a short directory is used because the path of a Unix domain socket is limited to about 100 characters
+    with tempfile.TemporaryDirectory() as f:
+        socket_path = str(Path(f) / "serve.sock")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "flexeval.scripts.flexeval_serve", "--socket_path", socket_path],
+        )
+        for _ in range(300):
+            if Path(socket_path).exists():
+                break
+            time.sleep(0.1)
+        yield socket_path
+        server.terminate()
+        server.wait()
+
+
+@pytest.fixture(scope="module")
+def socket_path() -> Iterator[str]:
+    with run_server() as socket_path:
+        yield socket_path
+
+
+@pytest.mark.parametrize(
+    "command",
+    [CHAT_RESPONSE_CMD, GENERATION_CMD, MULTIPLE_CHOICE_CMD, PERPLEXITY_CMD],
+)
+def test_cli_with_server(command: list[str], socket_path: str) -> None:
+    with tempfile.TemporaryDirectory() as local_dir, tempfile.TemporaryDirectory() as server_dir:
+        result = subprocess.run([*command, "--save_dir", local_dir], check=False)
+        assert result.returncode == 0
+        result = subprocess.run([*command, "--save_dir", server_dir, "--server", socket_path], check=False)
+        assert result.returncode == 0
+
+        check_if_eval_results_are_correctly_saved(server_dir, no_outputs="Perplexity" in command)
+        assert (Path(server_dir) / CONFIG_FILE_NAME).exists()
+        if "Perplexity" not in command:
+            assert read_jsonl(Path(server_dir) / OUTPUTS_FILE_NAME) == read_jsonl(Path(local_dir) / OUTPUTS_FILE_NAME)
+
+
+def test_evaluate_suite_cli_with_server(socket_path: str) -> None:
+    with tempfile.TemporaryDirectory() as f:
+        # fmt: off
+        command = [
+            "flexeval_lm",
+            "--language_model", "tests.dummy_modules.DummyLanguageModel",
+            "--eval_setup", "tests/dummy_modules/configs/eval_suite.jsonnet",
+            "--save_dir", f,
+            "--server", socket_path,
+        ]
+        # fmt: on
+        result = subprocess.run(command, check=False)
+        assert result.returncode == 0
+
+        assert sorted(path.name for path in Path(f).iterdir()) == ["generation", "multiple_choice", "perplexity"]
+        for task_name in ["generation", "multiple_choice", "perplexity"]:
+            check_if_eval_results_are_correctly_saved(Path(f) / task_name, no_outputs=task_name == "perplexity")
+
+
+def test_language_model_is_kept_loaded_in_server() -> None:
+    # a new server is started so that the model is not loaded by the other tests
+    metrics_list: list[dict] = []
+    env = {**os.environ, "PYTHONPATH": str(Path.cwd())}
+    with run_server() as socket_path:
+        for _ in range(2):
+            # the jobs are submitted from different directories
+            with tempfile.TemporaryDirectory() as f:
+                command = [*GENERATION_CMD, "--save_dir", "results", "--server", socket_path]
+                result = subprocess.run(command, check=False, cwd=f, env=env)
+                assert result.returncode == 0
+                with open(Path(f) / "results" / METRIC_FILE_NAME) as f_json:
+                    metrics_list.append(json.load(f_json))
+    # the second job reuses the model loaded for the first one, so the load time is not reported again
+    assert [("language_model_load_time" in metrics) for metrics in metrics_list] == [True, False]
+
+
+@pytest.mark.parametrize("num_texts", [1, 2])
+def test_relative_paths_are_resolved_in_the_working_directory_of_the_client(socket_path: str, num_texts: int) -> None:
+    with tempfile.TemporaryDirectory() as client_dir:
+        with open(Path(client_dir) / "data.jsonl", "w") as f_jsonl:
+            for _ in range(num_texts):
+                f_jsonl.write(json.dumps({"text": "This is a test."}) + "\n")
+        # fmt: off
+        command = [
+            "flexeval_lm",
+            "--language_model", "tests.dummy_modules.DummyLanguageModel",
+            "--eval_setup", "Perplexity",
+            "--eval_setup.eval_dataset", "JsonlTextDataset",
+            "--eval_setup.eval_dataset.file_path", "data.jsonl",
+            "--eval_setup.eval_dataset.field", "text",
+            "--eval_setup.batch_size", "1",
+            "--save_dir", "results",
+            "--server", socket_path,
+        ]
+        # fmt: on
+        env = {**os.environ, "PYTHONPATH": str(Path.cwd())}
+        result = subprocess.run(command, check=False, cwd=client_dir, env=env)
+        assert result.returncode == 0
+        check_if_eval_results_are_correctly_saved(Path(client_dir) / "results", no_outputs=True)
+        # the dataset loaded for the other client with the same relative path is not reused
+        with open(Path(client_dir) / "results" / METRIC_FILE_NAME) as f_json:
+            assert json.load(f_json)["total_log_prob"] == -1.0 * num_texts
+
+
+def test_errors_in_server_are_reported(socket_path: str) -> None:
+    with tempfile.TemporaryDirectory() as f:
+        # fmt: off
+        command = [
+            "flexeval_lm",
+            "--language_model", "HuggingFaceLM",
+            "--language_model.model_name", "this-model/does-not-exist",
+            *PERPLEXITY_CMD[3:],
+            "--save_dir", f,
+            "--server", socket_path,
+        ]
+        # fmt: on
+        result = subprocess.run(command, check=False, capture_output=True, text=True)
+        # the errors in evaluation are logged and skipped as in the local evaluation
+        assert result.returncode == 0
+        assert "The evaluation failed in the server" in result.stderr
+        assert not (Path(f) / METRIC_FILE_NAME).exists()